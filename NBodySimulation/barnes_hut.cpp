@@ -0,0 +1,174 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include "octree.h"
+
+// Barnes-Hut solver: the octree is rebuilt from scratch every step, cells far enough away
+// (cellSize / distance < theta) act as a single point mass placed in their center of mass.
+// theta = 0 opens every cell and falls back to the direct sum of accelerationOnParticle.
+// With data->sources the tree only holds the bodies that pull, the test particles just walk it.
+// The tree always works on the float32 positions and sums: its approximation error is far larger than
+// their rounding, data->precision only changes how the state is advanced.
+
+#define LEAF_CAPACITY 8			// bodies kept in a leaf before it is split
+#define TRAVERSAL_STACK_SIZE (7 * MAX_TREE_DEPTH + 8)
+
+static inline bool containsPoint(const OctreeNode& node, float3 p) {
+	return fabsf(p.x - node.center.x) <= node.halfSize
+		&& fabsf(p.y - node.center.y) <= node.halfSize
+		&& fabsf(p.z - node.center.z) <= node.halfSize;
+}
+
+static float3 treeAcceleration(const Octree& tree, int particleInd, const float3* positions, const float* weights, float thetaSquared, float* potential) {
+	float3 pos = positions[particleInd];
+	float3 acc = { 0.0f, 0.0f, 0.0f };
+	double phi = 0.0;
+	double* phiSum = potential ? &phi : NULL;
+
+	int stack[TRAVERSAL_STACK_SIZE];
+	int top = 0;
+	// no bodies that pull: no tree
+	if (!tree.nodes.empty())
+		stack[top++] = 0;
+
+	while (top > 0) {
+		const OctreeNode& node = tree.nodes[stack[--top]];
+		if (node.mass == 0.0f)
+			continue;
+
+		if (node.firstChild < 0) {
+			for (int k = node.begin; k < node.end; k++) {
+				int ind = tree.order[k];
+				if (ind == particleInd)
+					continue;
+				addPointMassAcceleration(&acc, pos, positions[ind], weights[ind], phiSum);
+			}
+			continue;
+		}
+
+		float dx = node.com.x - pos.x;
+		float dy = node.com.y - pos.y;
+		float dz = node.com.z - pos.z;
+		float distSqr = dx * dx + dy * dy + dz * dz;
+		float size = 2.0f * node.halfSize;
+		// a cell holding the body itself is always opened
+		if (size * size < thetaSquared * distSqr && !containsPoint(node, pos)) {
+			addPointMassAcceleration(&acc, pos, node.com, node.mass, phiSum);
+		}
+		else {
+			for (int c = 0; c < 8; c++)
+				stack[top++] = node.firstChild + c;
+		}
+	}
+	if (potential)
+		*potential = (float)phi;
+	return acc;
+}
+
+// The tree is kept between steps so that its buffers are only reallocated when they have to grow
+static Octree* simulationTree(SimulationData* data) {
+	if (!data->barnesHutTree)
+		data->barnesHutTree = new Octree();
+	return (Octree*)data->barnesHutTree;
+}
+
+void releaseBarnesHutTree(SimulationData* data) {
+	delete (Octree*)data->barnesHutTree;
+	data->barnesHutTree = NULL;
+}
+
+int computeActiveAccelerationsBarnesHut(SimulationData* data, const int* active, int nactive, float3* acc) {
+	if (data->theta < 0 || syncSimulationToHost(data))
+		return 1;
+
+	Octree& tree = *simulationTree(data);
+	const float3* positions = data->positions;
+	const float* weights = data->weights;
+	const float thetaSquared = data->theta * data->theta;
+	float* potentials = data->potentials;
+
+	buildOctree(tree, positions, weights, pullingBodies(data), LEAF_CAPACITY, data->sources);
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(dynamic, 64)
+#endif
+	for (int k = 0; k < nactive; k++) {
+		int i = active ? active[k] : k;
+		acc[k] = treeAcceleration(tree, i, positions, weights, thetaSquared, potentials ? &potentials[i] : NULL);
+	}
+	return 0;
+}
+
+static inline bool overlapsBox(const OctreeNode& node, const float* box) {
+	return node.center.x + node.halfSize >= box[0] && node.center.x - node.halfSize <= box[3]
+		&& node.center.y + node.halfSize >= box[1] && node.center.y - node.halfSize <= box[4]
+		&& node.center.z + node.halfSize >= box[2] && node.center.z - node.halfSize <= box[5];
+}
+
+// The tree as a box of targets sees it: a cell that treeAcceleration accepts for every point of the box is one
+// point mass (its distance from the box is the smallest distance from a target), the bodies of the leaves
+// reached are themselves. Items from items[first] on, only while they fit into capacity; returns their number
+static int exportCells(const Octree& tree, const float3* positions, const float* weights, const float* box, float thetaSquared,
+	float4* items, int first, int capacity) {
+	int count = 0;
+	int stack[TRAVERSAL_STACK_SIZE];
+	int top = 0;
+	if (!tree.nodes.empty())
+		stack[top++] = 0;
+
+	while (top > 0) {
+		const OctreeNode& node = tree.nodes[stack[--top]];
+		if (node.mass == 0.0f)
+			continue;
+
+		if (node.firstChild < 0) {
+			for (int k = node.begin; k < node.end; k++) {
+				int ind = tree.order[k];
+				if (first + count < capacity) {
+					float4 item = { positions[ind].x, positions[ind].y, positions[ind].z, weights[ind] };
+					items[first + count] = item;
+				}
+				count++;
+			}
+			continue;
+		}
+
+		float dx = fmaxf(fmaxf(box[0] - node.com.x, node.com.x - box[3]), 0.0f);
+		float dy = fmaxf(fmaxf(box[1] - node.com.y, node.com.y - box[4]), 0.0f);
+		float dz = fmaxf(fmaxf(box[2] - node.com.z, node.com.z - box[5]), 0.0f);
+		float distSqr = dx * dx + dy * dy + dz * dz;
+		float size = 2.0f * node.halfSize;
+		if (size * size < thetaSquared * distSqr && !overlapsBox(node, box)) {
+			if (first + count < capacity) {
+				float4 item = { node.com.x, node.com.y, node.com.z, node.mass };
+				items[first + count] = item;
+			}
+			count++;
+		}
+		else {
+			for (int c = 0; c < 8; c++)
+				stack[top++] = node.firstChild + c;
+		}
+	}
+	return count;
+}
+
+int essentialTree(SimulationData* data, float theta, int nboxes, const float* boxes, int* counts, float4* items, int capacity) {
+	if (theta < 0 || syncSimulationToHost(data))
+		return 1;
+
+	Octree& tree = *simulationTree(data);
+	buildOctree(tree, data->positions, data->weights, pullingBodies(data), LEAF_CAPACITY, data->sources);
+	int total = 0;
+	for (int b = 0; b < nboxes; b++) {
+		counts[b] = exportCells(tree, data->positions, data->weights, &boxes[6 * b], theta * theta, items, total, capacity);
+		total += counts[b];
+	}
+	return 0;
+}
+
+int computeAccelerationsBarnesHut(SimulationData* data, float3* acc) {
+	return computeActiveAccelerationsBarnesHut(data, NULL, data->nbodies, acc);
+}
+
+int updateSimulationBarnesHut(SimulationData* data, float timeStep) {
+	return stepSimulationHost(data, timeStep, computeActiveAccelerationsBarnesHut, FORCES_BARNES_HUT);
+}
@@ -0,0 +1,263 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <algorithm>
+#include <vector>
+#include "particle_update.h"
+
+// Hierarchical (block) time steps: particle i advances with its own step timeStep / 2^level[i],
+// level <= data->timestepLevels. A call advances everyone by timeStep, split into 2^timestepLevels
+// substeps of the finest level. Forces are recomputed only for the particles whose own step ends
+// at the current substep, the others just drift, so slow particles cost few force evaluations.
+//
+// Every particle follows kick-drift-kick leapfrog with its own step (data->integrator is not used):
+// half kick with the forces of the start of its step, drifts with everyone else, half kick with the
+// forces of the end. The level is then chosen again by dt = eta * |a| / |da/dt|, the jerk being the
+// change of the acceleration over the step just made. A particle may go to a finer level at the end
+// of any of its steps, but to a coarser one only where the coarser step boundaries line up.
+
+struct BlockTimesteps {
+	int maxLevel;		// timestepLevels and nbodies the levels were chosen for,
+	int nbodies;		// the levels are estimated again when they change
+	std::vector<int> levels;
+	std::vector<int> active;
+	std::vector<float3> newAccelerations;
+	std::vector<float3> savedPositions;		// state before the trial drift of estimateLevels
+	std::vector<float3> savedErrors;
+	std::vector<double3> savedPositions64;
+	long long forceEvaluations;
+};
+
+static BlockTimesteps* simulationBlockTimesteps(SimulationData* data) {
+	if (!data->blockTimesteps) {
+		BlockTimesteps* block = new BlockTimesteps();
+		block->maxLevel = -1;
+		block->nbodies = -1;
+		block->forceEvaluations = 0;
+		data->blockTimesteps = block;
+	}
+	return (BlockTimesteps*)data->blockTimesteps;
+}
+
+void releaseBlockTimesteps(SimulationData* data) {
+	delete (BlockTimesteps*)data->blockTimesteps;
+	data->blockTimesteps = NULL;
+}
+
+static inline float levelStep(float timeStep, int level) {
+	return ldexpf(timeStep, -level);
+}
+
+// Level of dt = eta * |a| / |jerk|: the coarsest one with timeStep / 2^level <= dt
+static int criterionLevel(float3 acc, float3 jerk, float timeStep, float eta, int maxLevel) {
+	double a = sqrt((double)acc.x * acc.x + (double)acc.y * acc.y + (double)acc.z * acc.z);
+	double j = sqrt((double)jerk.x * jerk.x + (double)jerk.y * jerk.y + (double)jerk.z * jerk.z);
+	// timeStep / dt, written so that a == 0 or j == 0 do not divide by zero
+	double ratio = j * timeStep;
+	if (ratio <= eta * a)
+		return 0;
+	if (!(ratio < ldexp(eta * a, maxLevel)))
+		return maxLevel;
+	int level = (int)ceil(log2(ratio / (eta * a)));
+	return level < maxLevel ? level : maxLevel;
+}
+
+// Coarsest level whose step boundaries include substep (in finest substeps)
+static inline int alignedLevel(int substep, int maxLevel) {
+	int level = 0;
+	while (substep % (1 << (maxLevel - level)) != 0)
+		level++;
+	return level;
+}
+
+static inline float3 jerkEstimate(float3 oldAcc, float3 newAcc, float dt) {
+	float3 jerk;
+	jerk.x = (newAcc.x - oldAcc.x) / dt;
+	jerk.y = (newAcc.y - oldAcc.y) / dt;
+	jerk.z = (newAcc.z - oldAcc.z) / dt;
+	return jerk;
+}
+
+static void kickHost(SimulationData* data, const int* levels, float timeStep) {
+	const int nbodies = data->nbodies;
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static)
+#endif
+	for (int i = 0; i < nbodies; i++) {
+		kickDriftParticleHost(data, i, 0.5f * levelStep(timeStep, levels[i]), 0.0f);
+	}
+}
+
+static void driftHost(SimulationData* data, float drift) {
+	const int nbodies = data->nbodies;
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static)
+#endif
+	for (int i = 0; i < nbodies; i++) {
+		kickDriftParticleHost(data, i, 0.0f, drift);
+	}
+}
+
+// First levels: the jerk is estimated from the forces after a trial drift by timeStep
+static int estimateLevels(SimulationData* data, BlockTimesteps& block, float timeStep, AccelerationFunction computeAccelerations) {
+	const int nbodies = data->nbodies;
+	block.levels.assign(nbodies, 0);
+	block.active.resize(nbodies);
+	block.newAccelerations.resize(nbodies);
+	block.savedPositions.assign(data->positions, data->positions + nbodies);
+	if (data->precision == PRECISION_KAHAN)
+		block.savedErrors.assign(data->positionErrors, data->positionErrors + nbodies);
+	if (data->precision == PRECISION_FLOAT64)
+		block.savedPositions64.assign(data->positions64, data->positions64 + nbodies);
+	block.maxLevel = data->timestepLevels;
+	block.nbodies = nbodies;
+
+	driftHost(data, timeStep);
+	int status = computeAccelerations(data, NULL, nbodies, block.newAccelerations.data());
+	std::copy(block.savedPositions.begin(), block.savedPositions.end(), data->positions);
+	if (data->precision == PRECISION_KAHAN)
+		std::copy(block.savedErrors.begin(), block.savedErrors.end(), data->positionErrors);
+	if (data->precision == PRECISION_FLOAT64)
+		std::copy(block.savedPositions64.begin(), block.savedPositions64.end(), data->positions64);
+	if (status) {
+		block.maxLevel = -1;
+		return 1;
+	}
+	block.forceEvaluations += nbodies;
+
+	for (int i = 0; i < nbodies; i++) {
+		float3 jerk = jerkEstimate(data->accelerations[i], block.newAccelerations[i], timeStep);
+		block.levels[i] = criterionLevel(data->accelerations[i], jerk, timeStep, data->timestepAccuracy, block.maxLevel);
+	}
+	return 0;
+}
+
+int stepBlockTimesteps(SimulationData* data, float timeStep, AccelerationFunction computeAccelerations, int forcesSource) {
+	const int nbodies = data->nbodies;
+	const int maxLevel = data->timestepLevels;
+	if (maxLevel > MAX_TIMESTEP_LEVEL || !(data->timestepAccuracy > 0) || checkPrecision(data) || syncSimulationToHost(data))
+		return 1;
+
+	BlockTimesteps& block = *simulationBlockTimesteps(data);
+	if (data->forcesSource != forcesSource) {
+		if (computeAccelerations(data, NULL, nbodies, data->accelerations))
+			return 1;
+		block.forceEvaluations += nbodies;
+	}
+	data->forcesSource = FORCES_NONE;
+	if (block.maxLevel != maxLevel || block.nbodies != nbodies) {
+		if (estimateLevels(data, block, timeStep, computeAccelerations))
+			return 1;
+	}
+
+	float3* accelerations = data->accelerations;
+	int* levels = block.levels.data();
+	int* active = block.active.data();
+	float3* newAccelerations = block.newAccelerations.data();
+	const float eta = data->timestepAccuracy;
+	const int substeps = 1 << maxLevel;
+	const float finestStep = levelStep(timeStep, maxLevel);
+
+	// every particle starts its step together with the block
+	kickHost(data, levels, timeStep);
+
+	int substep = 0;
+	while (substep < substeps) {
+		// the next substep where some particle ends its step
+		int finestLevel = 0;
+		for (int i = 0; i < nbodies; i++)
+			finestLevel = levels[i] > finestLevel ? levels[i] : finestLevel;
+		int stride = 1 << (maxLevel - finestLevel);
+		int next = (substep / stride + 1) * stride;
+
+		driftHost(data, (next - substep) * finestStep);
+		substep = next;
+
+		int aligned = alignedLevel(substep, maxLevel);
+		int nactive = 0;
+		for (int i = 0; i < nbodies; i++) {
+			if (levels[i] >= aligned)
+				active[nactive++] = i;
+		}
+		if (computeAccelerations(data, active, nactive, newAccelerations))
+			return 1;
+		block.forceEvaluations += nactive;
+
+		// closing half kick, the next level and the opening half kick of the next step
+#ifdef _OPENMP
+		#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static)
+#endif
+		for (int k = 0; k < nactive; k++) {
+			int i = active[k];
+			float dt = levelStep(timeStep, levels[i]);
+			float3 jerk = jerkEstimate(accelerations[i], newAccelerations[k], dt);
+			accelerations[i] = newAccelerations[k];
+			int level = criterionLevel(accelerations[i], jerk, timeStep, eta, maxLevel);
+			levels[i] = level > aligned ? level : aligned;
+
+			float kick = 0.5f * dt;
+			if (substep < substeps)
+				kick += 0.5f * levelStep(timeStep, levels[i]);
+			kickDriftParticleHost(data, i, kick, 0.0f);
+		}
+	}
+
+	// all particles end together, so the accelerations are the ones of the new positions
+	data->forcesSource = forcesSource;
+	data->stateLocation = STATE_ON_HOST;
+	return 0;
+}
+
+int timestepLevelOccupancy(SimulationData* data, int* counts, long long* forceEvaluations) {
+	const BlockTimesteps* block = (const BlockTimesteps*)data->blockTimesteps;
+	if (!block || block->maxLevel != data->timestepLevels || block->nbodies != data->nbodies)
+		return 1;
+
+	for (int level = 0; level <= block->maxLevel; level++)
+		counts[level] = 0;
+	for (int i = 0; i < block->nbodies; i++)
+		counts[block->levels[i]]++;
+	*forceEvaluations = block->forceEvaluations;
+	return 0;
+}
+
+int getTimestepLevels(SimulationData* data, int* levels, long long* forceEvaluations) {
+	const BlockTimesteps* block = (const BlockTimesteps*)data->blockTimesteps;
+	if (!block || block->maxLevel != data->timestepLevels || block->nbodies != data->nbodies)
+		return 1;
+
+	std::copy(block->levels.begin(), block->levels.end(), levels);
+	*forceEvaluations = block->forceEvaluations;
+	return 0;
+}
+
+int setTimestepLevels(SimulationData* data, const int* levels, long long forceEvaluations) {
+	const int nbodies = data->nbodies;
+	for (int i = 0; i < nbodies; i++) {
+		if (levels[i] < 0 || levels[i] > data->timestepLevels)
+			return 1;
+	}
+
+	BlockTimesteps& block = *simulationBlockTimesteps(data);
+	block.levels.assign(levels, levels + nbodies);
+	block.active.resize(nbodies);
+	block.newAccelerations.resize(nbodies);
+	block.maxLevel = data->timestepLevels;
+	block.nbodies = nbodies;
+	block.forceEvaluations = forceEvaluations;
+	return 0;
+}
+
+void mergeBlockTimesteps(SimulationData* data, const int* target, int remaining) {
+	BlockTimesteps* block = (BlockTimesteps*)data->blockTimesteps;
+	if (!block || block->maxLevel != data->timestepLevels || block->nbodies != data->nbodies)
+		return;
+
+	// the merged body steps with the finest level of its particles until its next step chooses again
+	std::vector<int> levels(remaining, 0);
+	for (int i = 0; i < block->nbodies; i++)
+		levels[target[i]] = std::max(levels[target[i]], block->levels[i]);
+	block->levels.swap(levels);
+	block->active.resize(remaining);
+	block->newAccelerations.resize(remaining);
+	block->nbodies = remaining;
+}
\ No newline at end of file
@@ -0,0 +1,298 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <math.h>
+#include <vector>
+#include "particle_update.h"
+
+// Collision stage: particles closer than data->mergeRadius are merged into one body.
+// Candidate pairs come from a spatial hash of cells of size mergeRadius: a pair closer than the radius is
+// always in the same or in adjacent cells, so every particle only looks at the 27 cells around its own.
+// Cells are hashed into a table of twice the particle count (counting sort by bucket, no per-cell lists),
+// cells sharing a bucket only give extra candidates that fail the distance test. One pass is O(N) as long
+// as a cell holds a bounded number of particles.
+//
+// Pairs are joined into clusters (union-find), so a chain of close particles merges as a whole. A cluster
+// becomes one body with the total mass, the center of mass and the momentum of its members (sums in double),
+// in the place of its heaviest member; the others are removed and the arrays are compacted keeping the order
+// of the particles. The buffers never move, only data->nbodies gets smaller.
+
+struct CollisionGrid {
+	std::vector<int> bucketStart;	// nbuckets + 1, particles of bucket b are order[bucketStart[b]..bucketStart[b + 1])
+	std::vector<int> order;
+	std::vector<int> bucket;		// per particle
+	std::vector<int> parent;		// union-find over the particles
+	std::vector<int> slot;			// cluster of every root, -1 if the particle touches nobody
+	std::vector<int> target;		// index of every particle after the compaction
+	std::vector<char> pulls;		// per particle after the compaction: it is one of data->sources
+};
+
+// Sums of one merged body
+struct ClusterSum {
+	double mass;
+	double position[3];
+	double momentum[3];
+	int heaviest;
+};
+
+static CollisionGrid* simulationCollisionGrid(SimulationData* data) {
+	if (!data->collisionGrid)
+		data->collisionGrid = new CollisionGrid();
+	return (CollisionGrid*)data->collisionGrid;
+}
+
+void releaseCollisionGrid(SimulationData* data) {
+	delete (CollisionGrid*)data->collisionGrid;
+	data->collisionGrid = NULL;
+}
+
+static inline long long cellCoordinate(float x, double inverseCellSize) {
+	return (long long)floor(x * inverseCellSize);
+}
+
+static inline int cellBucket(long long cx, long long cy, long long cz, unsigned int mask) {
+	unsigned long long h = (unsigned long long)cx * 73856093ULL ^ (unsigned long long)cy * 19349663ULL ^ (unsigned long long)cz * 83492791ULL;
+	return (int)((h ^ (h >> 29)) & mask);
+}
+
+static int findRoot(std::vector<int>& parent, int i) {
+	while (parent[i] != i) {
+		parent[i] = parent[parent[i]];
+		i = parent[i];
+	}
+	return i;
+}
+
+static void joinClusters(std::vector<int>& parent, int i, int j) {
+	i = findRoot(parent, i);
+	j = findRoot(parent, j);
+	// the smaller index becomes the root: the result does not depend on the order the pairs are found in
+	if (i < j)
+		parent[j] = i;
+	else if (j < i)
+		parent[i] = j;
+}
+
+static inline void particleState64(const SimulationData* data, int i, double p[3], double v[3]) {
+	if (data->positions64) {
+		p[0] = data->positions64[i].x; p[1] = data->positions64[i].y; p[2] = data->positions64[i].z;
+		v[0] = data->velocities64[i].x; v[1] = data->velocities64[i].y; v[2] = data->velocities64[i].z;
+	}
+	else {
+		p[0] = data->positions[i].x; p[1] = data->positions[i].y; p[2] = data->positions[i].z;
+		v[0] = data->velocities[i].x; v[1] = data->velocities[i].y; v[2] = data->velocities[i].z;
+	}
+}
+
+// Pairs closer than the radius, joined into clusters in grid.parent; returns the number of pairs
+static long long findClusters(SimulationData* data, CollisionGrid& grid) {
+	const int nbodies = data->nbodies;
+	const float3* positions = data->positions;
+	const double inverseCellSize = 1.0 / data->mergeRadius;
+	const float radiusSquared = data->mergeRadius * data->mergeRadius;
+
+	unsigned int nbuckets = 1;
+	while (nbuckets < 2u * (unsigned int)nbodies)
+		nbuckets <<= 1;
+	const unsigned int mask = nbuckets - 1;
+
+	grid.bucket.resize(nbodies);
+	grid.order.resize(nbodies);
+	grid.bucketStart.assign(nbuckets + 1, 0);
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static)
+#endif
+	for (int i = 0; i < nbodies; i++) {
+		grid.bucket[i] = cellBucket(cellCoordinate(positions[i].x, inverseCellSize), cellCoordinate(positions[i].y, inverseCellSize),
+			cellCoordinate(positions[i].z, inverseCellSize), mask);
+	}
+	for (int i = 0; i < nbodies; i++)
+		grid.bucketStart[grid.bucket[i] + 1]++;
+	for (unsigned int b = 0; b < nbuckets; b++)
+		grid.bucketStart[b + 1] += grid.bucketStart[b];
+	{
+		std::vector<int> next(grid.bucketStart.begin(), grid.bucketStart.end() - 1);
+		for (int i = 0; i < nbodies; i++)
+			grid.order[next[grid.bucket[i]]++] = i;
+	}
+
+	grid.parent.resize(nbodies);
+	for (int i = 0; i < nbodies; i++)
+		grid.parent[i] = i;
+
+	// pairs are rare: every thread collects its own, the clusters are joined afterwards
+	std::vector<int> pairs;
+#ifdef _OPENMP
+	#pragma omp parallel num_threads(simulationThreads(data))
+#endif
+	{
+		std::vector<int> threadPairs;
+		int visited[27];
+#ifdef _OPENMP
+		#pragma omp for schedule(dynamic, 1024)
+#endif
+		for (int i = 0; i < nbodies; i++) {
+			float3 p = positions[i];
+			long long cx = cellCoordinate(p.x, inverseCellSize);
+			long long cy = cellCoordinate(p.y, inverseCellSize);
+			long long cz = cellCoordinate(p.z, inverseCellSize);
+			int nvisited = 0;
+			for (int dx = -1; dx <= 1; dx++)
+			for (int dy = -1; dy <= 1; dy++)
+			for (int dz = -1; dz <= 1; dz++) {
+				int b = cellBucket(cx + dx, cy + dy, cz + dz, mask);
+				// neighbouring cells may share a bucket, it is scanned once
+				bool seen = false;
+				for (int k = 0; k < nvisited && !seen; k++)
+					seen = visited[k] == b;
+				if (seen)
+					continue;
+				visited[nvisited++] = b;
+				for (int k = grid.bucketStart[b]; k < grid.bucketStart[b + 1]; k++) {
+					int j = grid.order[k];
+					if (j <= i)
+						continue;
+					float3 q = positions[j];
+					float ex = q.x - p.x, ey = q.y - p.y, ez = q.z - p.z;
+					if (ex * ex + ey * ey + ez * ez < radiusSquared) {
+						threadPairs.push_back(i);
+						threadPairs.push_back(j);
+					}
+				}
+			}
+		}
+#ifdef _OPENMP
+		#pragma omp critical
+#endif
+		pairs.insert(pairs.end(), threadPairs.begin(), threadPairs.end());
+	}
+
+	for (size_t k = 0; k < pairs.size(); k += 2)
+		joinClusters(grid.parent, pairs[k], pairs[k + 1]);
+	return (long long)(pairs.size() / 2);
+}
+
+int mergeCollisions(SimulationData* data, int* removed) {
+	*removed = 0;
+	if (!(data->mergeRadius >= 0) || syncSimulationToHost(data))
+		return 1;
+	const int nbodies = data->nbodies;
+	if (data->mergeRadius == 0 || nbodies < 2)
+		return 0;
+
+	CollisionGrid& grid = *simulationCollisionGrid(data);
+	if (!findClusters(data, grid))
+		return 0;
+
+	// clusters of more than one particle get a slot (the root is their smallest index), the others stay -1
+	std::vector<ClusterSum> clusters;
+	grid.slot.assign(nbodies, -1);
+	for (int i = 0; i < nbodies; i++) {
+		int root = grid.parent[i] = findRoot(grid.parent, i);
+		if (root != i && grid.slot[root] < 0) {
+			ClusterSum sum = { 0.0, { 0.0, 0.0, 0.0 }, { 0.0, 0.0, 0.0 }, root };
+			grid.slot[root] = (int)clusters.size();
+			clusters.push_back(sum);
+		}
+	}
+	for (int i = 0; i < nbodies; i++) {
+		int s = grid.slot[grid.parent[i]];
+		if (s < 0)
+			continue;
+		ClusterSum& sum = clusters[s];
+		double p[3], v[3];
+		particleState64(data, i, p, v);
+		double m = data->weights[i];
+		sum.mass += m;
+		for (int k = 0; k < 3; k++) {
+			sum.position[k] += m * p[k];
+			sum.momentum[k] += m * v[k];
+		}
+		if (data->weights[i] > data->weights[sum.heaviest])
+			sum.heaviest = i;
+	}
+
+	// the merged bodies take the place of their heaviest members
+	for (size_t s = 0; s < clusters.size(); s++) {
+		const ClusterSum& sum = clusters[s];
+		int i = sum.heaviest;
+		double p[3], v[3];
+		if (sum.mass > 0) {
+			for (int k = 0; k < 3; k++) {
+				p[k] = sum.position[k] / sum.mass;
+				v[k] = sum.momentum[k] / sum.mass;
+			}
+		}
+		else {
+			// massless particles: the state of the kept one
+			particleState64(data, i, p, v);
+		}
+		data->weights[i] = (float)sum.mass;
+		data->positions[i].x = (float)p[0]; data->positions[i].y = (float)p[1]; data->positions[i].z = (float)p[2];
+		data->velocities[i].x = (float)v[0]; data->velocities[i].y = (float)v[1]; data->velocities[i].z = (float)v[2];
+		if (data->positions64) {
+			data->positions64[i].x = p[0]; data->positions64[i].y = p[1]; data->positions64[i].z = p[2];
+			data->velocities64[i].x = v[0]; data->velocities64[i].y = v[1]; data->velocities64[i].z = v[2];
+		}
+		if (data->positionErrors) {
+			data->positionErrors[i].x = data->positionErrors[i].y = data->positionErrors[i].z = 0.0f;
+			data->velocityErrors[i].x = data->velocityErrors[i].y = data->velocityErrors[i].z = 0.0f;
+		}
+	}
+
+	// new index of every particle: its own if it is kept, the one of its merged body if not
+	grid.target.resize(nbodies);
+	int n = 0;
+	for (int i = 0; i < nbodies; i++) {
+		int s = grid.slot[grid.parent[i]];
+		if (s < 0 || clusters[s].heaviest == i)
+			grid.target[i] = n++;
+	}
+	for (int i = 0; i < nbodies; i++) {
+		int s = grid.slot[grid.parent[i]];
+		if (s >= 0 && clusters[s].heaviest != i)
+			grid.target[i] = grid.target[clusters[s].heaviest];
+	}
+	mergeBlockTimesteps(data, grid.target.data(), n);
+
+	// a merged body pulls if one of its members did; the members of a cluster are not adjacent, the list
+	// is rebuilt in order of the new indices
+	if (data->sources) {
+		grid.pulls.assign(n, 0);
+		for (int k = 0; k < data->nsources; k++)
+			grid.pulls[grid.target[data->sources[k]]] = 1;
+		int nsources = 0;
+		for (int i = 0; i < n; i++) {
+			if (grid.pulls[i])
+				data->sources[nsources++] = i;
+		}
+		data->nsources = nsources;
+	}
+
+	// compaction in place, the particles keep their order
+	for (int i = 0; i < nbodies; i++) {
+		int k = grid.target[i];
+		int s = grid.slot[grid.parent[i]];
+		if (k == i || (s >= 0 && clusters[s].heaviest != i))
+			continue;
+		data->positions[k] = data->positions[i];
+		data->velocities[k] = data->velocities[i];
+		data->weights[k] = data->weights[i];
+		if (data->positions64) {
+			data->positions64[k] = data->positions64[i];
+			data->velocities64[k] = data->velocities64[i];
+		}
+		if (data->positionErrors) {
+			data->positionErrors[k] = data->positionErrors[i];
+			data->velocityErrors[k] = data->velocityErrors[i];
+		}
+		if (data->origins)
+			data->origins[k] = data->origins[i];
+	}
+
+	*removed = nbodies - n;
+	data->nbodies = n;
+	// masses and positions changed: the forces are computed again, the device copy is stale
+	data->forcesSource = FORCES_NONE;
+	data->stateLocation = STATE_ON_HOST;
+	return 0;
+}
\ No newline at end of file
@@ -0,0 +1,441 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <math.h>
+#include "octree.h"
+
+// Fast multipole method with Cartesian Taylor expansions (as in Dehnen's falcON).
+// Every cell of the octree gets the multipole moments of its bodies about its center of mass. Two cells A, B
+// interact through the moments of B expanded into the local expansion of A (M2L) once they are well separated:
+// |com_A - com_B| * theta > r_A + r_B, r - the largest distance of a body of the cell from its center of mass.
+// Pairs of leaves that never get there are summed directly, bodies then take the local expansion of their leaf
+// (passed down the tree, L2L) at their position. The cost is O(N) for a given order and theta.
+//
+// The expansions are of the softened kernel 1 / sqrt(r^2 + softeningSquared) itself, not of 1 / r (derivatives
+// by the McMurchie-Davidson recurrence), so the far and near fields are the same softened gravity as the direct
+// sum. Expansions are of degree data->fmmOrder in double, the force error falls as ~ theta^fmmOrder;
+// theta = 0 never accepts a pair and gives the direct sum. Like Barnes-Hut, the tree works on the float32
+// positions whatever data->precision is.
+//
+// With data->sources the field is that of the bodies that pull: their own tree gives the multipoles, the tree
+// of all bodies the locals (a pair is a target cell of the one and a source cell of the other).
+
+#define FMM_LEAF_CAPACITY 32		// bodies kept in a leaf before it is split
+#define MAX_FMM_TERMS ((MAX_FMM_ORDER + 1) * (MAX_FMM_ORDER + 2) * (MAX_FMM_ORDER + 3) / 6)
+
+// A term of a shift (M2M, L2L): expansion[big] and expansion[small] are related by offset^difference / difference!
+struct FmmShift {
+	int big, small, difference;
+};
+
+// A term of M2L: local[local] += sign * multipole[multipole] * derivative[derivative]
+struct FmmInteraction {
+	int local, multipole, derivative;
+	double sign;
+};
+
+// Index tables of the expansions of one order. Terms (multi-indices) are ordered by degree,
+// a term is reached from lower[term] = term - e_axis by the recurrences
+struct FmmTables {
+	int order;
+	int nterms;
+	std::vector<int> powers;		// 3 per term
+	std::vector<int> degree;
+	std::vector<int> axis;			// first axis with a nonzero power
+	std::vector<int> lower;			// term - e_axis
+	std::vector<int> lower2;		// term - 2 e_axis, -1 if the power of axis is 1
+	std::vector<int> raise;			// 3 per term: term + e_i, -1 above the order
+	std::vector<FmmShift> shifts;
+	std::vector<FmmInteraction> interactions;
+};
+
+struct FmmTree {
+	Octree octree;						// every body: the targets, and the sources if every body pulls
+	Octree sourceOctree;				// data->sources only
+	const Octree* sources;				// octree or sourceOctree
+	FmmTables tables;
+	std::vector<double> multipoles;		// nterms per node of sources, about the center of mass of the node
+	std::vector<double> locals;			// nterms per node of octree, about the center of mass of the node
+	std::vector<double> radii;			// per node of octree
+	std::vector<double> sourceOctreeRadii;
+	const double* sourceRadii;			// per node of sources: radii or sourceOctreeRadii
+	std::vector<float3> accelerations;	// per body
+	std::vector<double> potentials;
+	std::vector<int> targets;			// cells whose interactions are computed in parallel
+};
+
+static void buildTables(FmmTables& t, int order) {
+	t.order = order;
+	int side = order + 1;
+	std::vector<int> index(side * side * side, -1);
+	t.powers.clear();
+	t.degree.clear();
+	for (int n = 0; n <= order; n++) {
+		for (int a = n; a >= 0; a--) {
+			for (int b = n - a; b >= 0; b--) {
+				int c = n - a - b;
+				index[(a * side + b) * side + c] = (int)t.degree.size();
+				t.powers.push_back(a);
+				t.powers.push_back(b);
+				t.powers.push_back(c);
+				t.degree.push_back(n);
+			}
+		}
+	}
+	t.nterms = (int)t.degree.size();
+
+	t.axis.assign(t.nterms, 0);
+	t.lower.assign(t.nterms, -1);
+	t.lower2.assign(t.nterms, -1);
+	t.raise.assign(3 * t.nterms, -1);
+	for (int k = 0; k < t.nterms; k++) {
+		const int* p = &t.powers[3 * k];
+		for (int i = 0; i < 3; i++) {
+			int q[3] = { p[0], p[1], p[2] };
+			q[i]++;
+			if (t.degree[k] < order)
+				t.raise[3 * k + i] = index[(q[0] * side + q[1]) * side + q[2]];
+		}
+		if (k == 0)
+			continue;
+		int i = p[0] ? 0 : (p[1] ? 1 : 2);
+		int q[3] = { p[0], p[1], p[2] };
+		q[i]--;
+		t.axis[k] = i;
+		t.lower[k] = index[(q[0] * side + q[1]) * side + q[2]];
+		if (q[i] > 0) {
+			q[i]--;
+			t.lower2[k] = index[(q[0] * side + q[1]) * side + q[2]];
+		}
+	}
+
+	t.shifts.clear();
+	t.interactions.clear();
+	for (int big = 0; big < t.nterms; big++) {
+		const int* p = &t.powers[3 * big];
+		for (int small = 0; small < t.nterms; small++) {
+			const int* q = &t.powers[3 * small];
+			if (q[0] <= p[0] && q[1] <= p[1] && q[2] <= p[2]) {
+				FmmShift shift = { big, small, index[((p[0] - q[0]) * side + p[1] - q[1]) * side + p[2] - q[2]] };
+				t.shifts.push_back(shift);
+			}
+			if (t.degree[big] + t.degree[small] <= order) {
+				FmmInteraction interaction = { big, small, index[((p[0] + q[0]) * side + p[1] + q[1]) * side + p[2] + q[2]],
+					t.degree[small] % 2 ? -1.0 : 1.0 };
+				t.interactions.push_back(interaction);
+			}
+		}
+	}
+}
+
+// d^term / term! of every term
+static inline void monomials(const FmmTables& t, const double* d, double* out) {
+	out[0] = 1.0;
+	for (int k = 1; k < t.nterms; k++) {
+		int i = t.axis[k];
+		out[k] = out[t.lower[k]] * d[i] / t.powers[3 * k + i];
+	}
+}
+
+// Derivatives d^term K(r) of the softened kernel K(r) = (r^2 + softeningSquared)^(-1/2).
+// K is f(s) of s = r^2 / 2 with f^(m)(s) = (-1)^m (2m - 1)!! (r^2 + softeningSquared)^-(m + 1/2), and
+// d^term f^(m) = r_i d^(term - e_i) f^(m+1) + (power_i - 1) d^(term - 2 e_i) f^(m+1) (McMurchie-Davidson)
+static inline void kernelDerivatives(const FmmTables& t, const double* r, double* out) {
+	double aux[(MAX_FMM_ORDER + 1) * MAX_FMM_TERMS];
+	const int nterms = t.nterms;
+	double inverse = 1.0 / (r[0] * r[0] + r[1] * r[1] + r[2] * r[2] + softeningSquared);
+	double f = sqrt(inverse);
+	for (int m = 0; m <= t.order; m++) {
+		aux[m * nterms] = f;
+		f *= -(2 * m + 1) * inverse;
+	}
+	for (int k = 1; k < nterms; k++) {
+		int i = t.axis[k];
+		for (int m = 0; m <= t.order - t.degree[k]; m++) {
+			double value = r[i] * aux[(m + 1) * nterms + t.lower[k]];
+			if (t.lower2[k] >= 0)
+				value += (t.powers[3 * k + i] - 1) * aux[(m + 1) * nterms + t.lower2[k]];
+			aux[m * nterms + k] = value;
+		}
+	}
+	for (int k = 0; k < nterms; k++)
+		out[k] = aux[k];
+}
+
+static inline void offset(double* out, float3 to, float3 from) {
+	out[0] = (double)to.x - from.x;
+	out[1] = (double)to.y - from.y;
+	out[2] = (double)to.z - from.z;
+}
+
+// P2M of the leaves, then M2M and the radii from the children up to the root.
+// multipoles == NULL - only the radii (a tree of targets only)
+static void upwardPass(const FmmTables& t, const Octree& tree, double* multipoles, double* radii, const float3* positions, const float* weights, int nthreads) {
+	const int nnodes = (int)tree.nodes.size();
+	const int nterms = t.nterms;
+
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(nthreads) schedule(dynamic, 16)
+#endif
+	for (int n = 0; n < nnodes; n++) {
+		const OctreeNode& node = tree.nodes[n];
+		if (node.firstChild >= 0)
+			continue;
+		double mono[MAX_FMM_TERMS], d[3];
+		double radius = 0.0;
+		for (int k = node.begin; k < node.end; k++) {
+			int ind = tree.order[k];
+			offset(d, positions[ind], node.com);
+			if (multipoles) {
+				double* multipole = &multipoles[n * nterms];
+				monomials(t, d, mono);
+				for (int j = 0; j < nterms; j++)
+					multipole[j] += weights[ind] * mono[j];
+			}
+			radius = fmax(radius, sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2]));
+		}
+		radii[n] = radius;
+	}
+
+	double mono[MAX_FMM_TERMS], d[3];
+	for (int n = nnodes - 1; n >= 0; n--) {
+		const OctreeNode& node = tree.nodes[n];
+		if (node.firstChild < 0)
+			continue;
+		double radius = 0.0;
+		for (int c = node.firstChild; c < node.firstChild + 8; c++) {
+			const OctreeNode& child = tree.nodes[c];
+			if (child.end == child.begin)
+				continue;
+			offset(d, child.com, node.com);
+			if (multipoles) {
+				double* multipole = &multipoles[n * nterms];
+				const double* childMultipole = &multipoles[c * nterms];
+				monomials(t, d, mono);
+				for (size_t s = 0; s < t.shifts.size(); s++) {
+					const FmmShift& shift = t.shifts[s];
+					multipole[shift.big] += childMultipole[shift.small] * mono[shift.difference];
+				}
+			}
+			radius = fmax(radius, sqrt(d[0] * d[0] + d[1] * d[1] + d[2] * d[2]) + radii[c]);
+		}
+		// the bodies are inside the cube as well: its farthest corner is often the tighter bound
+		offset(d, node.com, node.center);
+		double corner = 0.0;
+		for (int i = 0; i < 3; i++)
+			corner += (fabs(d[i]) + node.halfSize) * (fabs(d[i]) + node.halfSize);
+		radii[n] = fmin(radius, sqrt(corner));
+	}
+}
+
+static void multipoleToLocal(FmmTree& fmm, int target, int source) {
+	const FmmTables& t = fmm.tables;
+	double derivatives[MAX_FMM_TERMS], r[3];
+	offset(r, fmm.octree.nodes[target].com, fmm.sources->nodes[source].com);
+	kernelDerivatives(t, r, derivatives);
+	double* local = &fmm.locals[target * t.nterms];
+	const double* multipole = &fmm.multipoles[source * t.nterms];
+	for (size_t k = 0; k < t.interactions.size(); k++) {
+		const FmmInteraction& term = t.interactions[k];
+		local[term.local] += term.sign * multipole[term.multipole] * derivatives[term.derivative];
+	}
+}
+
+static void particleToParticle(FmmTree& fmm, const OctreeNode& target, const OctreeNode& source, const float3* positions, const float* weights) {
+	const int* order = fmm.octree.order.data();
+	const int* sourceOrder = fmm.sources->order.data();
+	for (int a = target.begin; a < target.end; a++) {
+		int i = order[a];
+		float3 pos = positions[i];
+		float3 acc = fmm.accelerations[i];
+		double phi = fmm.potentials[i];
+		for (int b = source.begin; b < source.end; b++) {
+			int j = sourceOrder[b];
+			if (j == i)
+				continue;
+			addPointMassAcceleration(&acc, pos, positions[j], weights[j], &phi);
+		}
+		fmm.accelerations[i] = acc;
+		fmm.potentials[i] = phi;
+	}
+}
+
+// Field of the bodies of source on the bodies of target, both cells split until the pairs are well separated
+static void interact(FmmTree& fmm, int target, int source, double theta, const float3* positions, const float* weights) {
+	const OctreeNode& t = fmm.octree.nodes[target];
+	const OctreeNode& s = fmm.sources->nodes[source];
+	if (t.end == t.begin || s.mass == 0.0f)
+		return;
+
+	double r[3];
+	offset(r, t.com, s.com);
+	double distance = sqrt(r[0] * r[0] + r[1] * r[1] + r[2] * r[2]);
+	if (theta * distance > fmm.radii[target] + fmm.sourceRadii[source]) {
+		multipoleToLocal(fmm, target, source);
+		return;
+	}
+
+	bool targetLeaf = t.firstChild < 0, sourceLeaf = s.firstChild < 0;
+	if (targetLeaf && sourceLeaf) {
+		particleToParticle(fmm, t, s, positions, weights);
+	}
+	else if (sourceLeaf || (!targetLeaf && fmm.radii[target] >= fmm.sourceRadii[source])) {
+		for (int c = t.firstChild; c < t.firstChild + 8; c++)
+			interact(fmm, c, source, theta, positions, weights);
+	}
+	else {
+		for (int c = s.firstChild; c < s.firstChild + 8; c++)
+			interact(fmm, target, c, theta, positions, weights);
+	}
+}
+
+// L2L down to the leaves of node, then L2P of their bodies
+static void downwardPass(FmmTree& fmm, int n, const float3* positions) {
+	const FmmTables& t = fmm.tables;
+	const OctreeNode& node = fmm.octree.nodes[n];
+	const double* local = &fmm.locals[n * t.nterms];
+	double mono[MAX_FMM_TERMS], d[3];
+
+	if (node.firstChild >= 0) {
+		for (int c = node.firstChild; c < node.firstChild + 8; c++) {
+			const OctreeNode& child = fmm.octree.nodes[c];
+			if (child.end == child.begin)
+				continue;
+			offset(d, child.com, node.com);
+			monomials(t, d, mono);
+			double* childLocal = &fmm.locals[c * t.nterms];
+			for (size_t s = 0; s < t.shifts.size(); s++) {
+				const FmmShift& shift = t.shifts[s];
+				childLocal[shift.small] += local[shift.big] * mono[shift.difference];
+			}
+			downwardPass(fmm, c, positions);
+		}
+		return;
+	}
+
+	for (int k = node.begin; k < node.end; k++) {
+		int ind = fmm.octree.order[k];
+		offset(d, positions[ind], node.com);
+		monomials(t, d, mono);
+		double phi = 0.0, acc[3] = { 0.0, 0.0, 0.0 };
+		for (int j = 0; j < t.nterms; j++) {
+			phi += local[j] * mono[j];
+			for (int i = 0; i < 3; i++) {
+				int raised = t.raise[3 * j + i];
+				if (raised >= 0)
+					acc[i] += local[raised] * mono[j];
+			}
+		}
+		fmm.accelerations[ind].x += (float)(G * acc[0]);
+		fmm.accelerations[ind].y += (float)(G * acc[1]);
+		fmm.accelerations[ind].z += (float)(G * acc[2]);
+		fmm.potentials[ind] -= G * phi;
+	}
+}
+
+// Cells whose interactions are independent: the tree cut where there are enough of them for all threads
+static void collectTargets(FmmTree& fmm, int nthreads) {
+	const Octree& tree = fmm.octree;
+	fmm.targets.assign(1, 0);
+	bool split = true;
+	while (split && (int)fmm.targets.size() < 16 * nthreads) {
+		std::vector<int> next;
+		split = false;
+		for (size_t k = 0; k < fmm.targets.size(); k++) {
+			const OctreeNode& node = tree.nodes[fmm.targets[k]];
+			if (node.firstChild < 0) {
+				next.push_back(fmm.targets[k]);
+				continue;
+			}
+			split = true;
+			for (int c = node.firstChild; c < node.firstChild + 8; c++)
+				if (tree.nodes[c].end > tree.nodes[c].begin)
+					next.push_back(c);
+		}
+		fmm.targets.swap(next);
+	}
+}
+
+// The tree is kept between steps so that its buffers are only reallocated when they have to grow
+static FmmTree* simulationFmmTree(SimulationData* data) {
+	if (!data->fmmTree)
+		data->fmmTree = new FmmTree();
+	FmmTree* fmm = (FmmTree*)data->fmmTree;
+	if (fmm->tables.nterms == 0 || fmm->tables.order != data->fmmOrder)
+		buildTables(fmm->tables, data->fmmOrder);
+	return fmm;
+}
+
+void releaseFmmTree(SimulationData* data) {
+	delete (FmmTree*)data->fmmTree;
+	data->fmmTree = NULL;
+}
+
+// Every force pass computes the field at all bodies, for a block time step too: acc gets the active ones
+int computeActiveAccelerationsFmm(SimulationData* data, const int* active, int nactive, float3* acc) {
+	if (data->theta < 0 || data->fmmOrder < MIN_FMM_ORDER || data->fmmOrder > MAX_FMM_ORDER || syncSimulationToHost(data))
+		return 1;
+
+	FmmTree& fmm = *simulationFmmTree(data);
+	const float3* positions = data->positions;
+	const float* weights = data->weights;
+	const int nbodies = data->nbodies;
+	int nthreads = 1;
+#ifdef _OPENMP
+	nthreads = simulationThreads(data);
+#endif
+
+	buildOctree(fmm.octree, positions, weights, nbodies, FMM_LEAF_CAPACITY);
+	fmm.sources = &fmm.octree;
+	if (data->sources) {
+		buildOctree(fmm.sourceOctree, positions, weights, data->nsources, FMM_LEAF_CAPACITY, data->sources);
+		fmm.sources = &fmm.sourceOctree;
+	}
+	const int nterms = fmm.tables.nterms;
+	fmm.multipoles.assign(fmm.sources->nodes.size() * nterms, 0.0);
+	fmm.locals.assign(fmm.octree.nodes.size() * nterms, 0.0);
+	fmm.radii.assign(fmm.octree.nodes.size(), 0.0);
+	fmm.sourceOctreeRadii.assign(data->sources ? fmm.sourceOctree.nodes.size() : 0, 0.0);
+	fmm.sourceRadii = data->sources ? fmm.sourceOctreeRadii.data() : fmm.radii.data();
+	float3 zero = { 0.0f, 0.0f, 0.0f };
+	fmm.accelerations.assign(nbodies, zero);
+	fmm.potentials.assign(nbodies, 0.0);
+	if (nbodies == 0)
+		return 0;
+
+	if (data->sources) {
+		upwardPass(fmm.tables, fmm.sourceOctree, fmm.multipoles.data(), fmm.sourceOctreeRadii.data(), positions, weights, nthreads);
+		upwardPass(fmm.tables, fmm.octree, NULL, fmm.radii.data(), positions, weights, nthreads);
+	}
+	else {
+		upwardPass(fmm.tables, fmm.octree, fmm.multipoles.data(), fmm.radii.data(), positions, weights, nthreads);
+	}
+	collectTargets(fmm, nthreads);
+	const int ntargets = (int)fmm.targets.size();
+	const double theta = data->theta;
+	const bool pulled = !fmm.sources->nodes.empty();
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(nthreads) schedule(dynamic, 1)
+#endif
+	for (int k = 0; k < ntargets; k++) {
+		if (pulled)
+			interact(fmm, fmm.targets[k], 0, theta, positions, weights);
+		downwardPass(fmm, fmm.targets[k], positions);
+	}
+
+	float* potentials = data->potentials;
+	for (int k = 0; k < nactive; k++) {
+		int i = active ? active[k] : k;
+		acc[k] = fmm.accelerations[i];
+		if (potentials)
+			potentials[i] = (float)fmm.potentials[i];
+	}
+	return 0;
+}
+
+int computeAccelerationsFmm(SimulationData* data, float3* acc) {
+	return computeActiveAccelerationsFmm(data, NULL, data->nbodies, acc);
+}
+
+int updateSimulationFmm(SimulationData* data, float timeStep) {
+	return stepSimulationHost(data, timeStep, computeActiveAccelerationsFmm, FORCES_FMM);
+}
\ No newline at end of file
@@ -0,0 +1,147 @@
+#pragma once
+#include <vector>
+#include "particle_update.h"
+
+// Octree of the host tree solvers (barnes_hut.cpp, fmm.cpp), rebuilt from scratch for every force pass.
+// Children are always appended after their parent: iterating the nodes backwards visits every child
+// before its parent (upward passes), forwards every parent before its children (downward passes).
+
+#define MAX_TREE_DEPTH 32		// coincident bodies stop splitting here
+
+struct OctreeNode {
+	float3 center;		// geometric center of the cube
+	float halfSize;
+	float3 com;			// center of mass
+	float mass;
+	int firstChild;		// index of the first of 8 consecutive children, -1 for a leaf
+	int begin, end;		// bodies of the node: order[begin:end]
+};
+
+struct Octree {
+	std::vector<OctreeNode> nodes;
+	std::vector<int> order;		// body indices grouped by node
+	std::vector<int> scratch;
+};
+
+static inline int octantOf(float3 pos, float3 center) {
+	return (pos.x >= center.x ? 1 : 0) | (pos.y >= center.y ? 2 : 0) | (pos.z >= center.z ? 4 : 0);
+}
+
+static inline void summarizeLeaf(OctreeNode& node, const float3* positions, const float* weights, const int* order) {
+	double mass = 0, x = 0, y = 0, z = 0;
+	for (int k = node.begin; k < node.end; k++) {
+		int ind = order[k];
+		mass += weights[ind];
+		x += (double)weights[ind] * positions[ind].x;
+		y += (double)weights[ind] * positions[ind].y;
+		z += (double)weights[ind] * positions[ind].z;
+	}
+	node.mass = (float)mass;
+	if (mass > 0) {
+		node.com.x = (float)(x / mass);
+		node.com.y = (float)(y / mass);
+		node.com.z = (float)(z / mass);
+	}
+	else {
+		node.com = node.center;
+	}
+}
+
+static inline void buildNode(Octree& tree, int nodeInd, const float3* positions, const float* weights, int leafCapacity, int depth) {
+	OctreeNode node = tree.nodes[nodeInd];
+	int count = node.end - node.begin;
+
+	if (count <= leafCapacity || depth >= MAX_TREE_DEPTH) {
+		summarizeLeaf(node, positions, weights, tree.order.data());
+		tree.nodes[nodeInd] = node;
+		return;
+	}
+
+	// counting sort of the node bodies by octant
+	int counts[8] = { 0 };
+	for (int k = node.begin; k < node.end; k++)
+		counts[octantOf(positions[tree.order[k]], node.center)]++;
+
+	int offsets[8];
+	int offset = node.begin;
+	for (int c = 0; c < 8; c++) {
+		offsets[c] = offset;
+		offset += counts[c];
+	}
+	for (int k = node.begin; k < node.end; k++) {
+		int ind = tree.order[k];
+		tree.scratch[offsets[octantOf(positions[ind], node.center)]++] = ind;
+	}
+	for (int k = node.begin; k < node.end; k++)
+		tree.order[k] = tree.scratch[k];
+
+	node.firstChild = (int)tree.nodes.size();
+	float quarter = node.halfSize * 0.5f;
+	int begin = node.begin;
+	for (int c = 0; c < 8; c++) {
+		OctreeNode child;
+		child.center.x = node.center.x + ((c & 1) ? quarter : -quarter);
+		child.center.y = node.center.y + ((c & 2) ? quarter : -quarter);
+		child.center.z = node.center.z + ((c & 4) ? quarter : -quarter);
+		child.halfSize = quarter;
+		child.firstChild = -1;
+		child.begin = begin;
+		child.end = begin + counts[c];
+		child.mass = 0.0f;
+		child.com = child.center;
+		begin = child.end;
+		tree.nodes.push_back(child);
+	}
+
+	double mass = 0, x = 0, y = 0, z = 0;
+	for (int c = 0; c < 8; c++) {
+		int childInd = node.firstChild + c;
+		if (tree.nodes[childInd].end > tree.nodes[childInd].begin)
+			buildNode(tree, childInd, positions, weights, leafCapacity, depth + 1);
+		const OctreeNode& child = tree.nodes[childInd];
+		mass += child.mass;
+		x += (double)child.mass * child.com.x;
+		y += (double)child.mass * child.com.y;
+		z += (double)child.mass * child.com.z;
+	}
+	node.mass = (float)mass;
+	if (mass > 0) {
+		node.com.x = (float)(x / mass);
+		node.com.y = (float)(y / mass);
+		node.com.z = (float)(z / mass);
+	}
+	tree.nodes[nodeInd] = node;
+}
+
+// Splits the cells holding more than leafCapacity bodies. The tree holds bodies[0..nbodies) if bodies is given
+// (order keeps their indices into positions), bodies 0..nbodies - 1 otherwise
+static inline void buildOctree(Octree& tree, const float3* positions, const float* weights, int nbodies, int leafCapacity, const int* bodies = NULL) {
+	tree.nodes.clear();
+	tree.order.resize(nbodies);
+	tree.scratch.resize(nbodies);
+	if (nbodies == 0)
+		return;
+
+	float3 lo = positions[bodies ? bodies[0] : 0], hi = lo;
+	for (int i = 0; i < nbodies; i++) {
+		tree.order[i] = bodies ? bodies[i] : i;
+		float3 p = positions[tree.order[i]];
+		lo.x = fminf(lo.x, p.x); hi.x = fmaxf(hi.x, p.x);
+		lo.y = fminf(lo.y, p.y); hi.y = fmaxf(hi.y, p.y);
+		lo.z = fminf(lo.z, p.z); hi.z = fmaxf(hi.z, p.z);
+	}
+
+	OctreeNode root;
+	root.center.x = 0.5f * (lo.x + hi.x);
+	root.center.y = 0.5f * (lo.y + hi.y);
+	root.center.z = 0.5f * (lo.z + hi.z);
+	root.halfSize = 0.5f * fmaxf(fmaxf(hi.x - lo.x, hi.y - lo.y), hi.z - lo.z) * 1.0001f + 1e-6f;
+	root.firstChild = -1;
+	root.begin = 0;
+	root.end = nbodies;
+	root.mass = 0.0f;
+	root.com = root.center;
+	tree.nodes.push_back(root);
+
+	buildNode(tree, 0, positions, weights, leafCapacity, 0);
+}
\ No newline at end of file
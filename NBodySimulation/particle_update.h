@@ -0,0 +1,271 @@
+#pragma once
+#include <math.h>
+#include "simulator.h"
+
+#ifdef __CUDACC__
+#define HOST_DEVICE __host__ __device__
+#else
+#define HOST_DEVICE
+#endif
+
+#define softeningSquared 0.01f		// original plumer softener is 0.025. here the value is square of it.
+#define damping 1.0f				// 0.999f
+#define G 1
+//6.67418478E-11
+
+// Softened pull of a point mass `weight` located at r on a body located at p.
+// If potential is not NULL the softened potential -G * weight / dist is added to it as well
+static inline HOST_DEVICE void addPointMassAcceleration(float3* acc, float3 p, float3 r, float weight, double* potential = NULL) {
+	double dx, dy, dz;
+	float distSqr;
+
+	dx = p.x - r.x;
+	dy = p.y - r.y;
+	dz = p.z - r.z;
+
+	distSqr = (dx * dx + dy * dy + dz * dz + softeningSquared);
+
+	float dist = sqrtf(distSqr);
+	float magi = (G * weight) / (dist * dist * dist);
+	acc->x -= magi * dx;
+	acc->y -= magi * dy;
+	acc->z -= magi * dz;
+	if (potential)
+		*potential -= (G * weight) / dist;		// summed in double: a light body adds little to the sum of a heavy one
+}
+
+// Direct-sum gravity acting on particle particleInd: naive big loop.
+// The potential at the particle is stored to *potential if it is not NULL.
+// The pulling bodies are sources[0..nbodies) if sources is given (SimulationData::sources), 0..nbodies - 1 otherwise
+static inline HOST_DEVICE float3 accelerationOnParticle(int particleInd, const float3* positions, const float* weights, int nbodies, float* potential = NULL, const int* sources = NULL) {
+	float3 pos = positions[particleInd];
+	float3 acc = { 0.0f, 0.0f, 0.0f };
+	double phi = 0.0;
+
+	for (int k = 0; k < nbodies; k++)
+	{
+		int i = sources ? sources[k] : k;
+		if (i == particleInd)
+			continue;
+		addPointMassAcceleration(&acc, pos, positions[i], weights[i], potential ? &phi : NULL);
+	}
+	if (potential)
+		*potential = (float)phi;
+	return acc;
+}
+
+// Threads per block of the CUDA kernels; the force kernel stages j-bodies through shared memory in tiles of this size
+#define FORCE_BLOCK_SIZE 256
+
+// Blocks of blockSize threads covering nbodies particles (at least one block, a launch of none is an error)
+static inline HOST_DEVICE int forceGridSize(int nbodies, int blockSize) {
+	int blocks = (nbodies + blockSize - 1) / blockSize;
+	return blocks > 0 ? blocks : 1;
+}
+
+// Place of particle particleInd among the pulling bodies: its index in sources (-1 if it is a test particle),
+// particleInd itself if there are no sources
+static inline HOST_DEVICE int sourceSlot(int particleInd, const int* sources, int nsources) {
+	if (!sources)
+		return particleInd;
+	int lo = 0, hi = nsources;
+	while (lo < hi) {
+		int mid = (lo + hi) / 2;
+		if (sources[mid] < particleInd)
+			lo = mid + 1;
+		else
+			hi = mid;
+	}
+	return lo < nsources && sources[lo] == particleInd ? lo : -1;
+}
+
+// Pull of a tile of j-bodies (xyz and weight in w) on a body located at pos, tile[0] is j-body tileStart and
+// j-body self (see sourceSlot) is the body itself. Bodies are added in the order of their indices like in
+// accelerationOnParticle, so summing the tiles in order gives the same float result. Shared by the CUDA kernel
+// (tile in shared memory) and computeAccelerationsTiled
+static inline HOST_DEVICE void accumulateTile(float3* acc, float3 pos, int self, const float4* tile, int tileStart, int tileCount) {
+	for (int k = 0; k < tileCount; k++) {
+		if (tileStart + k == self)
+			continue;
+		float3 r = { tile[k].x, tile[k].y, tile[k].z };
+		addPointMassAcceleration(acc, pos, r, tile[k].w);
+	}
+}
+
+// Direct sum with dx and the sum kept in double, positions are float3 or double3 (see PRECISION_*)
+template <typename Vector>
+static inline HOST_DEVICE float3 accelerationOnParticle64(int particleInd, const Vector* positions, const float* weights, int nbodies, float* potential = NULL, const int* sources = NULL) {
+	double px = positions[particleInd].x, py = positions[particleInd].y, pz = positions[particleInd].z;
+	double ax = 0.0, ay = 0.0, az = 0.0, phi = 0.0;
+
+	for (int k = 0; k < nbodies; k++)
+	{
+		int i = sources ? sources[k] : k;
+		if (i == particleInd)
+			continue;
+		double dx = px - positions[i].x;
+		double dy = py - positions[i].y;
+		double dz = pz - positions[i].z;
+		double distSqr = dx * dx + dy * dy + dz * dz + softeningSquared;
+		double dist = sqrt(distSqr);
+		double magi = (G * (double)weights[i]) / (distSqr * dist);
+		ax -= magi * dx;
+		ay -= magi * dy;
+		az -= magi * dz;
+		if (potential)
+			phi -= (G * (double)weights[i]) / dist;
+	}
+	if (potential)
+		*potential = (float)phi;
+	float3 acc = { (float)ax, (float)ay, (float)az };
+	return acc;
+}
+
+// Kick (velocity by kick * acc) followed by drift (position by drift * new velocity).
+// kick = drift = step is the semi-implicit Euler step, every integrator is a sequence of these.
+// Shared by the CPU (simulator_cpu.cpp) and CUDA (simulator.cu) paths
+static inline HOST_DEVICE void updateSingleParticle(int particleInd, float3* positions, float3* velocities, const float3* accelerations, float kick, float drift) {
+	float3 acc = accelerations[particleInd];
+	float3 vel = velocities[particleInd];
+	float3 pos = positions[particleInd];
+
+	// update velocity with above acc
+	vel.x += acc.x * kick;
+	vel.y += acc.y * kick;
+	vel.z += acc.z * kick;
+
+	/*vel.x *= damping;
+	vel.y *= damping;
+	vel.z *= damping;*/
+
+	// update position
+	pos.x += vel.x * drift;
+	pos.y += vel.y * drift;
+	pos.z += vel.z * drift;
+
+	velocities[particleInd] = vel;
+	positions[particleInd] = pos;
+}
+
+// value += rate * step, the rounding error is kept in error and given back by the next addition
+static inline void compensatedAdd(float3* value, float3* error, float3 rate, float step) {
+	float y, t;
+	y = rate.x * step - error->x; t = value->x + y; error->x = (t - value->x) - y; value->x = t;
+	y = rate.y * step - error->y; t = value->y + y; error->y = (t - value->y) - y; value->y = t;
+	y = rate.z * step - error->z; t = value->z + y; error->z = (t - value->z) - y; value->z = t;
+}
+
+// updateSingleParticle in the precision of data->precision, the host paths step particles with it
+static inline void kickDriftParticleHost(SimulationData* data, int i, float kick, float drift) {
+	if (data->precision == PRECISION_KAHAN) {
+		if (kick != 0.0f)
+			compensatedAdd(&data->velocities[i], &data->velocityErrors[i], data->accelerations[i], kick);
+		if (drift != 0.0f)
+			compensatedAdd(&data->positions[i], &data->positionErrors[i], data->velocities[i], drift);
+	}
+	else if (data->precision == PRECISION_FLOAT64) {
+		float3 acc = data->accelerations[i];
+		double3 vel = data->velocities64[i];
+		double3 pos = data->positions64[i];
+		vel.x += acc.x * (double)kick;
+		vel.y += acc.y * (double)kick;
+		vel.z += acc.z * (double)kick;
+		pos.x += vel.x * drift;
+		pos.y += vel.y * drift;
+		pos.z += vel.z * drift;
+		data->velocities64[i] = vel;
+		data->positions64[i] = pos;
+		float3 vel32 = { (float)vel.x, (float)vel.y, (float)vel.z };
+		float3 pos32 = { (float)pos.x, (float)pos.y, (float)pos.z };
+		data->velocities[i] = vel32;
+		data->positions[i] = pos32;
+	}
+	else {
+		updateSingleParticle(i, data->positions, data->velocities, data->accelerations, kick, drift);
+	}
+}
+
+// Number of particles that pull: data->nsources if sources are given, all of them otherwise
+static inline int pullingBodies(const SimulationData* data) {
+	return data->sources ? data->nsources : data->nbodies;
+}
+
+// Direct-sum acceleration of particle i in the precision of data->precision, fills data->potentials[i] if it is given
+static inline float3 accelerationOnParticleHost(const SimulationData* data, int i) {
+	float* potential = data->potentials ? &data->potentials[i] : NULL;
+	const int n = pullingBodies(data);
+	if (data->precision == PRECISION_FLOAT64)
+		return accelerationOnParticle64(i, data->positions64, data->weights, n, potential, data->sources);
+	if (data->precision == PRECISION_KAHAN)
+		return accelerationOnParticle64(i, data->positions, data->weights, n, potential, data->sources);
+	return accelerationOnParticle(i, data->positions, data->weights, n, potential, data->sources);
+}
+
+// 0 if the buffers data->precision needs are given
+static inline int checkPrecision(const SimulationData* data) {
+	switch (data->precision) {
+	case PRECISION_FLOAT32:
+		return 0;
+	case PRECISION_KAHAN:
+		return data->positionErrors && data->velocityErrors ? 0 : 1;
+	case PRECISION_FLOAT64:
+		return data->positions64 && data->velocities64 ? 0 : 1;
+	}
+	return 1;
+}
+
+// A step is: kick[0], drift[0], forces, kick[1], drift[1], forces, ..., drift[stages - 1], forces, kick[stages]
+// (fractions of the time step). The forces of the end of a step are the ones its next step starts with,
+// so an integrator costs `stages` force evaluations per step.
+struct IntegratorScheme {
+	int stages;
+	float kicks[4];
+	float drifts[3];
+};
+
+#define YOSHIDA_W1 1.3512071919596578f		// 1 / (2 - 2^(1/3))
+#define YOSHIDA_W0 -1.7024143839193153f		// -2^(1/3) / (2 - 2^(1/3))
+
+static inline const IntegratorScheme* integratorScheme(int integrator) {
+	static const IntegratorScheme euler = { 1, { 1.0f, 0.0f }, { 1.0f } };
+	static const IntegratorScheme leapfrog = { 1, { 0.5f, 0.5f }, { 1.0f } };
+	static const IntegratorScheme yoshida4 = { 3,
+		{ 0.5f * YOSHIDA_W1, 0.5f * (YOSHIDA_W0 + YOSHIDA_W1), 0.5f * (YOSHIDA_W0 + YOSHIDA_W1), 0.5f * YOSHIDA_W1 },
+		{ YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1 } };
+
+	switch (integrator) {
+	case INTEGRATOR_EULER:
+		return &euler;
+	case INTEGRATOR_LEAPFROG:
+		return &leapfrog;
+	case INTEGRATOR_YOSHIDA4:
+		return &yoshida4;
+	}
+	return NULL;
+}
+
+// Library-internal helpers of the host side
+
+// Force pass of a backend: acc[k] receives the acceleration of particle active[k], active == NULL - all particles
+typedef int (*AccelerationFunction)(SimulationData* data, const int* active, int nactive, float3* acc);
+int computeActiveAccelerationsC(SimulationData* data, const int* active, int nactive, float3* acc);
+int computeActiveAccelerationsBarnesHut(SimulationData* data, const int* active, int nactive, float3* acc);
+int computeActiveAccelerationsFmm(SimulationData* data, const int* active, int nactive, float3* acc);
+int stepSimulationHost(SimulationData* data, float timeStep, AccelerationFunction computeAccelerations, int forcesSource);
+int stepBlockTimesteps(SimulationData* data, float timeStep, AccelerationFunction computeAccelerations, int forcesSource);
+void releaseSimulationCuda(SimulationData* data);
+void releaseBarnesHutTree(SimulationData* data);
+void releaseFmmTree(SimulationData* data);
+void releaseBlockTimesteps(SimulationData* data);
+void releaseCollisionGrid(SimulationData* data);
+// Levels of the particles left by mergeCollisions (called before data->nbodies changes): particle i went to
+// target[i] < remaining. Does nothing if no block time step was made with the current particles
+void mergeBlockTimesteps(SimulationData* data, const int* target, int remaining);
+
+#ifdef _OPENMP
+#include <omp.h>
+// Number of OpenMP threads requested for the CPU paths
+static inline int simulationThreads(const SimulationData* data) {
+	return data->nthreads > 0 ? data->nthreads : omp_get_max_threads();
+}
+#endif
\ No newline at end of file
@@ -2,14 +2,9 @@
 #include "device_launch_parameters.h"
 #include <device_functions.h>
 #include <stdio.h>
-#include "simulator.h"
+#include "particle_update.h"
 #include <stdlib.h>
 
-#define softeningSquared 0.01f		// original plumer softener is 0.025. here the value is square of it.
-#define damping 1.0f				// 0.999f
-#define G 1
-//6.67418478E-11
-
 
 //EXTERN_DLL_EXPORT
 //__host__ __device__ Particle updateSingleParticle(int particleInd, Particle* pdata, float step, int nbodies) {
@@ -59,70 +54,56 @@
 //	return p;
 //}
 
-EXTERN_DLL_EXPORT
-__host__ __device__ Particle updateSingleParticle(int particleInd, Particle* pdata, float step, int nbodies) {
-	Particle p = pdata[particleInd];
-
-	// update gravity (accumulation): naive big loop
-	float3 acc = { 0.0f, 0.0f, 0.0f };
-	float distSqr, distCube, s;
-
-	Particle r;
-	double dx, dy, dz;
-
-	for (int i = 0; i < nbodies; i++)
-	{
-		if (i == particleInd)
-			continue;
-		r = pdata[i];
+// Direct-sum forces, one thread per particle. The j-bodies go through shared memory in tiles of blockDim.x:
+// every thread loads one body of the tile, then every thread sums the whole tile (accumulateTile).
+// Positions are only read here, the result goes to a separate buffer. Launched with
+// blockDim.x * sizeof(float4) bytes of dynamic shared memory, see launchGalaxyKernel.
+// With sources (SimulationData::sources) only the nsources bodies listed there are staged
+__global__ void galaxyKernel(const float3* positions, const float* weights, float3* accelerations, int nbodies, const int* sources, int nsources)
+{
+	extern __shared__ float4 tile[];
 
-		dx = p.pos.x - r.pos.x;
-		dy = p.pos.y - r.pos.y;
-		dz = p.pos.z - r.pos.z;
+	// index for vertex (pos)
+	int x = blockIdx.x * blockDim.x + threadIdx.x;
 
-		distSqr = (dx * dx + dy * dy + dz * dz + softeningSquared);
+	// threads past the last particle still load their part of the tiles and reach the barriers
+	float3 pos = x < nbodies ? positions[x] : make_float3(0.0f, 0.0f, 0.0f);
+	float3 acc = { 0.0f, 0.0f, 0.0f };
+	int self = x < nbodies ? sourceSlot(x, sources, nsources) : -1;
 
-		float dist = sqrtf(distSqr);
-		float magi = (G * r.weight) / (dist * dist * dist);
-		acc.x -= magi * dx;
-		acc.y -= magi * dy;
-		acc.z -= magi * dz;
+	for (int tileStart = 0; tileStart < nsources; tileStart += blockDim.x) {
+		int k = tileStart + threadIdx.x;
+		if (k < nsources) {
+			int j = sources ? sources[k] : k;
+			float3 body = positions[j];
+			tile[threadIdx.x] = make_float4(body.x, body.y, body.z, weights[j]);
+		}
+		__syncthreads();
+		accumulateTile(&acc, pos, self, tile, tileStart, min((int)blockDim.x, nsources - tileStart));
+		// the tile is overwritten by the next iteration only when every thread is done with it
+		__syncthreads();
 	}
 
-	// update velocity with above acc
-	p.vel.x += acc.x * step;
-	p.vel.y += acc.y * step;
-	p.vel.z += acc.z * step;
-
-	/*p.vel.x *= damping;
-	p.vel.y *= damping;
-	p.vel.z *= damping;*/
-
-	// update position
-	p.pos.x += p.vel.x * step;
-	p.pos.y += p.vel.y * step;
-	p.pos.z += p.vel.z * step;
-
-	return p;
+	if (x < nbodies) {
+		accelerations[x] = acc;
+	}
 }
 
+static void launchGalaxyKernel(SimulationData* data) {
+	galaxyKernel <<<forceGridSize(data->nbodies, FORCE_BLOCK_SIZE), FORCE_BLOCK_SIZE, FORCE_BLOCK_SIZE * sizeof(float4) >>> (
+		data->devicePositions, data->deviceWeights, data->deviceAccelerations, data->nbodies,
+		data->sources ? data->deviceSources : NULL, pullingBodies(data));
+}
 
-__global__ void galaxyKernel(Particle* pdata, float step, int nbodies)
+__global__ void kickDriftKernel(float3* positions, float3* velocities, const float3* accelerations, float kick, float drift, int nbodies)
 {
-	// index for vertex (pos)
 	unsigned int x = blockIdx.x * blockDim.x + threadIdx.x;
 
 	if (x >= nbodies) {
 		return;
 	}
-	
-	Particle p = updateSingleParticle(x, pdata, step, nbodies);
-	
-	// thread synch
-	__syncthreads();
 
-	// update global memory with update value (position, velocity)
-	pdata[x] = p;
+	updateSingleParticle(x, positions, velocities, accelerations, kick, drift);
 }
 
 //__global__ void galaxyKernel(float4* pdata, float step, int nbodies)
@@ -186,65 +167,125 @@ __global__ void galaxyKernel(Particle* pdata, float step, int nbodies)
 //	pdata[y] = v;
 //}
 
-int updateSimulationCuda(SimulationData* data, float timeStep) {
+// Device buffers are allocated on the first CUDA step and kept until releaseSimulationData
+static cudaError_t allocateDeviceBuffers(SimulationData* data) {
 	cudaError_t cudaStatus;
+	size_t vectorsSize = data->nbodies * sizeof(float3);
 
 	cudaStatus = cudaSetDevice(0);
 	if (cudaStatus != cudaSuccess) {
 		fprintf(stderr, "cudaSetDevice failed!  Do you have a CUDA-capable GPU installed?");
-		goto Error;
+		return cudaStatus;
 	}
 
-
-	Particle* deviceParticleData;
-
-	cudaStatus = cudaMalloc((void**)&deviceParticleData, data->nbodies * sizeof(Particle));
+	cudaStatus = cudaMalloc((void**)&data->devicePositions, vectorsSize);
+	if (cudaStatus == cudaSuccess)
+		cudaStatus = cudaMalloc((void**)&data->deviceVelocities, vectorsSize);
+	if (cudaStatus == cudaSuccess)
+		cudaStatus = cudaMalloc((void**)&data->deviceAccelerations, vectorsSize);
+	if (cudaStatus == cudaSuccess)
+		cudaStatus = cudaMalloc((void**)&data->deviceWeights, data->nbodies * sizeof(float));
+	if (cudaStatus == cudaSuccess)
+		cudaStatus = cudaMalloc((void**)&data->deviceSources, data->nbodies * sizeof(int));
 	if (cudaStatus != cudaSuccess) {
 		fprintf(stderr, "cudaMalloc failed!");
-		goto Error;
+		releaseSimulationCuda(data);
 	}
+	return cudaStatus;
+}
 
-	cudaMemcpy(deviceParticleData, data->particleData, data->nbodies * sizeof(Particle), cudaMemcpyHostToDevice);
-	if (cudaStatus != cudaSuccess) {
-		fprintf(stderr, "cudaMemcopyHostToDevice failed!");
-		goto Error;
-	}
-	
-	galaxyKernel <<<256, 256 >>> (deviceParticleData, timeStep, data->nbodies);
-	cudaStatus = cudaGetLastError();
-	if (cudaStatus != cudaSuccess) {
-		fprintf(stderr, "galaxyKernel launch failed: %s\n", cudaGetErrorString(cudaStatus));
-		goto Error;
-	}
+void releaseSimulationCuda(SimulationData* data) {
+	if (data->stateLocation == STATE_ON_DEVICE)
+		syncSimulationToHost(data);
+	cudaFree(data->devicePositions);
+	cudaFree(data->deviceVelocities);
+	cudaFree(data->deviceWeights);
+	cudaFree(data->deviceAccelerations);
+	cudaFree(data->deviceSources);
+	data->devicePositions = NULL;
+	data->deviceVelocities = NULL;
+	data->deviceWeights = NULL;
+	data->deviceAccelerations = NULL;
+	data->deviceSources = NULL;
+}
 
-	// cudaDeviceSynchronize waits for the kernel to finish, and returns
-	// any errors encountered during the launch.
-	cudaStatus = cudaDeviceSynchronize();
-	if (cudaStatus != cudaSuccess) {
-		fprintf(stderr, "cudaDeviceSynchronize returned error code %d after launching addKernel!\n", cudaStatus);
-		goto Error;
-	}
+int syncSimulationToHost(SimulationData* data) {
+	if (data->stateLocation & STATE_ON_HOST)
+		return 0;
 
-	// Copy output vector from GPU buffer to host memory.
-	cudaStatus = cudaMemcpy(data->particleData, deviceParticleData, data->nbodies * sizeof(Particle), cudaMemcpyDeviceToHost);
+	size_t vectorsSize = data->nbodies * sizeof(float3);
+	cudaError_t cudaStatus = cudaMemcpy(data->positions, data->devicePositions, vectorsSize, cudaMemcpyDeviceToHost);
+	if (cudaStatus == cudaSuccess)
+		cudaStatus = cudaMemcpy(data->velocities, data->deviceVelocities, vectorsSize, cudaMemcpyDeviceToHost);
 	if (cudaStatus != cudaSuccess) {
 		fprintf(stderr, "cudaMemcpy failed!");
-		goto Error;
+		return 1;
 	}
-
-Error:
-	cudaFree(deviceParticleData);
-	return cudaStatus != cudaSuccess? 1: 0;
+	data->stateLocation |= STATE_ON_HOST;
+	return 0;
 }
 
-int updateSimulationC(SimulationData* data, float timeStep) {
-	Particle* particles = (Particle*)malloc(data->nbodies * sizeof(Particle));
-	if (!particles)
+int updateSimulationCuda(SimulationData* data, float timeStep) {
+	cudaError_t cudaStatus;
+	const IntegratorScheme* scheme = integratorScheme(data->integrator);
+	if (!scheme)
+		return 1;
+	if (data->timestepLevels > 0) {
+		fprintf(stderr, "Block time steps are only supported by the CPU paths\n");
+		return 1;
+	}
+	if (data->precision != PRECISION_FLOAT32) {
+		fprintf(stderr, "The CUDA path only supports PRECISION_FLOAT32\n");
+		return 1;
+	}
+
+	if (!data->devicePositions) {
+		cudaStatus = allocateDeviceBuffers(data);
+		if (cudaStatus != cudaSuccess)
+			return 1;
+	}
+
+	// the host copy is newer (first step or it was changed / stepped on the CPU)
+	if (!(data->stateLocation & STATE_ON_DEVICE)) {
+		size_t vectorsSize = data->nbodies * sizeof(float3);
+		cudaStatus = cudaMemcpy(data->devicePositions, data->positions, vectorsSize, cudaMemcpyHostToDevice);
+		if (cudaStatus == cudaSuccess)
+			cudaStatus = cudaMemcpy(data->deviceVelocities, data->velocities, vectorsSize, cudaMemcpyHostToDevice);
+		if (cudaStatus == cudaSuccess)
+			cudaStatus = cudaMemcpy(data->deviceWeights, data->weights, data->nbodies * sizeof(float), cudaMemcpyHostToDevice);
+		if (cudaStatus == cudaSuccess && data->sources)
+			cudaStatus = cudaMemcpy(data->deviceSources, data->sources, data->nsources * sizeof(int), cudaMemcpyHostToDevice);
+		if (cudaStatus != cudaSuccess) {
+			fprintf(stderr, "cudaMemcopyHostToDevice failed!");
+			return 1;
+		}
+		data->stateLocation |= STATE_ON_DEVICE;
+	}
+	
+	// same integrator steps as stepSimulationHost, on the device buffers
+	// the grid covers every particle, however many there are
+	const int blocks = forceGridSize(data->nbodies, FORCE_BLOCK_SIZE);
+	if (data->forcesSource != FORCES_DIRECT_DEVICE) {
+		launchGalaxyKernel(data);
+	}
+	for (int stage = 0; stage < scheme->stages; stage++) {
+		kickDriftKernel <<<blocks, FORCE_BLOCK_SIZE >>> (data->devicePositions, data->deviceVelocities, data->deviceAccelerations,
+			scheme->kicks[stage] * timeStep, scheme->drifts[stage] * timeStep, data->nbodies);
+		launchGalaxyKernel(data);
+	}
+	if (scheme->kicks[scheme->stages] != 0.0f) {
+		kickDriftKernel <<<blocks, FORCE_BLOCK_SIZE >>> (data->devicePositions, data->deviceVelocities, data->deviceAccelerations,
+			scheme->kicks[scheme->stages] * timeStep, 0.0f, data->nbodies);
+	}
+	cudaStatus = cudaGetLastError();
+	if (cudaStatus != cudaSuccess) {
+		fprintf(stderr, "galaxyKernel launch failed: %s\n", cudaGetErrorString(cudaStatus));
+		data->forcesSource = FORCES_NONE;
 		return 1;
-	for (int i = 0; i < data->nbodies; i++) {
-		particles[i] = updateSingleParticle(i, data->particleData, timeStep, data->nbodies);
 	}
-	free(data->particleData);
-	data->particleData = particles;
+
+	// the host copy is stale until syncSimulationToHost
+	data->forcesSource = FORCES_DIRECT_DEVICE;
+	data->stateLocation = STATE_ON_DEVICE;
 	return 0;
-}
\ No newline at end of file
+}
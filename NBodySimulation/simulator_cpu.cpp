@@ -0,0 +1,291 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <float.h>
+#include <math.h>
+#include "particle_update.h"
+
+int computeActiveAccelerationsC(SimulationData* data, const int* active, int nactive, float3* acc) {
+	if (checkPrecision(data) || syncSimulationToHost(data))
+		return 1;
+
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static)
+#endif
+	for (int k = 0; k < nactive; k++) {
+		acc[k] = accelerationOnParticleHost(data, active ? active[k] : k);
+	}
+	return 0;
+}
+
+int computeAccelerationsC(SimulationData* data, float3* acc) {
+	return computeActiveAccelerationsC(data, NULL, data->nbodies, acc);
+}
+
+int computeActiveAccelerations(SimulationData* data, int forcesSource, const int* active, int nactive, float3* acc) {
+	switch (forcesSource) {
+	case FORCES_DIRECT:
+		return computeActiveAccelerationsC(data, active, nactive, acc);
+	case FORCES_BARNES_HUT:
+		return computeActiveAccelerationsBarnesHut(data, active, nactive, acc);
+	case FORCES_FMM:
+		return computeActiveAccelerationsFmm(data, active, nactive, acc);
+	}
+	return 1;
+}
+
+int computeAccelerationsTiled(SimulationData* data, int blockSize, float3* acc) {
+	if (blockSize < 1 || blockSize > 1024 || syncSimulationToHost(data))
+		return 1;
+	const int nbodies = data->nbodies;
+	const int nsources = pullingBodies(data);
+	const int* sources = data->sources;
+	const int blocks = forceGridSize(nbodies, blockSize);
+	int failed = 0;
+
+#ifdef _OPENMP
+	#pragma omp parallel num_threads(simulationThreads(data))
+#endif
+	{
+		// shared memory of the block being emulated
+		float4* tile = (float4*)malloc(blockSize * sizeof(float4));
+		if (!tile) {
+#ifdef _OPENMP
+			#pragma omp atomic
+#endif
+			failed++;
+		}
+#ifdef _OPENMP
+		#pragma omp for schedule(static)
+#endif
+		for (int block = 0; block < blocks; block++) {
+			if (!tile)
+				continue;
+			const int first = block * blockSize;
+			const int count = nbodies - first < blockSize ? nbodies - first : blockSize;
+			for (int thread = 0; thread < count; thread++) {
+				float3 zero = { 0.0f, 0.0f, 0.0f };
+				acc[first + thread] = zero;
+			}
+			for (int tileStart = 0; tileStart < nsources; tileStart += blockSize) {
+				const int tileCount = nsources - tileStart < blockSize ? nsources - tileStart : blockSize;
+				// every thread of the block loads one j-body ...
+				for (int thread = 0; thread < tileCount; thread++) {
+					int j = sources ? sources[tileStart + thread] : tileStart + thread;
+					float3 p = data->positions[j];
+					float4 body = { p.x, p.y, p.z, data->weights[j] };
+					tile[thread] = body;
+				}
+				// ... then, after __syncthreads, every thread sums the whole tile
+				for (int thread = 0; thread < count; thread++) {
+					int i = first + thread;
+					accumulateTile(&acc[i], data->positions[i], sourceSlot(i, sources, nsources), tile, tileStart, tileCount);
+				}
+			}
+		}
+		free(tile);
+	}
+	return failed ? 1 : 0;
+}
+
+static void kickDriftHost(SimulationData* data, float kick, float drift) {
+	const int nbodies = data->nbodies;
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static)
+#endif
+	for (int i = 0; i < nbodies; i++) {
+		kickDriftParticleHost(data, i, kick, drift);
+	}
+}
+
+// One step of data->integrator on the host, computeAccelerations is the force pass of the backend
+int stepSimulationHost(SimulationData* data, float timeStep, AccelerationFunction computeAccelerations, int forcesSource) {
+	if (data->timestepLevels > 0)
+		return stepBlockTimesteps(data, timeStep, computeAccelerations, forcesSource);
+
+	const IntegratorScheme* scheme = integratorScheme(data->integrator);
+	if (!scheme || checkPrecision(data) || syncSimulationToHost(data))
+		return 1;
+
+	if (data->forcesSource != forcesSource) {
+		if (computeAccelerations(data, NULL, data->nbodies, data->accelerations))
+			return 1;
+	}
+	for (int stage = 0; stage < scheme->stages; stage++) {
+		kickDriftHost(data, scheme->kicks[stage] * timeStep, scheme->drifts[stage] * timeStep);
+		data->forcesSource = FORCES_NONE;
+		if (computeAccelerations(data, NULL, data->nbodies, data->accelerations))
+			return 1;
+	}
+	if (scheme->kicks[scheme->stages] != 0.0f)
+		kickDriftHost(data, scheme->kicks[scheme->stages] * timeStep, 0.0f);
+
+	data->forcesSource = forcesSource;
+	data->stateLocation = STATE_ON_HOST;
+	return 0;
+}
+
+int updateSimulationC(SimulationData* data, float timeStep) {
+	return stepSimulationHost(data, timeStep, computeActiveAccelerationsC, FORCES_DIRECT);
+}
+
+// Position and velocity of particle i in double, from the float64 state if there is one
+static inline void particleState64(const SimulationData* data, int i, double3* pos, double3* vel) {
+	if (data->precision == PRECISION_FLOAT64) {
+		*pos = data->positions64[i];
+		*vel = data->velocities64[i];
+		return;
+	}
+	float3 p = data->positions[i], v = data->velocities[i];
+	pos->x = p.x; pos->y = p.y; pos->z = p.z;
+	vel->x = v.x; vel->y = v.y; vel->z = v.z;
+}
+
+int computeDiagnostics(SimulationData* data, SimulationDiagnostics* diagnostics) {
+	if (!data->potentials || checkPrecision(data) || syncSimulationToHost(data))
+		return 1;
+	// the host force passes (direct, Barnes-Hut, FMM, NumPy) leave the potentials of the positions they end the step
+	// with, only the other sources need a direct pass
+	if (data->forcesSource != FORCES_DIRECT && data->forcesSource != FORCES_BARNES_HUT && data->forcesSource != FORCES_FMM
+		&& data->forcesSource != FORCES_NUMPY) {
+		if (computeActiveAccelerationsC(data, NULL, data->nbodies, data->accelerations))
+			return 1;
+		data->forcesSource = FORCES_DIRECT;
+	}
+
+	const int nbodies = data->nbodies;
+	double mass = 0, kinetic = 0, potential = 0;
+	double px = 0, py = 0, pz = 0, lx = 0, ly = 0, lz = 0, mx = 0, my = 0, mz = 0;
+#ifdef _OPENMP
+	#pragma omp parallel for num_threads(simulationThreads(data)) schedule(static) \
+		reduction(+: mass, kinetic, potential, px, py, pz, lx, ly, lz, mx, my, mz)
+#endif
+	for (int i = 0; i < nbodies; i++) {
+		double3 pos, vel;
+		particleState64(data, i, &pos, &vel);
+		double m = data->weights[i];
+		mass += m;
+		kinetic += 0.5 * m * (vel.x * vel.x + vel.y * vel.y + vel.z * vel.z);
+		potential += 0.5 * m * data->potentials[i];
+		px += m * vel.x; py += m * vel.y; pz += m * vel.z;
+		lx += m * (pos.y * vel.z - pos.z * vel.y);
+		ly += m * (pos.z * vel.x - pos.x * vel.z);
+		lz += m * (pos.x * vel.y - pos.y * vel.x);
+		mx += m * pos.x; my += m * pos.y; mz += m * pos.z;
+	}
+	// test particles are pulled by the sources without pulling back: their potential energy counts fully
+	if (data->sources) {
+		int k = 0;
+		for (int i = 0; i < nbodies; i++) {
+			if (k < data->nsources && data->sources[k] == i) {
+				k++;
+				continue;
+			}
+			potential += 0.5 * data->weights[i] * data->potentials[i];
+		}
+	}
+
+	diagnostics->mass = mass;
+	diagnostics->kineticEnergy = kinetic;
+	diagnostics->potentialEnergy = potential;
+	diagnostics->momentum[0] = px; diagnostics->momentum[1] = py; diagnostics->momentum[2] = pz;
+	diagnostics->angularMomentum[0] = lx; diagnostics->angularMomentum[1] = ly; diagnostics->angularMomentum[2] = lz;
+	double inverseMass = mass > 0 ? 1.0 / mass : 0.0;
+	diagnostics->centerOfMass[0] = mx * inverseMass;
+	diagnostics->centerOfMass[1] = my * inverseMass;
+	diagnostics->centerOfMass[2] = mz * inverseMass;
+	diagnostics->centerOfMassVelocity[0] = px * inverseMass;
+	diagnostics->centerOfMassVelocity[1] = py * inverseMass;
+	diagnostics->centerOfMassVelocity[2] = pz * inverseMass;
+	return 0;
+}
+
+int computeBounds(SimulationData* data, SceneBounds* bounds) {
+	if (syncSimulationToHost(data))
+		return 1;
+
+	const int nbodies = data->nbodies;
+	const float3* positions = data->positions;
+	const float* weights = data->weights;
+	double mass = 0, mx = 0, my = 0, mz = 0, sx = 0, sy = 0, sz = 0, squares = 0;
+	float lo[3] = { FLT_MAX, FLT_MAX, FLT_MAX };
+	float hi[3] = { -FLT_MAX, -FLT_MAX, -FLT_MAX };
+	// min / max reductions need OpenMP 3.1: every thread keeps its own box, merged at the end
+#ifdef _OPENMP
+	#pragma omp parallel num_threads(simulationThreads(data)) reduction(+: mass, mx, my, mz, sx, sy, sz, squares)
+#endif
+	{
+		float threadLo[3] = { FLT_MAX, FLT_MAX, FLT_MAX };
+		float threadHi[3] = { -FLT_MAX, -FLT_MAX, -FLT_MAX };
+#ifdef _OPENMP
+		#pragma omp for schedule(static)
+#endif
+		for (int i = 0; i < nbodies; i++) {
+			float3 p = positions[i];
+			double m = weights[i];
+			mass += m;
+			mx += m * p.x; my += m * p.y; mz += m * p.z;
+			sx += p.x; sy += p.y; sz += p.z;
+			squares += (double)p.x * p.x + (double)p.y * p.y + (double)p.z * p.z;
+			threadLo[0] = p.x < threadLo[0] ? p.x : threadLo[0];
+			threadLo[1] = p.y < threadLo[1] ? p.y : threadLo[1];
+			threadLo[2] = p.z < threadLo[2] ? p.z : threadLo[2];
+			threadHi[0] = p.x > threadHi[0] ? p.x : threadHi[0];
+			threadHi[1] = p.y > threadHi[1] ? p.y : threadHi[1];
+			threadHi[2] = p.z > threadHi[2] ? p.z : threadHi[2];
+		}
+#ifdef _OPENMP
+		#pragma omp critical
+#endif
+		{
+			for (int k = 0; k < 3; k++) {
+				lo[k] = threadLo[k] < lo[k] ? threadLo[k] : lo[k];
+				hi[k] = threadHi[k] > hi[k] ? threadHi[k] : hi[k];
+			}
+		}
+	}
+
+	if (!nbodies) {
+		for (int k = 0; k < 3; k++)
+			lo[k] = hi[k] = 0.0f;
+	}
+	double inverseMass = mass > 0 ? 1.0 / mass : 0.0;
+	double center[3] = { mx * inverseMass, my * inverseMass, mz * inverseMass };
+	double sums[3] = { sx, sy, sz };
+	// mean |p - c|^2 = mean |p|^2 - 2 c . mean p + |c|^2
+	double meanSquare = 0;
+	if (nbodies) {
+		meanSquare = squares / nbodies;
+		for (int k = 0; k < 3; k++)
+			meanSquare += center[k] * center[k] - 2 * center[k] * sums[k] / nbodies;
+	}
+	for (int k = 0; k < 3; k++) {
+		bounds->min[k] = lo[k];
+		bounds->max[k] = hi[k];
+		bounds->centerOfMass[k] = center[k];
+	}
+	bounds->radius = meanSquare > 0 ? sqrt(meanSquare) : 0.0;
+	return 0;
+}
+
+void releaseSimulationData(SimulationData* data) {
+	releaseBarnesHutTree(data);
+	releaseFmmTree(data);
+	releaseBlockTimesteps(data);
+	releaseCollisionGrid(data);
+	releaseSimulationCuda(data);
+}
+
+#ifdef NBODY_NO_CUDA
+int updateSimulationCuda(SimulationData* data, float timeStep) {
+	fprintf(stderr, "NBodySimulation was built without CUDA support\n");
+	return 1;
+}
+
+// Without CUDA the state never leaves the host
+int syncSimulationToHost(SimulationData* data) {
+	return 0;
+}
+
+void releaseSimulationCuda(SimulationData* data) {
+}
+#endif
\ No newline at end of file
@@ -0,0 +1,80 @@
+'''
+Accuracy report of the Barnes-Hut solver against the direct sum ('C' backend).
+
+For every scene and every opening angle theta prints the relative acceleration error
+|a_bh - a_direct| / |a_direct| (median, 99th percentile, max), the time of one force evaluation
+and, if --steps is given, the position deviation after integrating both backends side by side.
+
+    python barnes_hut_accuracy.py
+    python barnes_hut_accuracy.py --thetas 0.3 0.5 0.7 --steps 200 --dt 0.001 --json report.json
+'''
+import os
+import numpy as np
+
+from points_parser import parse_points
+from reports import position_deviations, relative_errors, report_parser, save_report, scene_files, timed
+
+
+def scene_report(path, thetas, steps, dt):
+    simulation = parse_points(path).simulation
+    exact, direct_time = timed(simulation.accelerations, 'C')
+
+    rows = []
+    for theta in thetas:
+        simulation.theta = theta
+        approx, tree_time = timed(simulation.accelerations, 'BARNES_HUT')
+        errors = relative_errors(approx, exact)
+        row = {
+            'scene': os.path.basename(path),
+            'nbodies': len(exact),
+            'theta': theta,
+            'median_error': float(np.median(errors)),
+            'p99_error': float(np.percentile(errors, 99)),
+            'max_error': float(errors.max()),
+            'direct_time': direct_time,
+            'tree_time': tree_time,
+        }
+        if steps:
+            row['position_deviation'] = trajectory_deviation(path, theta, steps, dt)
+        rows.append(row)
+    return rows
+
+
+def trajectory_deviation(path, theta, steps, dt):
+    '''Max distance between bodies of the direct and Barnes-Hut runs, relative to the scene radius'''
+    direct = parse_points(path).simulation
+    tree = parse_points(path).simulation
+    tree.theta = theta
+    for _ in range(steps):
+        direct.update(dt, 'C')
+        tree.update(dt, 'BARNES_HUT')
+    return float(np.max(position_deviations(tree.positions, direct.positions), initial=0.0))
+
+
+def print_report(rows):
+    header = f'{"scene":<36}{"N":>7}{"theta":>7}{"median":>11}{"p99":>11}{"max":>11}{"speedup":>9}'
+    if rows and 'position_deviation' in rows[0]:
+        header += f'{"pos.dev":>11}'
+    print(header)
+    for row in rows:
+        line = (f'{row["scene"]:<36}{row["nbodies"]:>7}{row["theta"]:>7.2f}'
+                f'{row["median_error"]:>11.2e}{row["p99_error"]:>11.2e}{row["max_error"]:>11.2e}'
+                f'{row["direct_time"] / max(row["tree_time"], 1e-9):>9.2f}')
+        if 'position_deviation' in row:
+            line += f'{row["position_deviation"]:>11.2e}'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = report_parser('Barnes-Hut vs direct sum accuracy report')
+    parser.add_argument('--thetas', type=float, nargs='+', default=[0.0, 0.3, 0.5, 0.7, 1.0])
+    parser.add_argument('--steps', type=int, default=0, help='also compare trajectories after this many steps')
+    parser.add_argument('--dt', type=float, default=0.001)
+    args = parser.parse_args()
+
+    report = []
+    for scene in scene_files(args.scenes):
+        report.extend(scene_report(scene, args.thetas, args.steps, args.dt))
+
+    print_report(report)
+    save_report(report, args.json)
@@ -0,0 +1,127 @@
+'''
+Headless batch runner: every scene with every time step, in parallel on a process pool.
+
+Each job loads its scene into its own Simulation in a worker process; the native engine of every worker
+uses --threads threads (by default the cores are split between the workers) so the jobs do not fight for
+the cores. With --out every job writes into <out>/<scene>_dt<dt>/:
+
+    trajectory/         every --record-every-th step, see trajectory.TrajectoryReader
+    diagnostics.npy     every --diagnostics-every-th step (numpy_simulator.DIAGNOSTICS_DTYPE records)
+
+and the summary (steps per second of every job) is printed and saved to --json.
+
+    python batch_run.py "TestData_v2/7 planet system.txt" --dt 0.1 0.05 0.025 --steps 10000 --type C --workers 3
+    python batch_run.py --steps 1000 --out runs --record-every 10 --diagnostics-every 100 --json runs/summary.json
+'''
+import os, time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import numpy as np
+
+from reports import report_parser, save_report, scene_files
+
+
+def pin_threads(threads):
+    # OpenMP / BLAS pools of libraries loaded by the worker later on
+    for name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[name] = str(threads)
+
+
+def job_directory(out, scene, dt):
+    return os.path.join(out, f'{os.path.splitext(os.path.basename(scene))[0]}_dt{dt:g}')
+
+
+def run_job(scene, dt, steps, type, integrator, threads, out, record_every, diagnostics_every, merge_radius=0.0,
+            test_particle_ratio=None):
+    from points_parser import parse_points, TEST_PARTICLE_RATIO
+    from trajectory import TrajectoryWriter
+
+    row = {'scene': os.path.basename(scene), 'dt': dt, 'type': type, 'integrator': integrator, 'steps': steps}
+    try:
+        ratio = TEST_PARTICLE_RATIO if test_particle_ratio is None else test_particle_ratio
+        simulation = parse_points(scene, test_particle_ratio=ratio).simulation
+        simulation.integrator = integrator
+        simulation.merge_radius = merge_radius
+        if type != 'NUMPY':
+            simulation.num_threads = threads
+        row['nbodies'] = nbodies = simulation.positions.shape[0]
+        # pairs per step: every particle with every one that pulls
+        row['sources'] = sources = nbodies if simulation.sources is None else len(simulation.sources)
+
+        writer = None
+        if out:
+            directory = job_directory(out, scene, dt)
+            os.makedirs(directory, exist_ok=True)
+            row['output'] = directory
+            if record_every:
+                writer = TrajectoryWriter(os.path.join(directory, 'trajectory'), record_every)
+                simulation.record_trajectory(writer)
+            if diagnostics_every:
+                simulation.log_diagnostics(diagnostics_every, steps // diagnostics_every + 1)
+
+        start = time.perf_counter()
+        try:
+            simulation.run(steps, dt, type=type)
+        finally:
+            if writer is not None:
+                writer.close()
+        elapsed = time.perf_counter() - start
+
+        row['time'] = elapsed
+        row['steps_per_second'] = steps / max(elapsed, 1e-9)
+        row['interactions_per_second'] = nbodies * sources * steps / max(elapsed, 1e-9)
+        row['merged'] = nbodies - simulation.positions.shape[0]
+        if writer is not None:
+            row['dropped_frames'] = writer.dropped_frames
+        if out and diagnostics_every:
+            log = simulation.diagnostics_log()
+            np.save(os.path.join(directory, 'diagnostics.npy'), log)
+            if len(log) > 1:
+                energy = log['kinetic_energy'] + log['potential_energy']
+                row['energy_drift'] = float(abs(energy[-1] - energy[0]) / abs(energy[0])) if energy[0] else 0.0
+    except Exception as error:
+        row['error'] = f'{error.__class__.__name__}: {error}'
+    return row
+
+
+def print_report(rows):
+    print(f'{"scene":<36}{"N":>7}{"dt":>10}{"type":>12}{"steps":>9}{"steps/s":>12}{"dE/E":>11}')
+    for row in rows:
+        if 'error' in row:
+            print(f'{row["scene"]:<36}{"":>7}{row["dt"]:>10g}{row["type"]:>12}    failed: {row["error"]}')
+            continue
+        drift = f'{row["energy_drift"]:>11.2e}' if 'energy_drift' in row else f'{"-":>11}'
+        print(f'{row["scene"]:<36}{row["nbodies"]:>7}{row["dt"]:>10g}{row["type"]:>12}{row["steps"]:>9}'
+              f'{row["steps_per_second"]:>12.1f}{drift}')
+
+
+if __name__ == '__main__':
+    parser = report_parser('Headless parameter sweep over scenes and time steps')
+    parser.add_argument('--dt', type=float, nargs='+', default=[0.5], help='time steps to run every scene with')
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--type', default='C', choices=['C', 'CUDA', 'BARNES_HUT', 'FMM', 'NUMPY'])
+    parser.add_argument('--integrator', default='LEAPFROG')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--threads', type=int, default=0, help='threads of every engine, 0 - cores / workers')
+    parser.add_argument('--out', help='directory for the trajectories and diagnostics of the jobs')
+    parser.add_argument('--record-every', type=int, default=0, help='trajectory frame every k steps, 0 - none')
+    parser.add_argument('--diagnostics-every', type=int, default=0, help='diagnostics record every k steps, 0 - none')
+    parser.add_argument('--merge-radius', type=float, default=0.0, help='merge particles closer than this, 0 - never')
+    parser.add_argument('--test-particle-ratio', type=float,
+                        help='particles lighter than this times the heaviest one only get pulled, 0 - none '
+                             '(points_parser.TEST_PARTICLE_RATIO by default)')
+    args = parser.parse_args()
+
+    scenes = scene_files(args.scenes)
+    jobs = list(product(scenes, args.dt))
+    workers = max(1, min(args.workers, len(jobs)))
+    threads = args.threads or max(1, os.cpu_count() // workers)
+
+    with ProcessPoolExecutor(workers, initializer=pin_threads, initargs=(threads,)) as pool:
+        futures = [pool.submit(run_job, scene, dt, args.steps, args.type, args.integrator, threads,
+                               args.out, args.record_every, args.diagnostics_every, args.merge_radius,
+                               args.test_particle_ratio) for scene, dt in jobs]
+        report = [future.result() for future in futures]
+
+    print_report(report)
+    save_report(report, args.json)
@@ -0,0 +1,177 @@
+'''
+Benchmark of the force engines: Simulation.update of every type over synthetic scenes of 10^2..10^5
+particles (Plummer sphere, uniform ball, asteroid belt, see synthetic_scenes) and the TestData_v2 scenes.
+Particles lighter than --test-particle-ratio times the heaviest one are test particles (see
+Simulation.test_particle_mass), --test-particle-ratio 0 times the full N^2 sums of the belts.
+
+Every case runs in a fresh process, so its peak memory is its own: one warm-up step, then as many steps
+as fit into --min-time (at most --max-steps). Reported per case:
+
+    steps_per_second
+    interactions_per_second     N * M pairs per step / time (M particles pull, N without test particles),
+                                for Barnes-Hut the direct-sum equivalent
+    peak_memory_mb              peak resident memory of the process above the one right after imports
+
+Cases whose step is expected (from the smaller N of the same engine) to take longer than --max-step-time
+are skipped. The JSON report also records the commit, the machine and the versions; --compare prints
+the speedup against an earlier report.
+
+    python benchmark.py --json before.json
+    python benchmark.py --types C BARNES_HUT --sizes 1000 10000 --no-test-data --json after.json --compare before.json
+'''
+import json, os, platform, subprocess, sys, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from reports import load_scene, report_parser, save_report, scene_files
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+
+def peak_memory():
+    '''Peak resident memory of this process in bytes, None if it can not be measured here'''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+
+def run_case(scene, n, type, dt, seed, threads, min_time, max_steps, test_particle_ratio=0.0):
+    from points_parser import Simulation
+
+    baseline = peak_memory()
+    row = {'scene': scene if n else os.path.basename(scene), 'type': type}
+    try:
+        positions, velocities, weights = load_scene(scene, n, seed)
+        simulation = Simulation(positions, velocities, weights)
+        if type != 'NUMPY':
+            simulation.num_threads = threads
+        if len(weights):
+            simulation.test_particle_mass = test_particle_ratio * float(np.max(weights))
+        row['nbodies'] = nbodies = simulation.positions.shape[0]
+        row['sources'] = sources = nbodies if simulation.sources is None else len(simulation.sources)
+
+        start = time.perf_counter()
+        simulation.update(dt, type)
+        warmup = time.perf_counter() - start
+        steps = int(min(max(min_time / max(warmup, 1e-9), 1), max_steps))
+
+        start = time.perf_counter()
+        simulation.run(steps, dt, type=type)
+        elapsed = time.perf_counter() - start
+
+        row['steps'] = steps
+        row['time'] = elapsed
+        row['steps_per_second'] = steps / max(elapsed, 1e-9)
+        row['interactions_per_second'] = float(nbodies) * sources * steps / max(elapsed, 1e-9)
+        peak = peak_memory()
+        row['peak_memory_mb'] = (peak - baseline) / 2 ** 20 if peak is not None else None
+    except Exception as error:
+        row['error'] = f'{error.__class__.__name__}: {error}'
+    return row
+
+
+def expected_step_time(rows, type, n):
+    '''Step time of N particles extrapolated from the largest smaller synthetic case of the engine'''
+    previous = [row for row in rows if row['type'] == type and 'steps' in row and row['nbodies'] < n]
+    if not previous:
+        return 0.0
+    row = max(previous, key=lambda row: row['nbodies'])
+    m = row['nbodies']
+    if type == 'BARNES_HUT':
+        scale = n * np.log(n) / (m * np.log(m))
+    elif type == 'FMM':
+        scale = n / m
+    else:
+        scale = (n / m) ** 2
+    return row['time'] / row['steps'] * scale
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+
+
+def case_key(row):
+    return row['scene'], row.get('nbodies'), row['type']
+
+
+def print_report(rows, baseline=None):
+    reference = {case_key(row): row for row in baseline['results'] if 'steps' in row} if baseline else {}
+    print(f'{"scene":<36}{"N":>8}{"type":>12}{"steps/s":>12}{"interactions/s":>16}{"memory, MB":>12}'
+          + (f'{"speedup":>9}' if baseline else ''))
+    for row in rows:
+        if 'steps' not in row:
+            reason = row.get('error') or row.get('skipped')
+            print(f'{row["scene"]:<36}{row.get("nbodies", ""):>8}{row["type"]:>12}    {reason}')
+            continue
+        memory = f'{row["peak_memory_mb"]:>12.1f}' if row['peak_memory_mb'] is not None else f'{"-":>12}'
+        line = (f'{row["scene"]:<36}{row["nbodies"]:>8}{row["type"]:>12}{row["steps_per_second"]:>12.2f}'
+                f'{row["interactions_per_second"]:>16.3e}{memory}')
+        if case_key(row) in reference:
+            line += f'{row["steps_per_second"] / reference[case_key(row)]["steps_per_second"]:>8.2f}x'
+        print(line)
+
+
+if __name__ == '__main__':
+    from points_parser import SIMULATION_TYPES, TEST_PARTICLE_RATIO
+    from synthetic_scenes import SCENE_GENERATORS
+
+    parser = report_parser('Benchmark of the Simulation.update engines')
+    parser.add_argument('--no-test-data', action='store_true', help='only the synthetic scenes')
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES, help='N of the synthetic scenes')
+    parser.add_argument('--distributions', nargs='*', default=['plummer', 'uniform'], choices=list(SCENE_GENERATORS))
+    parser.add_argument('--test-particle-ratio', type=float, default=TEST_PARTICLE_RATIO,
+                        help='particles lighter than this times the heaviest one only get pulled, 0 - none')
+    parser.add_argument('--types', nargs='+', default=SIMULATION_TYPES, choices=['C', 'CUDA', 'BARNES_HUT', 'FMM', 'NUMPY'])
+    parser.add_argument('--dt', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=0, help='num_threads of the engines, 0 - all cores')
+    parser.add_argument('--min-time', type=float, default=1.0, help='seconds to time every case for')
+    parser.add_argument('--max-steps', type=int, default=1000)
+    parser.add_argument('--max-step-time', type=float, default=30.0, help='skip cases with longer expected steps')
+    parser.add_argument('--compare', help='an earlier JSON report to print the speedup against')
+    args = parser.parse_args()
+
+    cases = [(distribution, n) for distribution in args.distributions for n in sorted(args.sizes)]
+    if not args.no_test_data:
+        cases += [(scene, 0) for scene in scene_files(args.scenes)]
+
+    results = []
+    for type in args.types:
+        for scene, n in cases:
+            expected = expected_step_time([row for row in results if row['scene'] == scene], type, n) if n else 0.0
+            if expected > args.max_step_time:
+                results.append({'scene': scene, 'nbodies': n, 'type': type,
+                                'skipped': f'expected {expected:.0f} s per step > --max-step-time'})
+                continue
+            # a fresh process for every case: its own peak memory, no state left by the previous one
+            with ProcessPoolExecutor(1) as pool:
+                results.append(pool.submit(run_case, scene, n, type, args.dt, args.seed, args.threads,
+                                           args.min_time, args.max_steps, args.test_particle_ratio).result())
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    save_report({'environment': environment(), 'settings': vars(args), 'results': results}, args.json)
@@ -0,0 +1,86 @@
+'''
+Occupancy report of the block (hierarchical) time steps.
+
+Runs every scene with timestep_levels levels: a particle on level l steps by dt / 2^l. Prints how many
+particles sit on every level (averaged over the run) and the single-particle force evaluations made,
+against the shared time step that would resolve the finest level used. With --compare the positions are
+also compared to such a shared step run (median and max, relative to the scene radius).
+
+    python block_timesteps_report.py "TestData_v2/planet and asteroidal system.txt" --dt 8 --steps 10
+    python block_timesteps_report.py --levels 8 --accuracy 0.01 --type BARNES_HUT --json report.json
+'''
+import os, time
+import numpy as np
+
+from points_parser import parse_points
+from reports import position_deviations, report_parser, save_report, scene_files
+
+
+def scene_report(path, levels, accuracy, steps, dt, type, compare):
+    simulation = parse_points(path).simulation
+    simulation.integrator = 'LEAPFROG'
+    simulation.timestep_levels = levels
+    simulation.timestep_accuracy = accuracy
+
+    occupancy = np.zeros(levels + 1)
+    start = time.perf_counter()
+    for _ in range(steps):
+        simulation.update(dt, type)
+        counts, evaluations = simulation.timestep_occupancy()
+        occupancy += counts
+    elapsed = time.perf_counter() - start
+
+    occupancy /= max(steps, 1)
+    nbodies = simulation.positions.shape[0]
+    finest = int(np.flatnonzero(occupancy)[-1]) if occupancy.any() else 0
+    shared_evaluations = nbodies * steps * 2 ** finest
+    row = {
+        'scene': os.path.basename(path),
+        'nbodies': nbodies,
+        'dt': dt,
+        'occupancy': occupancy.tolist(),
+        'finest_level': finest,
+        'force_evaluations': int(evaluations) if steps else 0,
+        'shared_force_evaluations': shared_evaluations,
+        'time': elapsed,
+    }
+    if compare:
+        shared = parse_points(path).simulation
+        shared.integrator = 'LEAPFROG'
+        shared.run(steps * 2 ** finest, dt / 2 ** finest, type=type)
+        deviations = position_deviations(simulation.positions, shared.positions)
+        # close encounters make single trajectories diverge even between two shared step runs, see the median too
+        row['median_position_deviation'] = float(np.median(deviations))
+        row['max_position_deviation'] = float(deviations.max())
+    return row
+
+
+def print_report(rows):
+    for row in rows:
+        saving = row['shared_force_evaluations'] / max(row['force_evaluations'], 1)
+        print(f'{row["scene"]}: N = {row["nbodies"]}, dt = {row["dt"]}, '
+              f'force evaluations {row["force_evaluations"]} vs {row["shared_force_evaluations"]} '
+              f'with dt / 2^{row["finest_level"]} for everyone ({saving:.1f}x), {row["time"]:.2f} s')
+        if 'max_position_deviation' in row:
+            print(f'    position deviation from the shared step: median {row["median_position_deviation"]:.2e}, '
+                  f'max {row["max_position_deviation"]:.2e}')
+        print(f'    {"level":>7}{"step":>12}{"particles":>12}')
+        for level, count in enumerate(row['occupancy']):
+            print(f'    {level:>7}{row["dt"] / 2 ** level:>12.4g}{count:>12.1f}')
+
+
+if __name__ == '__main__':
+    parser = report_parser('Block time steps occupancy report')
+    parser.add_argument('--levels', type=int, default=6, help='timestep_levels')
+    parser.add_argument('--accuracy', type=float, default=0.02, help='timestep_accuracy')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--dt', type=float, default=1.0, help='step of level 0')
+    parser.add_argument('--type', default='C', choices=['C', 'BARNES_HUT', 'FMM'])
+    parser.add_argument('--compare', action='store_true', help='also run the shared time step and compare positions')
+    args = parser.parse_args()
+
+    report = [scene_report(scene, args.levels, args.accuracy, args.steps, args.dt, args.type, args.compare)
+              for scene in scene_files(args.scenes)]
+
+    print_report(report)
+    save_report(report, args.json)
@@ -0,0 +1,58 @@
+'''
+Camera-follow policy of the canvases: where to look from Simulation.bounds() of the drawn frame.
+
+    fixed       the view is fitted to the scene once (points manager change, reset()) and stays
+    center      follows the center of mass, keeping the size of the view
+    fit         follows the center of mass and scales the view to margin * radius of the scene
+
+The target moves every frame, the view follows it with exponential smoothing of time constant
+`smoothing` seconds (0 - jumps straight to it), so it does not jitter with the particles.
+
+    follow = CameraFollow('fit', smoothing=0.5)
+    center, half_size = follow.update(frame.bounds)
+'''
+import time
+import numpy as np
+
+CAMERA_MODES = ['fixed', 'center', 'fit']
+
+# the view never shrinks below this half size: a scene of one particle has zero radius
+MIN_HALF_SIZE = 1e-6
+
+
+def view_target(bounds, margin=3.0):
+    '''(center, half size) of a cube around the center of mass, margin rms radii in every direction'''
+    center = np.asarray(bounds['center_of_mass'], dtype=np.float64)
+    return center, max(margin * bounds['radius'], MIN_HALF_SIZE)
+
+
+class CameraFollow:
+    def __init__(self, mode='center', smoothing=0.5, margin=3.0):
+        if mode not in CAMERA_MODES:
+            raise ValueError(f'Unknown camera mode {mode}, expected one of {CAMERA_MODES}')
+        self.mode = mode
+        self.smoothing = smoothing
+        self.margin = margin
+        self.center = None
+        self.half_size = None
+        self._last_time = None
+
+    def reset(self):
+        '''The next update() fits the view to the scene without smoothing'''
+        self.center = None
+        self.half_size = None
+        self._last_time = None
+
+    def update(self, bounds):
+        '''(center, half size) of the view for the frame with these bounds'''
+        now = time.perf_counter()
+        target_center, target_half_size = view_target(bounds, self.margin)
+        if self.center is None:
+            self.center, self.half_size = target_center, target_half_size
+        elif self.mode != 'fixed':
+            alpha = 1.0 - np.exp(-(now - self._last_time) / self.smoothing) if self.smoothing > 0 else 1.0
+            self.center = self.center + alpha * (target_center - self.center)
+            if self.mode == 'fit':
+                self.half_size += alpha * (target_half_size - self.half_size)
+        self._last_time = now
+        return self.center, self.half_size
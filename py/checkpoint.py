@@ -0,0 +1,86 @@
+'''
+Checkpoints of the full simulation state, see Simulation.save_checkpoint / Simulation.load_checkpoint.
+
+A checkpoint is one .npz file: the state buffers (positions, velocities, weights, the accelerations the
+integrator reuses, the float64 or compensation buffers of the precision, the block time step levels) and
+a 'meta' JSON string with the step, the time and the settings. It is written next to its final path and
+renamed over it, so a crash in the middle leaves the previous checkpoint intact.
+
+    policy = CheckpointPolicy('checkpoints', every_steps=10000, every_seconds=600, keep=3)
+    simulation.auto_checkpoint(policy)
+    ...
+    simulation = Simulation.load_checkpoint(latest_checkpoint('checkpoints'))
+'''
+import glob, json, os, time
+import numpy as np
+
+CHECKPOINT_FORMAT = 'nbody-checkpoint'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_PATTERN = 'checkpoint_*.npz'
+
+
+def replace_file(path, write):
+    '''Atomically replaces path with what write(f) writes: a temporary file is renamed over it'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_checkpoint(path, arrays, meta):
+    meta = dict(meta, format=CHECKPOINT_FORMAT, version=CHECKPOINT_VERSION)
+    replace_file(path, lambda f: np.savez(f, meta=np.array(json.dumps(meta)), **arrays))
+
+
+def read_checkpoint(path):
+    '''(arrays, meta) of a checkpoint file'''
+    with np.load(path, allow_pickle=False) as checkpoint:
+        arrays = {name: checkpoint[name] for name in checkpoint.files}
+    meta = json.loads(str(arrays.pop('meta', '{}')))
+    if meta.get('format') != CHECKPOINT_FORMAT:
+        raise Exception(f'"{path}" is not a checkpoint')
+    if meta.get('version') != CHECKPOINT_VERSION:
+        raise Exception(f'Unsupported checkpoint version {meta.get("version")} of "{path}"')
+    return arrays, meta
+
+
+def latest_checkpoint(directory):
+    '''Path of the newest checkpoint of a CheckpointPolicy directory, None if there is none'''
+    paths = sorted(glob.glob(os.path.join(directory, CHECKPOINT_PATTERN)))
+    return paths[-1] if paths else None
+
+
+class CheckpointPolicy:
+    '''Saves a checkpoint after every every_steps-th step and/or every_seconds of wall time, keeping the last keep.
+
+    Attach it with Simulation.auto_checkpoint. Files are named checkpoint_<step>.npz in directory.
+    With every_seconds the clock is checked after every step.
+    '''
+    def __init__(self, directory, every_steps=0, every_seconds=0, keep=3):
+        if every_steps < 0 or every_seconds < 0 or not (every_steps or every_seconds):
+            raise ValueError('every_steps or every_seconds should be > 0')
+        if keep < 1:
+            raise ValueError('keep should be >= 1')
+        self.directory = directory
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.keep = keep
+        # steps at which the simulation calls checkpoint()
+        self.every = 1 if every_seconds else every_steps
+        self._last_time = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def checkpoint(self, simulation):
+        now = time.monotonic()
+        step = simulation.step
+        if not ((self.every_steps and step % self.every_steps == 0) or
+                (self.every_seconds and now - self._last_time >= self.every_seconds)):
+            return
+        simulation.save_checkpoint(os.path.join(self.directory, f'checkpoint_{step:012d}.npz'))
+        self._last_time = now
+
+        paths = sorted(glob.glob(os.path.join(self.directory, CHECKPOINT_PATTERN)))
+        for path in paths[:-self.keep]:
+            os.remove(path)
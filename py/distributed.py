@@ -0,0 +1,465 @@
+'''
+Domain-decomposed runs over MPI: the particles are split between the ranks, every rank steps its own share
+with the native engine and only exchanges what the forces of its particles need.
+
+    'C'             direct sum. exchange='ALLGATHER': every force pass gathers all positions on every rank
+                    (N * 12 bytes per rank and pass), each rank sums the forces of its own block; the blocks
+                    are contiguous in the order of the scene, so the result is bit for bit the one of a single
+                    Simulation. exchange='RING': the blocks travel around the ring of ranks (p - 1 hops of one
+                    block, memory N / p per rank), the partial sums are added in float64, so the result only
+                    matches up to the float32 rounding
+    'BARNES_HUT'    tree solvers over locally essential trees: the particles are ordered along a Morton curve
+    'FMM'           and split into p equal ranges (again every rebalance_every steps, the particles migrate with
+                    their state). Every force pass each rank sends to every other one the bodies and the cells of
+                    its tree that are far enough from the box of that rank (Simulation.essential_tree) and builds
+                    its tree over its own particles and the received ones
+
+The integrator is the kick-drift of stepSimulationHost on the local share, in the same float32 arithmetic.
+Not supported in distributed mode: merges, block time steps, test particles and the 'FLOAT64' / 'KAHAN'
+precisions. Needs an MPI implementation (OpenMPI, MPICH) and mpi4py built against it:
+
+    pip install mpi4py
+
+    mpirun -np 4 python distributed.py plummer --n 20000 --steps 100 --type C --exchange RING --check
+    mpirun -np 4 python distributed.py planets.nbody --steps 1000 --dt 0.01 --type BARNES_HUT --json run.json
+
+--check runs the same steps in a single Simulation on rank 0 and reports the largest difference of the
+accelerations before the first step (relative to the largest acceleration) and of the final positions
+(relative to the radius of the scene, see reports.position_deviations). The trees of one process and of the
+essential trees are different approximations only to the extent that their cells differ, so the accelerations
+show a broken exchange long before the positions drift from the direct sum.
+'''
+import time
+import numpy as np
+from mpi4py import MPI
+
+from numpy_simulator import INTEGRATORS, YOSHIDA_W0, YOSHIDA_W1
+from reports import load_scene, position_deviations, report_parser, save_report
+from simulator import Simulation
+
+DISTRIBUTED_TYPES = ['C', 'BARNES_HUT', 'FMM']
+EXCHANGES = ['ALLGATHER', 'RING']
+
+# Morton keys of the tree decomposition: bits of every coordinate (3 * 21 bits fit into uint64)
+MORTON_BITS = 21
+
+# Keys every rank contributes to the choice of the splitters of the decomposition
+SPLITTER_SAMPLES = 256
+
+# (kicks, drifts) of the integrators in the float32 arithmetic of integratorScheme (particle_update.h)
+_W0, _W1, _HALF = np.float32(YOSHIDA_W0), np.float32(YOSHIDA_W1), np.float32(0.5)
+FLOAT32_SCHEMES = {
+    'EULER': ((np.float32(1), np.float32(0)), (np.float32(1),)),
+    'LEAPFROG': ((_HALF, _HALF), (np.float32(1),)),
+    'YOSHIDA4': ((_HALF * _W1, _HALF * (_W0 + _W1), _HALF * (_W0 + _W1), _HALF * _W1), (_W1, _W0, _W1)),
+}
+
+# Floats of a migrating particle: position, velocity, weight, acceleration, potential
+PARTICLE_FLOATS = 11
+
+
+def share(n, size, rank):
+    '''[start, stop) of the block of n particles that belongs to rank, the first n % size ranks get one more'''
+    base, extra = divmod(n, size)
+    start = rank * base + min(rank, extra)
+    return start, start + base + (rank < extra)
+
+
+def load_share(scene, n=0, seed=0, comm=None):
+    '''(positions, velocities, weights, start) of the block of the scene that belongs to this rank.
+
+    scene is a .nbody / .txt file or a synthetic_scenes generator (with n particles). Binary scenes are
+    memory-mapped, every rank only reads its own block.
+    '''
+    comm = comm or MPI.COMM_WORLD
+    arrays = load_scene(scene, n, seed)
+    start, stop = share(len(arrays[2]), comm.Get_size(), comm.Get_rank())
+    positions, velocities, weights = (np.array(array[start:stop], dtype=np.float32) for array in arrays)
+    return positions, velocities, weights, start
+
+
+def morton_keys(positions, low, high):
+    '''Morton (Z-order) keys of the positions in the box [low, high]'''
+    scale = (2 ** MORTON_BITS - 1) / np.maximum(np.asarray(high, dtype=np.float64) - low, 1e-30)
+    cells = ((np.asarray(positions, dtype=np.float64) - low) * scale).clip(0, 2 ** MORTON_BITS - 1).astype(np.uint64)
+    keys = np.zeros(len(positions), dtype=np.uint64)
+    for axis in range(3):
+        x = cells[:, axis]
+        # spreads the 21 bits of x to every third bit
+        x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+        x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+        x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+        x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+        x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+        keys |= x << np.uint64(axis)
+    return keys
+
+
+def export_theta(type, theta, fmm_order):
+    '''Opening angle of the cells sent to the other ranks: they arrive as point masses, for the FMM the
+    monopole error of a cell has to stay near the truncation error of its expansions'''
+    return theta ** (fmm_order / 2) if type == 'FMM' else theta
+
+
+class DistributedSimulation:
+    '''The share of one rank of a simulation split over the ranks of comm (a collective object: every rank
+    creates it and calls update / run / diagnostics / gather together).
+
+    positions, velocities, weights are the particles of this rank, ids their indices in the whole scene
+    (by default the ranks hold consecutive blocks in rank order, see load_share).
+    '''
+    def __init__(self, positions, velocities, weights, comm=None, type='C', exchange='ALLGATHER', integrator='EULER',
+                 theta=0.5, fmm_order=4, num_threads=0, rebalance_every=10, ids=None):
+        if type not in DISTRIBUTED_TYPES:
+            raise Exception(f'Undefined type "{type}". Use one of {", ".join(DISTRIBUTED_TYPES)} instead.')
+        if exchange not in EXCHANGES:
+            raise ValueError(f'Undefined exchange "{exchange}". Use one of {", ".join(EXCHANGES)}.')
+        if integrator not in INTEGRATORS:
+            raise ValueError(f'Undefined integrator "{integrator}". Use one of {", ".join(INTEGRATORS)}.')
+        if rebalance_every < 0:
+            raise ValueError('rebalance_every should be >= 0')
+        self.comm = comm or MPI.COMM_WORLD
+        self.type = type
+        self.exchange = exchange
+        self.integrator = integrator
+        self.theta = theta
+        self.fmm_order = fmm_order
+        self.num_threads = num_threads
+        self.rebalance_every = rebalance_every
+
+        self._positions = np.array(positions, dtype=np.float32, order='C').reshape(-1, 3)
+        self._velocities = np.array(velocities, dtype=np.float32, order='C').reshape(-1, 3)
+        self._weights = np.array(weights, dtype=np.float32, order='C').reshape(-1)
+        n = len(self._weights)
+        assert len(self._positions) == len(self._velocities) == n
+        if ids is None:
+            ids = self.comm.exscan(n) or 0
+            ids = np.arange(ids, ids + n)
+        self._ids = np.array(ids, dtype=np.int64)
+        self._accelerations = np.zeros((n, 3), dtype=np.float32)
+        self._potentials = np.zeros(n, dtype=np.float32)
+        self._forces_ready = False
+        self._step = 0
+        self._time = 0.0
+        self._counts = np.array(self.comm.allgather(n))
+
+        if type == 'C':
+            self._setup_direct()
+        else:
+            self._rebalance()
+
+    # --- direct sum ---------------------------------------------------------------------------------------
+
+    def _setup_direct(self):
+        n = len(self._weights)
+        rank = self.comm.Get_rank()
+        if self.exchange == 'ALLGATHER':
+            # the whole scene on every rank, the weights never change
+            self._displacements = np.concatenate([[0], np.cumsum(self._counts)[:-1]])
+            total = int(self._counts.sum())
+            self._buffer_positions = np.empty((total, 3), dtype=np.float32)
+            self._buffer_weights = np.empty(total, dtype=np.float32)
+            self.comm.Allgatherv(self._weights, [self._buffer_weights, self._counts, self._displacements, MPI.FLOAT])
+            self._targets = np.arange(self._displacements[rank], self._displacements[rank] + n, dtype=np.intc)
+        else:
+            # own particles, then the block that is visiting
+            capacity = int(self._counts.max())
+            self._buffer_positions = np.zeros((n + capacity, 3), dtype=np.float32)
+            self._buffer_weights = np.zeros(n + capacity, dtype=np.float32)
+            self._buffer_weights[:n] = self._weights
+            self._visiting = np.zeros((capacity, 4), dtype=np.float32)
+            self._targets = np.arange(n, dtype=np.intc)
+        self._work = Simulation(self._buffer_positions, np.zeros_like(self._buffer_positions), self._buffer_weights,
+                                num_threads=self.num_threads, copy=False)
+
+    def _allgather_forces(self):
+        self.comm.Allgatherv(self._positions, [self._buffer_positions, self._counts * 3, self._displacements * 3, MPI.FLOAT])
+        self._accelerations[...] = self._work.accelerations('C', targets=self._targets, potentials=self._potentials)
+
+    def _ring_forces(self):
+        n = len(self._weights)
+        size, rank = self.comm.Get_size(), self.comm.Get_rank()
+        accelerations = np.zeros((n, 3))
+        potentials = np.zeros(n)
+        self._buffer_positions[:n] = self._positions
+        self._visiting[:n, :3] = self._positions
+        self._visiting[:n, 3] = self._weights
+        for hop in range(size):
+            owner = (rank - hop) % size
+            count = self._counts[owner]
+            if hop:
+                self.comm.Sendrecv_replace(self._visiting, dest=(rank + 1) % size, source=(rank - 1) % size)
+                self._buffer_positions[n:n + count] = self._visiting[:count, :3]
+                self._buffer_weights[n:n + count] = self._visiting[:count, 3]
+            if not count or not n:
+                continue
+            # the own block pulls from its place, the others from the visiting rows
+            self._work.sources = np.arange(count) + (n if hop else 0)
+            accelerations += self._work.accelerations('C', targets=self._targets, potentials=self._potentials)
+            potentials += self._potentials
+        self._accelerations[...] = accelerations
+        self._potentials[...] = potentials
+
+    # --- tree solvers ---------------------------------------------------------------------------------------
+
+    def _rebalance(self):
+        '''Orders the particles along the Morton curve of the scene and gives every rank an equal range of it'''
+        size = self.comm.Get_size()
+        n = len(self._weights)
+        low = np.full(3, np.inf)
+        high = np.full(3, -np.inf)
+        if n:
+            low, high = self._positions.min(axis=0).astype(np.float64), self._positions.max(axis=0).astype(np.float64)
+        self.comm.Allreduce(MPI.IN_PLACE, low, op=MPI.MIN)
+        self.comm.Allreduce(MPI.IN_PLACE, high, op=MPI.MAX)
+        keys = morton_keys(self._positions, low, high)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+
+        # splitters at equal shares of the weighted samples of all ranks
+        picks = keys[np.arange(min(n, SPLITTER_SAMPLES)) * n // min(n, SPLITTER_SAMPLES)] if n else keys
+        samples = self.comm.allgather((picks, n / max(len(picks), 1)))
+        sample_keys = np.concatenate([s for s, _ in samples])
+        sample_weights = np.concatenate([np.full(len(s), w) for s, w in samples])
+        by_key = np.argsort(sample_keys, kind='stable')
+        cumulative = np.cumsum(sample_weights[by_key])
+        cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, size) / size) if len(cumulative) else []
+        splitters = sample_keys[by_key][np.minimum(cuts, len(by_key) - 1)] if len(cumulative) else np.zeros(size - 1, np.uint64)
+        destination = np.searchsorted(splitters, keys, side='right')
+
+        state = np.empty((n, PARTICLE_FLOATS), dtype=np.float32)
+        state[:, 0:3] = self._positions[order]
+        state[:, 3:6] = self._velocities[order]
+        state[:, 6] = self._weights[order]
+        state[:, 7:10] = self._accelerations[order]
+        state[:, 10] = self._potentials[order]
+        send_counts = np.bincount(destination, minlength=size)
+        state, ids = self._alltoall_rows(send_counts, state, self._ids[order])
+
+        self._positions = np.ascontiguousarray(state[:, 0:3])
+        self._velocities = np.ascontiguousarray(state[:, 3:6])
+        self._weights = np.ascontiguousarray(state[:, 6])
+        self._accelerations = np.ascontiguousarray(state[:, 7:10])
+        self._potentials = np.ascontiguousarray(state[:, 10])
+        self._ids = ids
+        self._counts = np.array(self.comm.allgather(len(ids)))
+
+    def _alltoall_rows(self, send_counts, rows, ids=None):
+        '''Sends send_counts[r] consecutive rows (and ids) to every rank r, returns the received ones in rank order'''
+        recv_counts = np.array(self.comm.alltoall(send_counts.tolist()))
+        width = rows.shape[1]
+        send_offsets = np.concatenate([[0], np.cumsum(send_counts)[:-1]])
+        recv_offsets = np.concatenate([[0], np.cumsum(recv_counts)[:-1]])
+        received = np.empty((recv_counts.sum(), width), dtype=np.float32)
+        self.comm.Alltoallv([np.ascontiguousarray(rows), send_counts * width, send_offsets * width, MPI.FLOAT],
+                            [received, recv_counts * width, recv_offsets * width, MPI.FLOAT])
+        if ids is None:
+            return received
+        received_ids = np.empty(recv_counts.sum(), dtype=np.int64)
+        self.comm.Alltoallv([np.ascontiguousarray(ids), send_counts, send_offsets, MPI.INT64_T],
+                            [received_ids, recv_counts, recv_offsets, MPI.INT64_T])
+        return received, received_ids
+
+    def _tree_forces(self):
+        n = len(self._weights)
+        size, rank = self.comm.Get_size(), self.comm.Get_rank()
+        box = np.concatenate([self._positions.min(axis=0), self._positions.max(axis=0)]) if n else None
+        boxes = self.comm.allgather(box)
+
+        send_counts = np.zeros(size, dtype=np.int64)
+        items = np.empty((0, 4), dtype=np.float32)
+        others = [r for r in range(size) if r != rank and boxes[r] is not None]
+        if n and others:
+            local = Simulation(self._positions, self._velocities, self._weights, num_threads=self.num_threads)
+            trees = local.essential_tree(np.array([boxes[r] for r in others]),
+                                         export_theta(self.type, self.theta, self.fmm_order))
+            send_counts[others] = [len(tree) for tree in trees]
+            items = np.concatenate(trees)
+        received = self._alltoall_rows(send_counts, items)
+        if not n:
+            return
+
+        positions = np.concatenate([self._positions, received[:, :3]])
+        weights = np.concatenate([self._weights, received[:, 3]])
+        combined = Simulation(positions, np.zeros_like(positions), weights, num_threads=self.num_threads,
+                              theta=self.theta, fmm_order=self.fmm_order)
+        self._accelerations[...] = combined.accelerations(self.type, targets=np.arange(n), potentials=self._potentials)
+
+    # --- stepping -------------------------------------------------------------------------------------------
+
+    def _compute_forces(self):
+        if self.type != 'C':
+            self._tree_forces()
+        elif self.exchange == 'ALLGATHER':
+            self._allgather_forces()
+        else:
+            self._ring_forces()
+        self._forces_ready = True
+
+    def update(self, timestep=0.001):
+        '''One step of the integrator, like stepSimulationHost (float32 kicks and drifts of the same size)'''
+        if self.type != 'C' and self.rebalance_every and self._step and self._step % self.rebalance_every == 0:
+            self._rebalance()
+        if not self._forces_ready:
+            self._compute_forces()
+        kicks, drifts = FLOAT32_SCHEMES[self.integrator]
+        dt = np.float32(timestep)
+        for kick, drift in zip(kicks, drifts):
+            self._velocities += self._accelerations * (kick * dt)
+            self._positions += self._velocities * (drift * dt)
+            self._compute_forces()
+        if kicks[-1]:
+            self._velocities += self._accelerations * (kicks[-1] * dt)
+        self._step += 1
+        self._time += timestep
+
+    def run(self, n_steps, timestep=0.001):
+        for _ in range(n_steps):
+            self.update(timestep)
+
+    def diagnostics(self):
+        '''Conserved quantities of the whole scene, the dict of Simulation.diagnostics()'''
+        if not self._forces_ready:
+            self._compute_forces()
+        positions = self._positions.astype(np.float64)
+        velocities = self._velocities.astype(np.float64)
+        weights = self._weights.astype(np.float64)
+        sums = np.concatenate([
+            [weights.sum(), 0.5 * weights @ np.einsum('ij,ij->i', velocities, velocities), 0.5 * weights @ self._potentials],
+            weights @ velocities, weights @ np.cross(positions, velocities).reshape(-1, 3), weights @ positions,
+        ])
+        self.comm.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
+        mass = sums[0]
+        return {
+            'mass': mass,
+            'kinetic_energy': sums[1],
+            'potential_energy': sums[2],
+            'momentum': sums[3:6],
+            'angular_momentum': sums[6:9],
+            'center_of_mass': sums[9:12] / mass if mass else np.zeros(3),
+            'center_of_mass_velocity': sums[3:6] / mass if mass else np.zeros(3),
+            'energy': sums[1] + sums[2],
+        }
+
+    def accelerations(self):
+        '''Accelerations of the particles of this rank (see ids) at their current positions'''
+        if not self._forces_ready:
+            self._compute_forces()
+        return self._accelerations.copy()
+
+    def _gather(self, arrays, root):
+        parts = self.comm.gather((self._ids,) + arrays, root=root)
+        if parts is None:
+            return None
+        order = np.argsort(np.concatenate([part[0] for part in parts]))
+        return tuple(np.concatenate([part[k] for part in parts])[order] for k in range(1, len(arrays) + 1))
+
+    def gather(self, root=0):
+        '''(positions, velocities, weights) of the whole scene in the order of the ids on root, None elsewhere'''
+        return self._gather((self._positions, self._velocities, self._weights), root)
+
+    def gather_accelerations(self, root=0):
+        '''Accelerations of the whole scene in the order of the ids on root, None elsewhere'''
+        if not self._forces_ready:
+            self._compute_forces()
+        parts = self._gather((self._accelerations,), root)
+        return parts and parts[0]
+
+    @property
+    def positions(self):
+        '''Read-only view of the positions of the particles of this rank (see ids)'''
+        view = self._positions.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def ids(self):
+        '''Index in the whole scene of every particle of this rank'''
+        return self._ids.copy()
+
+    @property
+    def nbodies(self):
+        return int(self._counts.sum())
+
+    @property
+    def step(self):
+        return self._step
+
+    @property
+    def time(self):
+        return self._time
+
+
+def single_process_run(args):
+    '''(accelerations before the first step, positions after the steps) of the same run in one Simulation'''
+    positions, velocities, weights = load_scene(args.scene, args.n, args.seed)
+    simulation = Simulation(positions, velocities, weights, num_threads=args.threads, theta=args.theta,
+                            integrator=args.integrator, fmm_order=args.fmm_order)
+    accelerations = simulation.accelerations(args.type)
+    simulation.run(args.steps, args.dt, type=args.type)
+    return accelerations, simulation.copy()[0]
+
+
+def print_report(row):
+    print(f'{row["ranks"]} ranks, {row["nbodies"]} bodies, {row["type"]} ({row["exchange"]}), {row["steps"]} steps: '
+          f'{row["steps_per_second"]:.1f} steps/s, dE/E {row["energy_drift"]:.2e}')
+    if 'max_difference' in row:
+        print(f'single process: max |da| {row["max_acceleration_difference"]:.3e} of max |a| before the first step, '
+              f'max |dx| {row["max_difference"]:.3e} of the scene radius'
+              + (' (identical)' if row['identical'] else ''))
+
+
+if __name__ == '__main__':
+    parser = report_parser('Simulation split over the ranks of an MPI run', scenes=False)
+    parser.add_argument('scene', help='scene file (.txt or .nbody) or a synthetic scene: plummer, uniform, belt')
+    parser.add_argument('--n', type=int, default=10000, help='particles of a synthetic scene')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--dt', type=float, default=0.001)
+    parser.add_argument('--type', default='C', choices=DISTRIBUTED_TYPES)
+    parser.add_argument('--exchange', default='ALLGATHER', choices=EXCHANGES, help='position exchange of "C"')
+    parser.add_argument('--integrator', default='LEAPFROG', choices=list(INTEGRATORS))
+    parser.add_argument('--theta', type=float, default=0.5)
+    parser.add_argument('--fmm-order', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1, help='threads of the engine of every rank, 0 - all cores')
+    parser.add_argument('--rebalance-every', type=int, default=10, help='steps between the tree decompositions, 0 - once')
+    parser.add_argument('--check', action='store_true', help='compare with a single-process run on rank 0')
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    positions, velocities, weights, _ = load_share(args.scene, args.n, args.seed, comm)
+    simulation = DistributedSimulation(positions, velocities, weights, comm, type=args.type, exchange=args.exchange,
+                                       integrator=args.integrator, theta=args.theta, fmm_order=args.fmm_order,
+                                       num_threads=args.threads, rebalance_every=args.rebalance_every)
+    before = simulation.diagnostics()
+    initial = simulation.gather_accelerations() if args.check else None
+    comm.Barrier()
+    start = time.perf_counter()
+    simulation.run(args.steps, args.dt)
+    comm.Barrier()
+    elapsed = time.perf_counter() - start
+    after = simulation.diagnostics()
+    final = simulation.gather()
+
+    if comm.Get_rank() == 0:
+        row = {
+            'scene': args.scene,
+            'ranks': comm.Get_size(),
+            'nbodies': simulation.nbodies,
+            'type': args.type,
+            'exchange': args.exchange if args.type == 'C' else 'ESSENTIAL_TREES',
+            'integrator': args.integrator,
+            'steps': args.steps,
+            'time': elapsed,
+            'steps_per_second': args.steps / max(elapsed, 1e-9),
+            'energy_drift': float(abs(after['energy'] - before['energy']) / abs(before['energy'])) if before['energy'] else 0.0,
+        }
+        if args.check:
+            reference_accelerations, reference = single_process_run(args)
+            scale = np.max(np.linalg.norm(reference_accelerations, axis=1), initial=0.0) or 1.0
+            row['max_acceleration_difference'] = float(
+                np.max(np.linalg.norm(initial - reference_accelerations, axis=1), initial=0.0) / scale)
+            row['max_difference'] = float(np.max(position_deviations(final[0], reference), initial=0.0))
+            row['identical'] = bool(np.array_equal(final[0], reference))
+        print_report(row)
+        save_report(row, args.json)
@@ -1,6 +1,5 @@
-import sys, datetime
+import sys
 import random
-import numpy as np
 from mpl_toolkits import mplot3d
 import matplotlib
 matplotlib.use('Qt5Agg')
@@ -19,10 +18,21 @@ else:
 
 import os, traceback
 
-from points_parser import PointsManager, parse_points
+from points_parser import PointsManager, parse_points, SIMULATION_TYPES, INTEGRATORS, TEST_PARTICLE_RATIO
+from frame_pipeline import SimulationWorker, RateMeter
+from numpy_simulator import scene_bounds
+from camera_follow import CameraFollow, CAMERA_MODES
+try:
+    from vispy_canvas import VispyCanvas
+except ImportError:
+    # VisPy не установлен: остаётся только matplotlib
+    VispyCanvas = None
+
+# пауза цикла отрисовки между кадрами, с
+FRAME_INTERVAL = 1 / 60
 
 class MplCanvas(QtWidgets.QWidget):
-    def __init__(self, parent=None, width=5, height=4, dpi=100): #, toolbar=True)
+    def __init__(self, parent=None, width=5, height=4, dpi=100, camera_follow=None): #, toolbar=True)
         super().__init__()
         layout = QtWidgets.QVBoxLayout(self)
         self.setLayout(layout)
@@ -48,6 +58,7 @@ class MplCanvas(QtWidgets.QWidget):
         # self.axes.grid(False)
 
         # 
+        self.camera_follow = camera_follow or CameraFollow('fixed')
         self._points_manager = None
         self._points_manager_changed = True
         self._lines_refs = None
@@ -69,10 +80,17 @@ class MplCanvas(QtWidgets.QWidget):
     def change_points_size(self):
         self._groups_updated = True
 
-    def update_points(self):
+    def update_points(self, positions=None, bounds=None, indices=None, origin=None):
         if not self._points_manager:
             return # Пока ещё не было загружено ни каких точек
+        if positions is None:
+            positions = self._points_manager.simulation.positions
+            bounds = bounds or self._points_manager.simulation.bounds()
+            origin = self._points_manager.origin()
+            indices = self._points_manager.select(positions, bounds, origin)
         if self._points_manager_changed or self._groups_updated: # Первый запуск осле смены points_manager, надо всё переинициализировать
+            if self._points_manager_changed:
+                self.camera_follow.reset()
             self._points_manager_changed = False
             self._groups_updated = False
             self._lines_refs = []
@@ -80,41 +98,10 @@ class MplCanvas(QtWidgets.QWidget):
             # self.axes.axis('off')
             # self.axes.grid(False)
 
-            x_max = None
-            x_min = None
-            y_max = None
-            y_min = None
-            z_max = None
-            z_min = None
-            for group in self._points_manager:
+            for group in self._points_manager.groups(positions, indices, origin):
                 xs = group['xs']
                 ys = group['ys']
                 zs = group['zs'] / 0.75
-                
-                x_min_t = np.min(xs)
-                x_max_t = np.max(xs)
-                y_min_t = np.min(ys)
-                y_max_t = np.max(ys)
-                z_min_t = np.min(zs)
-                z_max_t = np.max(zs)
-                if x_max is None:
-                    x_min = x_min_t
-                    x_max = x_max_t
-                    
-                    y_min = y_max_t
-                    y_max = y_max_t
-                    
-                    z_min = z_min_t
-                    z_max = z_max_t
-                else:
-                    x_min = min(x_min, x_min_t)
-                    x_max = max(x_max, x_max_t)
-                    
-                    y_min = min(y_min, y_min_t)
-                    y_max = max(y_max, y_max_t)
-                    
-                    z_min = min(z_min, z_min_t)
-                    z_max = max(z_max, z_max_t)
 
                 size = group['size']
                 color = group['color']
@@ -124,28 +111,8 @@ class MplCanvas(QtWidgets.QWidget):
                                                color=color,
                                                markersize=size)
                 self._lines_refs.append(_plot_refs[0])
-
-
-                positions, velocity, weights = self._points_manager.simulation.data
-                center_of_mass = np.sum(positions  * weights.reshape(-1, 1), axis=0) / np.sum(weights)
-                distances = np.sqrt(np.sum(np.power((positions - center_of_mass), 2), axis=1)) + 0.1
-                std_distance_from_center = np.std([0, *distances])
-                x_min = center_of_mass[0] - 3 * std_distance_from_center
-                x_max = center_of_mass[0] + 3 * std_distance_from_center
-                y_min = center_of_mass[1] - 3 * std_distance_from_center
-                y_max = center_of_mass[1] + 3 * std_distance_from_center
-                z_min = center_of_mass[2] - 3 * std_distance_from_center
-                z_max = center_of_mass[2] + 3 * std_distance_from_center
-
-                print('center_of_mass', center_of_mass)
-                print('distances', distances)
-                print('std_distance_from_center', std_distance_from_center)
-
-                self.axes.set_xlim3d(x_min, x_max)
-                self.axes.set_ylim3d(y_min, y_max)
-                self.axes.set_zlim3d(z_min, z_max)
         else:
-            for ind, group in enumerate(self._points_manager):
+            for ind, group in enumerate(self._points_manager.groups(positions, indices, origin)):
                 xs = group['xs']
                 ys = group['ys']
                 zs = group['zs'] / 0.75
@@ -153,14 +120,27 @@ class MplCanvas(QtWidgets.QWidget):
                     xs, ys, zs
                 )
 
+        # границы считаются один раз на кадр (обычно уже посчитаны потоком симуляции), смена границ
+        # меняет только пределы осей, без перестроения графика
+        if len(positions):
+            weights = self._points_manager.weights if origin is None else self._points_manager.weights[origin]
+            center, half_size = self.camera_follow.update(bounds or scene_bounds(positions, weights))
+            self.axes.set_xlim3d(center[0] - half_size, center[0] + half_size)
+            self.axes.set_ylim3d(center[1] - half_size, center[1] + half_size)
+            self.axes.set_zlim3d(center[2] - half_size, center[2] + half_size)
+
         self.canvas.draw()
 
 class MainWindow(QtWidgets.QMainWindow):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, renderer='vispy', **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
+        self.points_manager = None
 
-        self.plot3D = MplCanvas(self, width=20, height=20, dpi=130)
+        if renderer == 'vispy' and VispyCanvas is not None:
+            self.plot3D = VispyCanvas(self)
+        else:
+            self.plot3D = MplCanvas(self, width=20, height=20, dpi=130)
         self.test_text = QtWidgets.QTextEdit("Hello world")
 
         left_col_base = QtWidgets.QWidget(self)
@@ -247,17 +227,33 @@ class MainWindow(QtWidgets.QMainWindow):
             # if self.max_size_select.value() != self.points_manager.max_point_size:
             #     self.max_size_select.setValue(self.points_manager.max_point_size)
             self.plot3D.change_points_size()
-            self.update_plot()
+            # во время симуляции состоянием владеет её поток: новые размеры нарисует следующий кадр
+            if self.simulation_worker is None:
+                self.update_plot()
         update_points_sizes.clicked.connect(update_points)
 
         # add to left col
         left_col.addWidget(update_points_sizes)
 
-        # Флаг использовать CUDA или нет
-        self.cuda_use_flag = QtWidgets.QCheckBox('Использовать CUDA')
-        
+        # Способ расчёта: C, CUDA или NUMPY
+        simulation_type_layout = QtWidgets.QHBoxLayout()
+        simulation_type_layout.addWidget(QtWidgets.QLabel('Вычислитель'))
+        self.simulation_type_select = QtWidgets.QComboBox()
+        self.simulation_type_select.addItems(SIMULATION_TYPES)
+        simulation_type_layout.addWidget(self.simulation_type_select)
+
         # add to left col
-        left_col.addWidget(self.cuda_use_flag)
+        left_col.addLayout(simulation_type_layout)
+
+        # Схема интегрирования: EULER, LEAPFROG или YOSHIDA4
+        integrator_layout = QtWidgets.QHBoxLayout()
+        integrator_layout.addWidget(QtWidgets.QLabel('Интегратор'))
+        self.integrator_select = QtWidgets.QComboBox()
+        self.integrator_select.addItems(list(INTEGRATORS))
+        integrator_layout.addWidget(self.integrator_select)
+
+        # add to left col
+        left_col.addLayout(integrator_layout)
 
         # decimation
         decimation_layout = QtWidgets.QHBoxLayout()
@@ -272,6 +268,63 @@ class MainWindow(QtWidgets.QMainWindow):
         # add to left col
         left_col.addLayout(decimation_layout)
 
+        # Бюджет точек: сколько частиц рисуется за кадр, 0 - все
+        point_budget_layout = QtWidgets.QHBoxLayout()
+        point_budget_layout.addWidget(QtWidgets.QLabel("Точек на кадр"))
+        self.point_budget_selection = QtWidgets.QSpinBox()
+        self.point_budget_selection.setRange(0, 10**7)
+        self.point_budget_selection.setSingleStep(10000)
+        self.point_budget_selection.setValue(200000)
+        self.point_budget_selection.setSpecialValueText("все")
+        self.point_budget_selection.valueChanged.connect(self.point_budget_changed)
+        point_budget_layout.addWidget(self.point_budget_selection)
+
+        # add to left col
+        left_col.addLayout(point_budget_layout)
+
+        # Слияние столкнувшихся частиц: ближе этого расстояния частицы объединяются, 0 - выключено
+        merge_radius_layout = QtWidgets.QHBoxLayout()
+        merge_radius_layout.addWidget(QtWidgets.QLabel("Радиус слияния"))
+        self.merge_radius_selection = QtWidgets.QDoubleSpinBox()
+        self.merge_radius_selection.setRange(0, 10**6)
+        self.merge_radius_selection.setDecimals(6)
+        self.merge_radius_selection.setSingleStep(0.001)
+        self.merge_radius_selection.setValue(0)
+        self.merge_radius_selection.setSpecialValueText("нет")
+        merge_radius_layout.addWidget(self.merge_radius_selection)
+
+        # add to left col
+        left_col.addLayout(merge_radius_layout)
+
+        # Пробные частицы: лёгкие частицы (TEST_PARTICLE_RATIO от самой тяжёлой) только притягиваются, M*N вместо N^2
+        self.test_particles_selection = QtWidgets.QCheckBox("Пробные частицы")
+        self.test_particles_selection.setChecked(True)
+        self.test_particles_selection.setToolTip("Лёгкие частицы никого не притягивают: "
+                                                 "в разы быстрее для поясов астероидов и колец")
+
+        # add to left col
+        left_col.addWidget(self.test_particles_selection)
+
+        # частиц сейчас: уменьшается при слияниях
+        nbodies_layout = QtWidgets.QHBoxLayout()
+        nbodies_layout.addWidget(QtWidgets.QLabel("Частиц:"))
+        self.nbodies_show = QtWidgets.QLabel("0")
+        nbodies_layout.addWidget(self.nbodies_show)
+
+        # add to left col
+        left_col.addLayout(nbodies_layout)
+
+        # Камера: неподвижна, следит за центром масс или ещё и за размером сцены
+        camera_layout = QtWidgets.QHBoxLayout()
+        camera_layout.addWidget(QtWidgets.QLabel('Камера'))
+        self.camera_select = QtWidgets.QComboBox()
+        self.camera_select.addItems(CAMERA_MODES)
+        self.camera_select.currentTextChanged.connect(self.camera_mode_changed)
+        camera_layout.addWidget(self.camera_select)
+
+        # add to left col
+        left_col.addLayout(camera_layout)
+
         # Запуск / Пауза
         self.start_simulation_btn = QtWidgets.QPushButton('Начать')
         self.start_simulation_btn.setCheckable(True)
@@ -287,8 +340,20 @@ class MainWindow(QtWidgets.QMainWindow):
         # add to left col
         left_col.addLayout(fps_layout)
 
+        # шагов симуляции в секунду, считаются отдельно от кадров
+        steps_label = QtWidgets.QLabel("Шагов/с:")
+        self.steps_show = QtWidgets.QLabel("0")
+        steps_layout = QtWidgets.QHBoxLayout()
+        steps_layout.addWidget(steps_label)
+        steps_layout.addWidget(self.steps_show)
+
+        # add to left col
+        left_col.addLayout(steps_layout)
+
         # Флаг для определения того, когда нужно проводить симуляцию
         self.simulation_running = False
+        # Поток симуляции, пока он шагает (до join), None - симуляцию можно читать из интерфейса
+        self.simulation_worker = None
 
         # add to left col
         left_col.addWidget(self.start_simulation_btn)
@@ -319,38 +384,63 @@ class MainWindow(QtWidgets.QMainWindow):
             return
         
         # disable all
-        self.cuda_use_flag.setEnabled(False)
+        self.simulation_type_select.setEnabled(False)
+        self.integrator_select.setEnabled(False)
         self.dataPathLineEdit.setEnabled(False)
         self.selectFileBtn.setEnabled(False)
         self.loadDataFromFile.setEnabled(False)
         self.decimation_selection.setEnabled(False)
+        self.point_budget_selection.setEnabled(False)
+        self.merge_radius_selection.setEnabled(False)
+        self.test_particles_selection.setEnabled(False)
         self.fps_show.setText("0")
+        self.steps_show.setText("0")
 
         # изменить надпись на кнопке запуска так, чтоб было Продолжить/Пауза
         self.start_simulation_btn.setText('Пауза')
     
         self.simulation_running = True
-        use_cuda = self.cuda_use_flag.isChecked()
+        simulation_type = self.simulation_type_select.currentText()
         decimation = self.decimation_selection.value()
         time_step = self.time_step_select.value()
-
-        cuda_val = "CUDA" if use_cuda else 'C'
+        self.points_manager.simulation.integrator = self.integrator_select.currentText()
+        self.points_manager.simulation.merge_radius = self.merge_radius_selection.value()
+        self.points_manager.test_particle_ratio = TEST_PARTICLE_RATIO if self.test_particles_selection.isChecked() else 0.0
+
+        # симуляция идёт непрерывно в своём потоке (decimation шагов на кадр), а интерфейс рисует
+        # последний готовый кадр со своей скоростью, пропуская те, что не успел нарисовать
+        self.points_manager.point_budget = self.point_budget_selection.value()
+        worker = SimulationWorker(self.points_manager.simulation, decimation, time_step, simulation_type,
+                                  self.points_manager.level_of_detail)
         try:
-            ind = 0
-            time_prev = datetime.datetime.now()
-            while self.simulation_running:
-                ind += 1
-                old_data = self.points_manager.simulation.data
-                await self.points_manager.update(time_step, cuda_val)
-                new_data = self.points_manager.simulation.data
-                if ind % decimation == 0:
-                    self.plot3D.update_points()
-                    time_cur = datetime.datetime.now()
-                    delta = (time_cur - time_prev).total_seconds()
-                    time_prev = time_cur
-                    delta = (decimation / delta) * 100 // 100
-                    self.fps_show.setText(str(delta))
+            self.simulation_worker = worker
+            worker.start()
+            frames_drawn = 0
+            fps_meter = RateMeter()
+            steps_meter = RateMeter()
+            while self.simulation_running and worker.is_alive():
+                frame = worker.frames.latest()
+                if frame is not None:
+                    self.plot3D.update_points(frame.positions, frame.bounds, frame.indices, frame.origin)
+                    frames_drawn += 1
+                    self.nbodies_show.setText(str(len(frame.positions)))
+                if fps_meter.update(frames_drawn):
+                    self.fps_show.setText(f'{fps_meter.rate:.1f}')
+                if steps_meter.update(worker.steps):
+                    self.steps_show.setText(f'{steps_meter.rate:.1f}')
+                await asyncio.sleep(FRAME_INTERVAL)
+            worker.stop()
+            await asyncio.get_running_loop().run_in_executor(None, worker.join)
+            self.simulation_worker = None
+            if worker.error is not None:
+                raise worker.error
+            # последнее состояние, поток симуляции уже остановлен
+            self.plot3D.update_points()
         except Exception as e:
+            worker.stop()
+            if worker.is_alive():
+                worker.join()
+            self.simulation_worker = None
             self.simulation_running = False
             msg = QtWidgets.QMessageBox()
             msg.setIcon(QtWidgets.QMessageBox.Critical)
@@ -358,16 +448,30 @@ class MainWindow(QtWidgets.QMainWindow):
             msg.setDetailedText('Error: ' + str(e) + '\n' + 'Traceback: ' + traceback.format_exc())
             msg.exec_()
         finally:
-            self.cuda_use_flag.setEnabled(True)
+            self.simulation_type_select.setEnabled(True)
+            self.integrator_select.setEnabled(True)
             self.dataPathLineEdit.setEnabled(True)
             self.selectFileBtn.setEnabled(True)
             self.loadDataFromFile.setEnabled(True)
             self.decimation_selection.setEnabled(True)
+            self.point_budget_selection.setEnabled(True)
+            self.merge_radius_selection.setEnabled(True)
+            self.test_particles_selection.setEnabled(True)
             self.start_simulation_btn.setText('Продолжить')
 
     def stop_simulation(self):
         self.simulation_running = False
 
+    def point_budget_changed(self, value):
+        if self.points_manager:
+            self.points_manager.point_budget = value
+            self.update_plot()
+
+    def camera_mode_changed(self, mode):
+        self.plot3D.camera_follow.mode = mode
+        if self.simulation_worker is None:
+            self.update_plot()
+
     def min_point_size_changed(self):
         val = self.min_size_select.value()
         if self.max_size_select.value() < val:
@@ -380,7 +484,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def openSelectFileWithData(self):
         options = QtWidgets.QFileDialog.Options()
-        fileName, _ = QtWidgets.QFileDialog.getOpenFileName(self, "QFileDialog.getSaveFileName()","","Text Files (*.txt);; CSV Files (*.csv)", options=options)
+        fileName, _ = QtWidgets.QFileDialog.getOpenFileName(self, "QFileDialog.getSaveFileName()","","Text Files (*.txt);; CSV Files (*.csv);; Binary scenes (*.nbody)", options=options)
         if fileName:
             self.dataPathLineEdit.setText(fileName)
     
@@ -392,7 +496,9 @@ class MainWindow(QtWidgets.QMainWindow):
             msg.setText(f'Указанный файл \"{fileName}\" не найден')
             msg.exec_()
         try:
-            self.points_manager = parse_points(fileName, self.max_size_select.value(), self.max_size_select.value())
+            self.points_manager = parse_points(fileName, self.max_size_select.value(), self.max_size_select.value(),
+                                               TEST_PARTICLE_RATIO if self.test_particles_selection.isChecked() else 0.0)
+            self.points_manager.point_budget = self.point_budget_selection.value()
             self.max_size_select.setEnabled(True)
             self.min_size_select.setEnabled(True)
             self.plot3D.points_manager = self.points_manager
@@ -414,17 +520,25 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def update_plot(self):
         self.plot3D.update_points()
+        if self.points_manager:
+            self.nbodies_show.setText(str(len(self.points_manager.simulation.positions)))
 
 
 from qasync import QEventLoop, QThreadExecutor
 import asyncio
 if __name__ == '__main__':
-    app = QtWidgets.QApplication(sys.argv)
+    import argparse
+    parser = argparse.ArgumentParser(description='N-body simulation viewer')
+    parser.add_argument('--renderer', default='vispy', choices=['vispy', 'matplotlib'],
+                        help='vispy (OpenGL, falls back to matplotlib when VisPy is not installed) or matplotlib')
+    args, qt_args = parser.parse_known_args()
+
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
     app.setStyle('Fusion')
     loop = QEventLoop(app)
     asyncio.set_event_loop(loop)
     
-    ex = MainWindow()
+    ex = MainWindow(renderer=args.renderer)
     ex.show()
 
     with loop:
@@ -0,0 +1,119 @@
+'''
+Scaling report of the fast multipole method ('FMM' accelerations) against the direct sum ('C').
+
+For every Plummer sphere size and expansion order prints the relative acceleration error
+|a_fmm - a_exact| / |a_exact| (median, 99th percentile, max) on a random sample of bodies, the exact
+accelerations summed in float64 over all bodies with the softening of the engine, and the time of one
+force evaluation of both backends. The direct sum is only run up to --max-direct bodies, above that
+its time is extrapolated as N^2 from the largest measured size. The last lines give the smallest N at
+which the FMM of every order is faster than the direct sum.
+
+    python fmm_scaling.py
+    python fmm_scaling.py --sizes 10000 100000 1000000 --orders 2 4 8 --theta 0.4 --json report.json
+'''
+import numpy as np
+
+from numpy_simulator import SOFTENING_SQUARED
+from reports import relative_errors, report_parser, save_report, timed
+from simulator import Simulation
+from synthetic_scenes import plummer_scene
+
+DEFAULT_SIZES = [1000, 4000, 16000, 64000]
+DEFAULT_ORDERS = [2, 4, 6, 8]
+
+
+def exact_accelerations(positions, weights, sample, chunk=64):
+    '''float64 direct sum on the bodies of `sample`'''
+    positions = positions.astype(np.float64)
+    weights = weights.astype(np.float64)
+    acc = np.empty((len(sample), 3))
+    for start in range(0, len(sample), chunk):
+        part = sample[start:start + chunk]
+        d = positions[None, :, :] - positions[part, None, :]
+        dist_sqr = np.einsum('ijk,ijk->ij', d, d) + SOFTENING_SQUARED
+        s = weights[None, :] / (dist_sqr * np.sqrt(dist_sqr))
+        s[np.arange(len(part)), part] = 0
+        acc[start:start + chunk] = np.einsum('ij,ijk->ik', s, d)
+    return acc
+
+
+def size_report(n, orders, theta, max_direct, sample_size, threads, seed, direct_times):
+    positions, velocities, weights = plummer_scene(n, seed)
+    simulation = Simulation(positions, velocities, weights, num_threads=threads)
+    simulation.theta = theta
+    sample = np.sort(np.random.default_rng(seed).choice(n, min(sample_size, n), replace=False))
+    exact = exact_accelerations(simulation.positions, np.asarray(weights, dtype=np.float32), sample)
+
+    if n <= max_direct:
+        direct_time = timed(simulation.accelerations, 'C')[1]
+        direct_times[n] = direct_time
+        extrapolated = False
+    else:
+        m = max(direct_times)
+        direct_time = direct_times[m] * (n / m) ** 2
+        extrapolated = True
+
+    rows = []
+    for order in orders:
+        simulation.fmm_order = order
+        acc, fmm_time = timed(simulation.accelerations, 'FMM')
+        errors = relative_errors(acc[sample], exact)
+        rows.append({
+            'nbodies': n,
+            'order': order,
+            'theta': theta,
+            'median_error': float(np.median(errors)),
+            'p99_error': float(np.percentile(errors, 99)),
+            'max_error': float(np.max(errors)),
+            'fmm_time': fmm_time,
+            'direct_time': direct_time,
+            'direct_extrapolated': extrapolated,
+            'speedup': direct_time / max(fmm_time, 1e-9),
+        })
+    return rows
+
+
+def crossover(rows, order):
+    '''Smallest measured N from which on the FMM of this order stays faster than the direct sum'''
+    faster = [(row['nbodies'], row['speedup'] > 1) for row in rows if row['order'] == order]
+    result = None
+    for n, fast in reversed(sorted(faster)):
+        if not fast:
+            break
+        result = n
+    return result
+
+
+def print_report(rows, orders):
+    print(f'{"N":>9}{"order":>7}{"median":>11}{"p99":>11}{"max":>11}{"fmm, s":>10}{"direct, s":>11}{"speedup":>10}')
+    for row in rows:
+        mark = '*' if row['direct_extrapolated'] else ' '
+        print(f'{row["nbodies"]:>9}{row["order"]:>7}{row["median_error"]:>11.2e}{row["p99_error"]:>11.2e}'
+              f'{row["max_error"]:>11.2e}{row["fmm_time"]:>10.3f}{row["direct_time"]:>10.3f}{mark}{row["speedup"]:>10.2f}')
+    if any(row['direct_extrapolated'] for row in rows):
+        print('* direct sum time extrapolated as N^2')
+    for order in orders:
+        n = crossover(rows, order)
+        print(f'order {order}: faster than the direct sum ' + (f'from N = {n}' if n else 'at no measured N'))
+
+
+if __name__ == '__main__':
+    parser = report_parser('FMM accuracy and time against the direct sum', scenes=False)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='N of the Plummer scenes')
+    parser.add_argument('--orders', type=int, nargs='+', default=DEFAULT_ORDERS, help='expansion orders')
+    parser.add_argument('--theta', type=float, default=0.5, help='opening angle')
+    parser.add_argument('--max-direct', type=int, default=20000, help='largest N the direct sum is run on')
+    parser.add_argument('--sample', type=int, default=512, help='bodies the error is measured on')
+    parser.add_argument('--threads', type=int, default=0, help='OpenMP threads, 0 - all cores')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = sorted(args.sizes)
+    # без хотя бы одного прямого замера экстраполировать не от чего
+    max_direct = max(args.max_direct, sizes[0])
+    report, direct_times = [], {}
+    for n in sizes:
+        report.extend(size_report(n, args.orders, args.theta, max_direct, args.sample, args.threads, args.seed, direct_times))
+
+    print_report(report, args.orders)
+    save_report(report, args.json)
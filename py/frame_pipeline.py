@@ -0,0 +1,138 @@
+'''
+Simulation and rendering decoupled: the simulation steps continuously in a worker thread and publishes
+positions into a latest-frame slot, the UI takes the newest frame whenever it is ready to draw one.
+
+The native engines release the GIL for the whole Simulation.run call, so a thread is enough for the
+simulation and the UI to run in parallel, and the frames are shared memory without any serialization.
+Frames the UI was too slow to draw are overwritten (dropped), a slow frame never stalls the simulation
+and a slow step never stalls the UI.
+
+    worker = SimulationWorker(simulation, steps_per_frame=100, timestep=0.01, type='C')
+    worker.start()
+    ...
+    frame = worker.frames.latest()      # None if nothing new since the last call
+    if frame is not None:
+        canvas.update_points(frame.positions, frame.bounds, frame.indices, frame.origin)
+    ...
+    worker.stop()
+'''
+import threading, time
+import numpy as np
+
+from numpy_simulator import merged_origin
+
+
+class Frame:
+    '''Buffers of nbodies particles, a frame of a simulation whose particles were merged uses the first ones'''
+    def __init__(self, nbodies):
+        self._positions = np.zeros((nbodies, 3), dtype=np.float32)
+        self._origin = np.zeros(nbodies, dtype=np.intc)
+        self.positions = self._positions
+        self.step = 0
+        self.time = 0.0
+        self.sequence = 0
+        self.bounds = None      # Simulation.bounds() of the positions, computed by the producer
+        self.indices = None     # particles to draw (level_of_detail), None - all of them
+        self.origin = None      # Simulation.origin of the positions, None - no particle was merged
+
+
+class LatestFrame:
+    '''Latest-frame slot between one producer and one consumer: three preallocated frame buffers.
+
+    The producer fills a buffer that is neither the newest one nor the one the consumer is drawing, then
+    publishes it; the consumer takes the newest buffer and keeps it until its next latest() call. Copies
+    happen outside the lock, which only guards the exchange of the buffer indices.
+    '''
+    def __init__(self, nbodies):
+        self._frames = [Frame(nbodies) for _ in range(3)]
+        self._lock = threading.Lock()
+        self._newest = None
+        self._reading = None
+        self._writing = 0
+        self.published = 0
+        self.consumed = 0   # published - consumed frames were dropped (or are waiting)
+
+    def publish(self, positions, step, time, bounds=None, indices=None, origin=None):
+        frame = self._frames[self._writing]
+        nbodies = len(positions)
+        frame.positions = frame._positions[:nbodies]
+        np.copyto(frame.positions, positions)
+        # origin of the simulation is compacted in place by the next merge, the frame keeps its own copy
+        frame.origin = None
+        if origin is not None:
+            frame.origin = frame._origin[:nbodies]
+            np.copyto(frame.origin, origin)
+        frame.step = step
+        frame.time = time
+        frame.bounds = bounds
+        frame.indices = indices
+        with self._lock:
+            self.published += 1
+            frame.sequence = self.published
+            self._newest = self._writing
+            self._writing = next(i for i in range(3) if i != self._newest and i != self._reading)
+
+    def latest(self):
+        '''The newest frame, None if it was already returned. Valid until the next call'''
+        with self._lock:
+            if self._newest is None or self._newest == self._reading:
+                return None
+            self._reading = self._newest
+            self.consumed += 1
+            return self._frames[self._reading]
+
+
+class SimulationWorker(threading.Thread):
+    '''Steps the simulation until stop(), publishing a frame every steps_per_frame steps.
+
+    While the worker runs, the simulation belongs to it: the UI only reads frames. Errors of the
+    simulation end the worker and are kept in error. The bounds of every frame are computed here, once
+    per published frame (not per step), so the UI thread never scans the positions for the camera.
+    So is the selection of the particles to draw, when a level_of_detail.LevelOfDetail is given.
+    Once particles were merged (Simulation.merge_radius) frames carry the origin of their particles.
+    '''
+    def __init__(self, simulation, steps_per_frame, timestep, type='C', level_of_detail=None):
+        super().__init__(name='SimulationWorker', daemon=True)
+        self.simulation = simulation
+        self.steps_per_frame = steps_per_frame
+        self.timestep = timestep
+        self.type = type
+        self.level_of_detail = level_of_detail
+        self.frames = LatestFrame(simulation.positions.shape[0])
+        self.steps = 0
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                self.simulation.run(self.steps_per_frame, self.timestep, type=self.type)
+                self.steps += self.steps_per_frame
+                positions, bounds = self.simulation.positions, self.simulation.bounds()
+                origin = merged_origin(self.simulation.origin)
+                indices = self.level_of_detail.select(positions, bounds, origin) if self.level_of_detail else None
+                self.frames.publish(positions, self.simulation.step, self.simulation.time, bounds, indices, origin)
+        except Exception as error:
+            self.error = error
+
+    def stop(self):
+        '''Asks the worker to stop after the current run of steps_per_frame steps, join() waits for it'''
+        self._stop_event.set()
+
+
+class RateMeter:
+    '''Rate of a growing counter (frames drawn, steps made) over the last `period` seconds'''
+    def __init__(self, period=0.5):
+        self.period = period
+        self.rate = 0.0
+        self._start_time = time.perf_counter()
+        self._start_count = 0
+
+    def update(self, count):
+        '''Returns True when the rate was recomputed'''
+        now = time.perf_counter()
+        if now - self._start_time < self.period:
+            return False
+        self.rate = (count - self._start_count) / (now - self._start_time)
+        self._start_time, self._start_count = now, count
+        return True
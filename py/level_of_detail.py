@@ -0,0 +1,88 @@
+'''
+Level of detail of the renderer: at most about `budget` particles are drawn per frame, whatever N is.
+
+Massive bodies (the star and the planets of TestData_v2) are always drawn. The light particles are
+subsampled by a density cap on a cells^3 grid over the view cube (camera_follow.view_target): every
+cell keeps at most `cap` particles, the cap is the largest one that fits the budget, so sparse regions
+are drawn in full and only dense ones are thinned.
+
+Every particle has a fixed random priority, a cell keeps the particles of the lowest priorities. The
+same particles stay on screen from frame to frame (no flicker), only the ones moving between cells of
+different density come and go. One selection is a few vectorized O(N) passes, no sorting of particles.
+
+    lod = LevelOfDetail(weights, budget=200000)
+    indices = lod.select(positions, simulation.bounds())   # sorted indices, None - draw everything
+
+The weights are those of the particles the simulation started with; after merges (Simulation.merge_radius)
+select takes the origin of the current particles too.
+'''
+import numpy as np
+
+from camera_follow import view_target
+from numpy_simulator import scene_bounds
+
+PARTICLES_PER_CELL = 16
+
+
+def density_cap(counts, budget):
+    '''Largest cap with sum(min(counts, cap)) == budget, counts sorted ascending; inf if all of them fit'''
+    if np.sum(counts) <= budget:
+        return np.inf
+    before = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    # total of the cap counts[j]: the cells below j in full, the rest cut to counts[j]
+    above = len(counts) - np.arange(len(counts))
+    j = np.searchsorted(before + counts * above, budget)
+    return (budget - before[j]) / above[j]
+
+
+class LevelOfDetail:
+    '''
+    budget          particles to draw per frame, 0 - all of them
+    cells           grid cells along every axis of the view cube, by default about PARTICLES_PER_CELL
+                    particles of the budget per cell: a finer grid caps every occupied cell at a particle
+                    or two and flattens the whole scene to a uniform haze
+    massive_ratio   particles at least this fraction of the heaviest one are always drawn, the lightest
+                    mass of the scene never is (a scene of equal masses has no massive bodies)
+    max_massive     at most this many of the heaviest ones
+    '''
+    def __init__(self, weights, budget=200000, cells=None, margin=3.0, massive_ratio=1e-7, max_massive=1024, seed=0):
+        self.weights = weights
+        self.budget = budget
+        self.cells = cells
+        self.margin = margin
+        self._priority = np.random.default_rng(seed).random(len(weights), dtype=np.float32)
+
+        self._massive = np.zeros(len(weights), dtype=bool)
+        if len(weights):
+            massive = np.flatnonzero((weights >= massive_ratio * weights.max()) & (weights > weights.min()))
+            massive = massive[np.argsort(weights[massive], kind='stable')[::-1][:max_massive]]
+            self._massive[massive] = True
+        self.massive = int(np.count_nonzero(self._massive))
+
+    def select(self, positions, bounds=None, origin=None):
+        '''Sorted indices of the particles to draw, None if all of them fit into the budget.
+
+        origin - index of every particle of positions among the initial ones (Simulation.origin), None - the same
+        '''
+        if not self.budget or len(positions) <= self.budget:
+            return None
+        if bounds is None:
+            bounds = scene_bounds(positions, self.weights)
+        center, half_size = view_target(bounds, self.margin)
+        cells = self.cells or max(int(np.cbrt(self.budget / PARTICLES_PER_CELL)), 1)
+
+        # частицы за пределами куба попадают в крайние ячейки
+        grid = (positions - (center - half_size).astype(np.float32)) * np.float32(cells / (2 * half_size))
+        grid = np.clip(grid, 0, cells - 1, out=grid).astype(np.int32)
+        cell = (grid[:, 0] * cells + grid[:, 1]) * cells + grid[:, 2]
+        priority, massive = (self._priority, self._massive) if origin is None else (self._priority[origin], self._massive[origin])
+        # массивные тела в отдельной последней ячейке, они рисуются всегда и в плотность не входят
+        cell[massive] = cells ** 3
+        counts = np.bincount(cell, minlength=cells ** 3 + 1)
+
+        occupied = counts[:-1]
+        cap = density_cap(np.sort(occupied[occupied > 0]), max(self.budget - counts[-1], 0))
+        counts[-1] = 1
+        keep = priority * counts[cell] < cap
+        keep |= massive
+        return np.flatnonzero(keep)
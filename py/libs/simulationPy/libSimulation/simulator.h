@@ -1,19 +1,188 @@
 #pragma once
+#ifdef NBODY_NO_CUDA
+// CPU-only build: same layout as float3 from CUDA's vector_types.h
+struct float3 {
+	float x, y, z;
+};
+struct double3 {
+	double x, y, z;
+};
+struct float4 {
+	float x, y, z, w;
+};
+#else
 #include <vector_types.h>
+#endif
+
+#ifdef _WIN32
 #define EXTERN_DLL_EXPORT extern "C" __declspec(dllexport)
+#else
+#define EXTERN_DLL_EXPORT extern "C"
+#endif
+
+// Where the newest particle state lives (bit flags of SimulationData::stateLocation)
+#define STATE_ON_HOST 1
+#define STATE_ON_DEVICE 2
+
+// SimulationData::integrator
+#define INTEGRATOR_EULER 0		// semi-implicit (symplectic) Euler, 1st order
+#define INTEGRATOR_LEAPFROG 1	// kick-drift-kick leapfrog, 2nd order
+#define INTEGRATOR_YOSHIDA4 2	// Yoshida / Forest-Ruth composition of leapfrogs, 4th order
+
+// Force pass that produced SimulationData::accelerations for the current positions
+#define FORCES_NONE 0
+#define FORCES_DIRECT 1
+#define FORCES_BARNES_HUT 2
+#define FORCES_DIRECT_DEVICE 3
+#define FORCES_NUMPY 4			// set by the NumPy backend of the Python wrapper
+#define FORCES_FMM 5
+
+// SimulationData::precision
+#define PRECISION_FLOAT32 0		// float32 state and force sums, the fastest
+#define PRECISION_KAHAN 1		// float32 state, force sums in double, compensated (Kahan) kicks and drifts
+#define PRECISION_FLOAT64 2		// float64 state (positions64 / velocities64), force sums in double
+
+// SimulationData::fmmOrder
+#define MIN_FMM_ORDER 1
+#define MAX_FMM_ORDER 10
+
+// Finest block time step level: timeStep / 2^MAX_TIMESTEP_LEVEL
+#define MAX_TIMESTEP_LEVEL 20
+
+// Conserved quantities of the current state, see computeDiagnostics
+struct SimulationDiagnostics {
+	double mass;
+	double kineticEnergy;
+	double potentialEnergy;		// 1/2 sum of weight * potential: the softened potential of the force pass (test particles count fully)
+	double momentum[3];
+	double angularMomentum[3];	// about the origin
+	double centerOfMass[3];
+	double centerOfMassVelocity[3];
+};
 
-struct Particle {
-	float3 pos;
-	float3 vel;
-	float weight;
-} ;
+// Extent of the particle cloud for the camera of the renderers, see computeBounds
+struct SceneBounds {
+	double min[3];
+	double max[3];
+	double centerOfMass[3];
+	double radius;		// root mean square distance of the particles from the center of mass
+};
 
+// Structure of arrays: each field of all particles is one contiguous buffer, so that
+// positions/velocities map directly onto (nbodies, 3) float32 arrays on the Python side.
+// The buffers belong to the caller and never move: a step computes the accelerations into
+// a separate buffer first and then updates velocities and positions in place.
 struct SimulationData {
-	Particle* particleData;
+	float3* positions;
+	float3* velocities;
+	float* weights;
+	float3* accelerations;		// work buffer of the force pass
+	double3* positions64;		// PRECISION_FLOAT64: the state itself, positions / velocities are its rounded copies
+	double3* velocities64;
+	float3* positionErrors;		// PRECISION_KAHAN: low order bits lost by the summation of positions / velocities
+	float3* velocityErrors;
+	float* potentials;			// if given, the host force passes also store the potential at every particle here
+	int* origins;				// if given, compacted along with the particles by mergeCollisions: the original index of every particle
+	int* sources;				// if given, only particles sources[0..nsources) (ascending) pull, see nsources
 	int nbodies;
+	int nsources;		// with sources: the other particles are test particles, pulled by the sources but pulling nothing,
+						// a force pass costs nbodies * nsources instead of nbodies^2
+	int nthreads;		// CPU threads used by the CPU paths, 0 - all available cores
+	float theta;		// Barnes-Hut and FMM opening angle
+	int fmmOrder;		// degree of the FMM multipole and local expansions, MIN_FMM_ORDER..MAX_FMM_ORDER
+	int stateLocation;
+	int integrator;
+	int forcesSource;	// accelerations of the end of the last step are reused by the next one
+	int precision;
+	int timestepLevels;		// > 0 - block time steps: particles step by timeStep / 2^level, level <= timestepLevels
+	float timestepAccuracy;	// eta of the block time step criterion dt = eta * |a| / |da/dt|
+	float mergeRadius;		// collision stage: particles closer than this are merged by mergeCollisions, 0 - never
+
+	// Owned by the library, created on first use and freed by releaseSimulationData
+	float3* devicePositions;	// particles stay resident on the device between CUDA steps
+	float3* deviceVelocities;
+	float* deviceWeights;
+	float3* deviceAccelerations;
+	int* deviceSources;			// copy of sources, uploaded with the rest of the state
+	void* barnesHutTree;
+	void* fmmTree;
+	void* blockTimesteps;
+	void* collisionGrid;
 };
 
-EXTERN_DLL_EXPORT 
+// Copies the newest positions and velocities to the host buffers if they currently live on the device only
+EXTERN_DLL_EXPORT
+int syncSimulationToHost(SimulationData* data);
+// Frees the buffers the library allocated for data (host buffers belong to the caller)
+EXTERN_DLL_EXPORT
+void releaseSimulationData(SimulationData* data);
+
+EXTERN_DLL_EXPORT
 int updateSimulationCuda(SimulationData* data, float timeStep);
 EXTERN_DLL_EXPORT 
-int updateSimulationC(SimulationData* data, float timeStep);
\ No newline at end of file
+int updateSimulationC(SimulationData* data, float timeStep);
+EXTERN_DLL_EXPORT
+int updateSimulationBarnesHut(SimulationData* data, float timeStep);
+// Fast multipole method: O(N) force passes of error ~ theta^fmmOrder, see fmm.cpp
+EXTERN_DLL_EXPORT
+int updateSimulationFmm(SimulationData* data, float timeStep);
+
+// Accelerations of every particle without advancing the simulation (acc holds nbodies items)
+EXTERN_DLL_EXPORT
+int computeAccelerationsC(SimulationData* data, float3* acc);
+EXTERN_DLL_EXPORT
+int computeAccelerationsBarnesHut(SimulationData* data, float3* acc);
+EXTERN_DLL_EXPORT
+int computeAccelerationsFmm(SimulationData* data, float3* acc);
+// Accelerations of the particles active[0..nactive) only by the host backend of forcesSource (FORCES_DIRECT,
+// FORCES_BARNES_HUT or FORCES_FMM): acc[k] of particle active[k], data->potentials of them if given. Every
+// particle (every source) still pulls; a process of a distributed run computes its own share this way.
+EXTERN_DLL_EXPORT
+int computeActiveAccelerations(SimulationData* data, int forcesSource, const int* active, int nactive, float3* acc);
+// Locally essential tree of the particles for each of nboxes boxes of targets (boxes: min xyz, max xyz of each):
+// the Barnes-Hut cells accepted for every point of the box as point masses (center of mass and mass), the bodies
+// of the leaves reached as they are, all as x, y, z, weight. The items of box b are counts[b] consecutive ones,
+// after those of the boxes before it. Only the first capacity items are written: if sum(counts) is larger the call
+// is repeated with a larger buffer. A distributed run sends the items of a box to the process that owns it.
+EXTERN_DLL_EXPORT
+int essentialTree(SimulationData* data, float theta, int nboxes, const float* boxes, int* counts, float4* items, int capacity);
+// Accelerations by a CPU emulation of the tiled CUDA force kernel: the grid of ceil(nbodies / blockSize) blocks,
+// every block staging tiles of blockSize j-bodies the way the kernel stages them in shared memory. The kernel and
+// this reference share the summation code and order, so they agree bit for bit (the kernel is built without
+// FMA contraction). Float32 only; returns 1 if blockSize is not in [1, 1024].
+EXTERN_DLL_EXPORT
+int computeAccelerationsTiled(SimulationData* data, int blockSize, float3* acc);
+
+// Energy, momenta and center of mass of the current state, in double. The potential energy comes from the
+// potentials of the last host force pass (data->potentials must be given); if the last step did not leave
+// them for the current positions (no step yet, CUDA) a direct-sum pass is made first.
+EXTERN_DLL_EXPORT
+int computeDiagnostics(SimulationData* data, SimulationDiagnostics* diagnostics);
+
+// Bounding box, center of mass and radius of the current positions in one parallel pass. Meant to be called
+// once per drawn frame, not by the steps themselves: a frame usually spans many steps.
+EXTERN_DLL_EXPORT
+int computeBounds(SimulationData* data, SceneBounds* bounds);
+
+// Number of particles on every block time step level (counts holds timestepLevels + 1 items) and the number
+// of single-particle force evaluations made by the block time step steps so far.
+// Returns 1 if no block time step was made yet.
+EXTERN_DLL_EXPORT
+int timestepLevelOccupancy(SimulationData* data, int* counts, long long* forceEvaluations);
+
+// Per-particle levels of the block time steps (levels holds nbodies items) and the force evaluations counter,
+// to save and restore them exactly (checkpoints). get returns 1 if no block time step was made yet,
+// set returns 1 if a level is outside [0, timestepLevels]; the levels set are used by the next step.
+EXTERN_DLL_EXPORT
+int getTimestepLevels(SimulationData* data, int* levels, long long* forceEvaluations);
+EXTERN_DLL_EXPORT
+int setTimestepLevels(SimulationData* data, const int* levels, long long forceEvaluations);
+
+// Collision stage, meant to be called after a step: every cluster of particles closer than data->mergeRadius
+// to each other becomes one body of their total mass, center of mass and momentum, in the place of the
+// heaviest member. The arrays of the particles (and origins) are compacted in place, keeping the order;
+// data->nbodies gets smaller by *removed. sources are renumbered the same way, a merged body pulls if
+// one of its members did. Found in O(N) by a spatial hash, see collisions.cpp.
+// Returns 1 if mergeRadius < 0.
+EXTERN_DLL_EXPORT
+int mergeCollisions(SimulationData* data, int* removed);
\ No newline at end of file
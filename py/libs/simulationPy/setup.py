@@ -1,16 +1,84 @@
-from distutils.core import setup, Extension
+import os, shutil, sys
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
 from Cython.Build import cythonize
 from numpy import get_include as np_get_include
 
+# The NBodySimulation sources are compiled directly into the module on every platform. The module is placed
+# into py/, next to the scripts that import it:
+#   python setup.py build_ext
+# simulator.cu (the 'CUDA' type) is compiled with nvcc when the CUDA toolkit is found (CUDA_PATH / CUDA_HOME
+# or nvcc on PATH), otherwise, or with NBODY_NO_CUDA=1 in the environment, the module is CPU-only.
+PY_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+NBODY_SOURCES = os.path.join(os.path.dirname(PY_DIRECTORY), 'NBodySimulation')
+CPU_SOURCES = ['simulator_cpu.cpp', 'barnes_hut.cpp', 'fmm.cpp', 'block_timesteps.cpp', 'collisions.cpp']
+CUDA_SOURCES = ['simulator.cu']
+
+
+def find_cuda():
+    '''Root of the CUDA toolkit, None without nvcc'''
+    if os.environ.get('NBODY_NO_CUDA'):
+        return None
+    for root in (os.environ.get('CUDA_PATH'), os.environ.get('CUDA_HOME')):
+        if root and os.path.exists(os.path.join(root, 'bin', 'nvcc.exe' if sys.platform == 'win32' else 'nvcc')):
+            return root
+    nvcc = shutil.which('nvcc')
+    return os.path.dirname(os.path.dirname(nvcc)) if nvcc else None
+
+
+class build_ext_cuda(build_ext):
+    '''build_ext that compiles the .cu sources of an extension with nvcc and links their objects'''
+    def build_extension(self, ext):
+        cuda_sources = [source for source in ext.sources if source.endswith('.cu')]
+        ext.sources = [source for source in ext.sources if not source.endswith('.cu')]
+        os.makedirs(self.build_temp, exist_ok=True)
+        for source in cuda_sources:
+            name = os.path.splitext(os.path.basename(source))[0] + ('.obj' if sys.platform == 'win32' else '.o')
+            obj = os.path.join(self.build_temp, name)
+            # same flags as NBodySimulation.vcxproj: no fused multiply-add, so 'CUDA' matches 'C' more closely
+            self.spawn([os.path.join(CUDA_ROOT, 'bin', 'nvcc'), '-c', source, '-o', obj, '-O3', '--fmad=false',
+                        '-Xcompiler', '/MD' if sys.platform == 'win32' else '-fPIC']
+                       + ['-I' + directory for directory in ext.include_dirs])
+            ext.extra_objects.append(obj)
+        super().build_extension(ext)
+
+
+CUDA_ROOT = find_cuda()
+sources = ['simulator.pyx'] + [os.path.join(NBODY_SOURCES, name) for name in CPU_SOURCES]
+include_dirs = ['.', np_get_include(), NBODY_SOURCES]
+if CUDA_ROOT:
+    sources += [os.path.join(NBODY_SOURCES, name) for name in CUDA_SOURCES]
+    include_dirs.append(os.path.join(CUDA_ROOT, 'include'))
+    define_macros = []
+    # the static runtime: the module does not depend on a cudart DLL on the search path
+    library_dirs = [os.path.join(CUDA_ROOT, 'lib', 'x64') if sys.platform == 'win32' else os.path.join(CUDA_ROOT, 'lib64')]
+    libraries = ['cudart_static'] + ([] if sys.platform == 'win32' else ['dl', 'rt', 'pthread'])
+else:
+    define_macros = [('NBODY_NO_CUDA', None)]
+    library_dirs = []
+    libraries = []
+
+if sys.platform == 'win32':
+    extra_compile_args = ['/O2', '/openmp']
+    extra_link_args = []
+else:
+    extra_compile_args = ['-O3', '-fopenmp']
+    extra_link_args = ['-fopenmp']
+
 ext = Extension(
     name='simulator',
-    sources=['simulator.pyx'],
-    language="c++",  
-    library_dirs=['libSimulation'],
-    libraries=['NBodySimulation'],
-    include_dirs=['.', np_get_include(), 'C:/Program Files/NVIDIA GPU Computing Toolkit/CUDA/v11.0/include']
+    sources=sources,
+    language="c++",
+    define_macros=define_macros,
+    include_dirs=include_dirs,
+    library_dirs=library_dirs,
+    libraries=libraries,
+    extra_compile_args=extra_compile_args,
+    extra_link_args=extra_link_args
 )
 
 setup(
-    ext_modules = cythonize(ext)
-)
\ No newline at end of file
+    ext_modules = cythonize(ext),
+    cmdclass = {'build_ext': build_ext_cuda},
+    options = {'build_ext': {'build_lib': PY_DIRECTORY}}
+)
@@ -0,0 +1,567 @@
+'''
+Pure NumPy implementation of the N-body step.
+
+Mirrors NBodySimulation (G = 1, softeningSquared = 0.01, the same kick/drift integrator
+schemes as particle_update.h), but works on contiguous (N, 3) float32 arrays and needs neither the
+native NBodySimulation library nor CUDA.
+
+All-pairs differences are evaluated in blocks of rows, so the temporary (rows, N) arrays
+never exceed BLOCK_ELEMENTS pairs and memory stays bounded even for 10^5 bodies.
+'''
+import itertools
+import numpy as np
+
+from checkpoint import write_checkpoint, read_checkpoint
+
+G = 1.0
+SOFTENING_SQUARED = 0.01
+
+YOSHIDA_W1 = 1 / (2 - 2 ** (1 / 3))
+YOSHIDA_W0 = -2 ** (1 / 3) / (2 - 2 ** (1 / 3))
+
+# (kicks, drifts) in fractions of the time step, the same schemes as integratorScheme in particle_update.h:
+# kick[0], drift[0], forces, kick[1], ..., drift[-1], forces, kick[-1]
+INTEGRATORS = {
+    'EULER': ((1.0, 0.0), (1.0,)),
+    'LEAPFROG': ((0.5, 0.5), (1.0,)),
+    'YOSHIDA4': ((YOSHIDA_W1 / 2, (YOSHIDA_W0 + YOSHIDA_W1) / 2, (YOSHIDA_W0 + YOSHIDA_W1) / 2, YOSHIDA_W1 / 2),
+                 (YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1)),
+}
+
+# Number of pairwise interactions evaluated at once: 2^16 pairs * float32 = 256 KB per temporary
+BLOCK_ELEMENTS = 2 ** 16
+
+# Bits of every cell coordinate in the keys of the spatial hash of close_pairs: cells 2^21 apart share a key,
+# which only adds candidates that fail the distance test
+CELL_KEY_BITS = 21
+
+# Records of Simulation.diagnostics_log(): step, time and the fields of SimulationDiagnostics (simulator.h)
+DIAGNOSTICS_DTYPE = np.dtype([
+    ('step', np.int64),
+    ('time', np.float64),
+    ('mass', np.float64),
+    ('kinetic_energy', np.float64),
+    ('potential_energy', np.float64),
+    ('momentum', np.float64, (3,)),
+    ('angular_momentum', np.float64, (3,)),
+    ('center_of_mass', np.float64, (3,)),
+    ('center_of_mass_velocity', np.float64, (3,)),
+], align=True)
+
+
+def as_state_array(values, columns=None, copy=True):
+    '''A state buffer of the simulation: float32, C-contiguous, (N, columns) or (N,).
+
+    By default a private copy, the simulation must not write into the caller's arrays. With copy=False
+    the array itself becomes the buffer (e.g. a np.memmap of a binary scene), so it has to be already
+    laid out as one: steps then update it in place.
+    '''
+    shape = (-1, columns) if columns else (-1,)
+    if copy:
+        return np.array(values, dtype=np.float32, order='C').reshape(shape)
+    if not (isinstance(values, np.ndarray) and values.dtype == np.float32 and values.flags.c_contiguous
+            and values.flags.writeable and values.ndim == len(shape) and (not columns or values.shape[1] == columns)):
+        raise ValueError(f'copy=False needs writable C-contiguous float32 arrays of shape {shape}')
+    return values
+
+
+def _read_only_view(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def compute_accelerations(positions, weights, out=None, block_elements=BLOCK_ELEMENTS, potentials=None, sources=None):
+    '''Softened all-pairs gravitational accelerations for every body.
+
+    positions: (N, 3) float32, weights: (N,) float32. Result is written to out (N, 3) if given.
+    If potentials (N,) is given, the softened potential at every body is stored there as well.
+    If sources (ascending indices) is given only those bodies pull, the others are test particles: N * len(sources) pairs.
+    '''
+    nbodies = positions.shape[0]
+    if out is None:
+        out = np.empty_like(positions)
+    pulling = np.arange(nbodies) if sources is None else np.asarray(sources)
+    nsources = len(pulling)
+    if nbodies == 0 or nsources == 0:
+        out[...] = 0
+        if potentials is not None:
+            potentials[...] = 0
+        return out
+
+    rows = max(1, min(nbodies, block_elements // nsources))
+    dtype = positions.dtype
+    weights = (weights * G).astype(dtype)[None, :]
+    softening = dtype.type(SOFTENING_SQUARED)
+    # Per-axis columns keep every temporary a plain contiguous (rows, N) block
+    columns = [np.ascontiguousarray(positions[:, axis]) for axis in range(3)]
+    source_columns = columns
+    if sources is not None:
+        weights = weights[:, pulling]
+        source_columns = [column[pulling] for column in columns]
+
+    diff = np.empty((3, rows, nsources), dtype=dtype)
+    dist = np.empty((rows, nsources), dtype=dtype)
+    tmp = np.empty((rows, nsources), dtype=dtype)
+    potential = np.empty((rows, nsources), dtype=dtype) if potentials is not None else None
+    for start in range(0, nbodies, rows):
+        stop = min(start + rows, nbodies)
+        d = diff[:, :stop - start]
+        r = dist[:stop - start]
+        t = tmp[:stop - start]
+
+        # dx = p.pos - r.pos
+        for axis in range(3):
+            np.subtract(columns[axis][start:stop, None], source_columns[axis][None, :], out=d[axis])
+        np.multiply(d[0], d[0], out=r)
+        for axis in (1, 2):
+            np.multiply(d[axis], d[axis], out=t)
+            r += t
+        r += softening
+
+        # magi = G * r.weight / dist^3; the i == j term is put infinitely far so it neither pulls nor adds potential
+        np.sqrt(r, out=t)
+        first, last = np.searchsorted(pulling, (start, stop))
+        t[pulling[first:last] - start, np.arange(first, last)] = np.inf
+        if potentials is not None:
+            p = potential[:stop - start]
+            np.divide(weights, t, out=p)
+            potentials[start:stop] = -p.sum(axis=1)
+        t *= r
+        np.divide(weights, t, out=r)
+        for axis in range(3):
+            out[start:stop, axis] = np.einsum('ij,ij->i', r, d[axis])
+    np.negative(out, out=out)
+    return out
+
+
+def update_simulation_numpy(positions, velocities, weights, time_step, accelerations=None, integrator='EULER', forces_ready=False,
+                            potentials=None, sources=None):
+    '''Advances (positions, velocities) in place by one step of the integrator, like updateSimulationC.
+
+    If forces_ready, accelerations already holds the forces of the current positions. On return it holds
+    the forces of the new positions, so the next step can reuse them, and potentials (if given) their potentials.
+    sources: the bodies that pull, see compute_accelerations.
+    '''
+    kicks, drifts = INTEGRATORS[integrator]
+    if accelerations is None:
+        accelerations = np.empty_like(positions)
+        forces_ready = False
+    if not forces_ready:
+        compute_accelerations(positions, weights, out=accelerations, potentials=potentials, sources=sources)
+
+    scalar = positions.dtype.type
+    for kick, drift in zip(kicks, drifts):
+        velocities += accelerations * scalar(kick * time_step)
+        positions += velocities * scalar(drift * time_step)
+        compute_accelerations(positions, weights, out=accelerations, potentials=potentials, sources=sources)
+    if kicks[-1]:
+        velocities += accelerations * scalar(kicks[-1] * time_step)
+    return accelerations
+
+
+def state_diagnostics(positions, velocities, weights, potentials, record, sources=None):
+    '''Fills the conserved quantities of a DIAGNOSTICS_DTYPE record, like computeDiagnostics in simulator_cpu.cpp'''
+    positions = positions.astype(np.float64)
+    velocities = velocities.astype(np.float64)
+    weights = weights.astype(np.float64)
+    mass = weights.sum()
+    momentum = weights @ velocities
+    record['mass'] = mass
+    record['kinetic_energy'] = 0.5 * weights @ np.einsum('ij,ij->i', velocities, velocities)
+    record['potential_energy'] = 0.5 * weights @ potentials
+    if sources is not None:
+        # test particles are pulled without pulling back: their potential energy counts fully
+        test = np.ones(len(weights), dtype=bool)
+        test[sources] = False
+        record['potential_energy'] += 0.5 * weights[test] @ potentials[test]
+    record['momentum'] = momentum
+    record['angular_momentum'] = weights @ np.cross(positions, velocities)
+    record['center_of_mass'] = weights @ positions / mass if mass else 0
+    record['center_of_mass_velocity'] = momentum / mass if mass else 0
+
+
+def diagnostics_dict(record):
+    '''Simulation.diagnostics() of a DIAGNOSTICS_DTYPE record: the conserved quantities and the total energy'''
+    result = {name: record[name].copy() if record[name].shape else float(record[name]) for name in DIAGNOSTICS_DTYPE.names[2:]}
+    result['energy'] = result['kinetic_energy'] + result['potential_energy']
+    return result
+
+
+def scene_bounds(positions, weights):
+    '''Simulation.bounds(): bounding box, center of mass and rms distance from it of the positions'''
+    if not len(positions):
+        return {'min': np.zeros(3), 'max': np.zeros(3), 'center_of_mass': np.zeros(3), 'radius': 0.0}
+    positions = positions.astype(np.float64)
+    center_of_mass = weights @ positions / np.sum(weights, dtype=np.float64)
+    return {
+        'min': positions.min(axis=0),
+        'max': positions.max(axis=0),
+        'center_of_mass': center_of_mass,
+        'radius': float(np.sqrt(np.mean(np.sum((positions - center_of_mass) ** 2, axis=1)))),
+    }
+
+
+def pulling_particles(weights, test_particle_mass):
+    '''Ascending indices of the particles at least test_particle_mass heavy (Simulation.sources),
+    None if every particle is, or test_particle_mass is 0
+    '''
+    if not test_particle_mass:
+        return None
+    sources = np.flatnonzero(np.asarray(weights) >= test_particle_mass)
+    return sources if len(sources) < len(weights) else None
+
+
+def merged_origin(origin):
+    '''Simulation.origin if any particle was merged, None while it is still arange(nbodies)'''
+    # origin is ascending: it is arange(n) exactly when its last index is n - 1
+    return origin if len(origin) and origin[-1] != len(origin) - 1 else None
+
+
+def _cell_keys(cells):
+    mask = (1 << CELL_KEY_BITS) - 1
+    return ((cells[:, 0] & mask) << (2 * CELL_KEY_BITS)) | ((cells[:, 1] & mask) << CELL_KEY_BITS) | (cells[:, 2] & mask)
+
+
+def close_pairs(positions, radius):
+    '''(i, j) with i < j of the particles closer than radius: a spatial hash of cells of size radius, every
+    particle is only compared with the ones of the 27 cells around its own
+    '''
+    cells = np.floor(positions / np.float64(radius)).astype(np.int64)
+    keys = _cell_keys(cells)
+    order = np.argsort(keys, kind='stable')
+    unique, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    radius_squared = np.float32(radius) * np.float32(radius)
+    pairs_i, pairs_j = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        neighbours = _cell_keys(cells + offset)
+        cell = np.minimum(np.searchsorted(unique, neighbours), len(unique) - 1)
+        i = np.flatnonzero(unique[cell] == neighbours)
+        sizes = counts[cell[i]]
+        # every particle i against every particle of its neighbour cell
+        within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        j = order[np.repeat(starts[cell[i]], sizes) + within]
+        i = np.repeat(i, sizes)
+        candidates = j > i
+        i, j = i[candidates], j[candidates]
+        d = positions[j] - positions[i]
+        close = np.einsum('ij,ij->i', d, d) < radius_squared
+        pairs_i.append(i[close])
+        pairs_j.append(j[close])
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def merge_collisions(positions, velocities, weights, radius, pulls=None):
+    '''Collision stage of Simulation.merge_radius, like mergeCollisions in collisions.cpp.
+
+    Every cluster of particles closer than radius to each other becomes one body of their total mass, center
+    of mass and momentum, written in place over its heaviest member. Returns the ascending indices of the
+    particles left: the merged bodies and the particles that touched nobody.
+    pulls (N,) bool, if given, is written in place as well: a merged body pulls if one of its members did.
+    '''
+    nbodies = len(positions)
+    if not radius or nbodies < 2:
+        return np.arange(nbodies)
+    i, j = close_pairs(positions, radius)
+    if not len(i):
+        return np.arange(nbodies)
+
+    # clusters: every particle gets the smallest index of its cluster
+    labels = np.arange(nbodies)
+    while True:
+        joined = labels.copy()
+        np.minimum.at(joined, i, labels[j])
+        np.minimum.at(joined, j, labels[i])
+        joined = joined[joined]
+        if np.array_equal(joined, labels):
+            break
+        labels = joined
+
+    members = np.flatnonzero(np.isin(labels, labels[labels != np.arange(nbodies)]))
+    cluster = labels[members]
+    m = weights[members].astype(np.float64)
+    # the heaviest member of every cluster (the first one of equal masses) keeps the merged body
+    ranked = members[np.lexsort((members, -m, cluster))]
+    heaviest = ranked[np.concatenate(([True], labels[ranked][1:] != labels[ranked][:-1]))]
+    heaviest_of = np.empty(nbodies, dtype=np.intp)
+    heaviest_of[labels[heaviest]] = heaviest
+
+    mass = np.bincount(cluster, weights=m, minlength=nbodies)[labels[heaviest], None]
+    for state in (positions, velocities):
+        sums = np.zeros((nbodies, 3))
+        np.add.at(sums, cluster, m[:, None] * state[members])
+        # massless clusters keep the state of the kept particle
+        state[heaviest] = np.where(mass > 0, sums[labels[heaviest]] / np.where(mass > 0, mass, 1), state[heaviest])
+    weights[heaviest] = mass[:, 0]
+    if pulls is not None:
+        pulled = np.zeros(nbodies, dtype=bool)
+        np.logical_or.at(pulled, cluster, pulls[members])
+        pulls[heaviest] = pulled[labels[heaviest]]
+
+    removed = members[heaviest_of[cluster] != members]
+    return np.setdiff1d(np.arange(nbodies), removed, assume_unique=True)
+
+
+class DiagnosticsLog:
+    '''Ring buffer of the last len(records) DIAGNOSTICS_DTYPE records, one after every `every`-th step'''
+    def __init__(self, every, capacity):
+        if every <= 0 or capacity <= 0:
+            raise ValueError('every and capacity should be > 0')
+        self.every = every
+        self.records = np.zeros(capacity, dtype=DIAGNOSTICS_DTYPE)
+        self.count = 0  # records written so far, the next one goes to records[count % capacity]
+
+    def next_index(self):
+        index = self.count % len(self.records)
+        self.count += 1
+        return index
+
+    def ordered(self):
+        '''Copy of the kept records, oldest first'''
+        capacity = len(self.records)
+        if self.count <= capacity:
+            return self.records[:self.count].copy()
+        start = self.count % capacity
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+
+class Simulation:
+    '''Drop-in replacement for simulator.Simulation that only supports the 'NUMPY' type.
+
+    Used when the native module can not be imported (not built, see libs/simulationPy/setup.py).
+    '''
+    def __init__(self, particlesPositions, particlesVelocities, particlesWeights, integrator='EULER', copy=True, merge_radius=0.0,
+                 test_particle_mass=0.0):
+        self._positions = as_state_array(particlesPositions, 3, copy)
+        self._velocities = as_state_array(particlesVelocities, 3, copy)
+        self._weights = as_state_array(particlesWeights, copy=copy)
+        assert self._positions.shape[0] == self._velocities.shape[0] == self._weights.shape[0]
+        self._accelerations = np.empty_like(self._positions)
+        self._potentials = np.empty(self._weights.shape, dtype=np.float32)
+        self._origins = np.arange(self._weights.shape[0], dtype=np.intc)
+        self._forces_ready = False
+        self._step = 0
+        self._time = 0.0
+        self._log = None
+        self._trajectory = None
+        self._checkpoints = None
+        self.integrator = integrator
+        self.merge_radius = merge_radius
+        self.test_particle_mass = test_particle_mass
+
+    def _make_views(self):
+        self._positions_view = _read_only_view(self._positions)
+        self._velocities_view = _read_only_view(self._velocities)
+        self._weights_view = _read_only_view(self._weights)
+        self._origins_view = _read_only_view(self._origins)
+        self._sources_view = _read_only_view(self._sources) if self._sources is not None else None
+
+    @property
+    def integrator(self):
+        return self._integrator
+
+    @integrator.setter
+    def integrator(self, value):
+        if value not in INTEGRATORS:
+            raise ValueError(f'Undefined integrator "{value}". Use one of {", ".join(INTEGRATORS)}.')
+        self._integrator = value
+
+    @property
+    def merge_radius(self):
+        '''Collision stage after every step: particles closer than merge_radius are merged, 0 - off'''
+        return self._merge_radius
+
+    @merge_radius.setter
+    def merge_radius(self, value):
+        if not value >= 0:
+            raise ValueError('merge_radius should be >= 0')
+        self._merge_radius = float(value)
+
+    @property
+    def origin(self):
+        '''Index of every current particle among the initial ones, ascending (see merge_radius)'''
+        return self._origins_view
+
+    @property
+    def test_particle_mass(self):
+        '''Particles lighter than this only get pulled, 0 - every particle pulls (see simulator.Simulation)'''
+        return self._test_particle_mass
+
+    @test_particle_mass.setter
+    def test_particle_mass(self, value):
+        if not value >= 0:
+            raise ValueError('test_particle_mass should be >= 0')
+        self._test_particle_mass = float(value)
+        self._set_sources(pulling_particles(self._weights, value))
+
+    @property
+    def sources(self):
+        '''Ascending indices of the particles that pull, None if all of them do'''
+        return self._sources_view
+
+    @sources.setter
+    def sources(self, value):
+        if value is not None:
+            value = np.unique(np.asarray(value, dtype=np.intp))
+            if len(value) and (value[0] < 0 or value[-1] >= len(self._weights)):
+                raise ValueError(f'sources should be indices of the {len(self._weights)} particles')
+        self._set_sources(value)
+
+    def _set_sources(self, sources):
+        self._sources = None if sources is None else np.array(sources, dtype=np.intc)
+        self._forces_ready = False
+        self._make_views()
+
+    def _merge_collisions(self):
+        pulls = None
+        if self._sources is not None:
+            pulls = np.zeros(len(self._positions), dtype=bool)
+            pulls[self._sources] = True
+        keep = merge_collisions(self._positions, self._velocities, self._weights, self._merge_radius, pulls)
+        if len(keep) == len(self._positions):
+            return
+        self._positions, self._velocities, self._weights = self._positions[keep], self._velocities[keep], self._weights[keep]
+        self._accelerations, self._potentials = self._accelerations[keep], self._potentials[keep]
+        self._origins = self._origins[keep]
+        if pulls is not None:
+            self._sources = np.flatnonzero(pulls[keep]).astype(np.intc)
+        self._forces_ready = False
+        self._make_views()
+
+    @property
+    def positions(self):
+        '''Read-only view of the current positions, follows the simulation as it advances'''
+        return self._positions_view
+
+    @property
+    def data(self):
+        return self._positions_view, self._velocities_view, self._weights_view
+
+    def copy(self):
+        '''Snapshot of (positions, velocities, weights) that is not affected by further steps'''
+        return self._positions.copy(), self._velocities.copy(), self._weights.copy()
+
+    def accelerations(self, type='NUMPY'):
+        if type != 'NUMPY':
+            raise Exception(f'Undefined type "{type}". Native simulator is not available, use "NUMPY" instead.')
+        return compute_accelerations(self._positions, self._weights, sources=self._sources)
+
+    def update(self, timestep=0.001, type='NUMPY'):
+        if type == 'NUMPY':
+            update_simulation_numpy(self._positions, self._velocities, self._weights, timestep,
+                                    self._accelerations, self._integrator, self._forces_ready, self._potentials, self._sources)
+            self._forces_ready = True
+        else:
+            raise Exception(f'Undefined type "{type}". Native simulator is not available, use "NUMPY" instead.')
+        if self._merge_radius:
+            self._merge_collisions()
+        self._step += 1
+        self._time += timestep
+        if self._log and self._step % self._log.every == 0:
+            self._fill_diagnostics(self._log.records[self._log.next_index()])
+        if self._trajectory and self._step % self._trajectory.every == 0:
+            self._trajectory.record(self._step, self._time, self._positions, self._velocities, self._origins)
+        if self._checkpoints and self._step % self._checkpoints.every == 0:
+            self._checkpoints.checkpoint(self)
+
+    def _fill_diagnostics(self, record):
+        if not self._forces_ready:
+            compute_accelerations(self._positions, self._weights, out=self._accelerations, potentials=self._potentials,
+                                  sources=self._sources)
+            self._forces_ready = True
+        record['step'] = self._step
+        record['time'] = self._time
+        state_diagnostics(self._positions, self._velocities, self._weights, self._potentials, record, self._sources)
+
+    def diagnostics(self):
+        '''Total, kinetic and potential energy, momentum, angular momentum and center of mass of the current state'''
+        record = np.zeros(1, dtype=DIAGNOSTICS_DTYPE)[0]
+        self._fill_diagnostics(record)
+        return diagnostics_dict(record)
+
+    @property
+    def step(self):
+        return self._step
+
+    @property
+    def time(self):
+        return self._time
+
+    def record_trajectory(self, writer):
+        '''Passes every writer.every-th step to writer.record (a trajectory.TrajectoryWriter), None - stop'''
+        self._trajectory = writer
+
+    def save_checkpoint(self, path):
+        '''Saves the full state to path atomically (see checkpoint), load_checkpoint continues it exactly'''
+        arrays = {'positions': self._positions, 'velocities': self._velocities, 'weights': self._weights,
+                  'origins': self._origins}
+        if self._sources is not None:
+            arrays['sources'] = self._sources
+        if self._forces_ready:
+            arrays['accelerations'] = self._accelerations
+            arrays['potentials'] = self._potentials
+        write_checkpoint(path, arrays, {
+            'step': self._step,
+            'time': self._time,
+            'integrator': self._integrator,
+            'precision': 'FLOAT32',
+            'timestep_levels': 0,
+            'merge_radius': self._merge_radius,
+            'test_particle_mass': self._test_particle_mass,
+            'forces': 'NUMPY' if self._forces_ready else None,
+        })
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        '''A new simulation in the state saved by save_checkpoint'''
+        arrays, meta = read_checkpoint(path)
+        if meta['precision'] != 'FLOAT32' or meta['timestep_levels']:
+            raise Exception(f'The checkpoint needs the native simulator ({meta["precision"]} precision, '
+                            f'{meta["timestep_levels"]} time step levels)')
+        simulation = cls(arrays['positions'], arrays['velocities'], arrays['weights'], meta['integrator'],
+                         merge_radius=meta.get('merge_radius', 0.0), test_particle_mass=meta.get('test_particle_mass', 0.0))
+        if 'origins' in arrays:
+            simulation._origins[...] = arrays['origins']
+        simulation._set_sources(arrays.get('sources'))
+        # only accelerations of the NumPy force pass give the same next step
+        if meta['forces'] == 'NUMPY':
+            simulation._accelerations[...] = arrays['accelerations']
+            simulation._potentials[...] = arrays['potentials']
+            simulation._forces_ready = True
+        simulation._step = meta['step']
+        simulation._time = meta['time']
+        return simulation
+
+    def auto_checkpoint(self, policy):
+        '''Passes every policy.every-th step to policy.checkpoint (a checkpoint.CheckpointPolicy), None - stop'''
+        self._checkpoints = policy
+
+    def bounds(self):
+        '''Bounding box, center of mass and radius (rms distance from the center of mass) of the positions'''
+        return scene_bounds(self._positions, self._weights)
+
+    def log_diagnostics(self, every, capacity=1024):
+        '''Records diagnostics after every `every`-th step into a ring buffer of the last capacity records, 0 - stop'''
+        self._log = DiagnosticsLog(every, capacity) if every else None
+
+    def diagnostics_log(self):
+        '''Logged records (DIAGNOSTICS_DTYPE), oldest first'''
+        return self._log.ordered() if self._log else np.zeros(0, dtype=DIAGNOSTICS_DTYPE)
+
+    def run(self, n_steps, timestep=0.001, record_every=0, type='NUMPY', out=None):
+        '''Advances the simulation by n_steps, storing positions after every record_every-th step into out'''
+        if n_steps < 0 or record_every < 0:
+            raise ValueError('n_steps and record_every should be >= 0')
+        n_snapshots = n_steps // record_every if record_every else 0
+        if out is None:
+            out = np.empty((n_snapshots, self._positions.shape[0], 3), dtype=np.float32)
+        elif out.shape != (n_snapshots, self._positions.shape[0], 3):
+            raise ValueError(f'out should have shape {(n_snapshots, self._positions.shape[0], 3)}, got {out.shape}')
+
+        for step in range(1, n_steps + 1):
+            self.update(timestep, type)
+            if record_every and step % record_every == 0:
+                # merged particles leave NaN rows at the end
+                out[step // record_every - 1, :len(self._positions)] = self._positions
+                out[step // record_every - 1, len(self._positions):] = np.nan
+        return out
@@ -16,7 +16,7 @@ Use color to make different group of opject. For example White for sun and blue
 mass factor defines the size of the point on a plot. 
 It's fair to point out that size in this case grows as log(mass) and all sizes are linearly projected to line [min_marker_size; max_marker_size]
 '''
-import functools, asyncio
+import functools, asyncio, warnings
 
 def run_in_executor(f):
     @functools.wraps(f)
@@ -26,14 +26,33 @@ def run_in_executor(f):
 
     return inner
 
-import pandas as pd, numpy as np
-from simulator import Simulation
+import numpy as np
+from numpy_simulator import INTEGRATORS, merged_origin
+from scene_format import is_binary_scene, read_scene, read_tsv_scene, group_order
+from trajectory import TrajectoryWriter
+from level_of_detail import LevelOfDetail
+try:
+    from simulator import Simulation
+    SIMULATION_TYPES = ['C', 'CUDA', 'BARNES_HUT', 'FMM', 'NUMPY']
+except ImportError as error:
+    # Модуль simulator не собран (libs/simulationPy/setup.py): остаётся только движок на NumPy
+    warnings.warn(f'Native simulator is not available ({error}), only the "NUMPY" type works. '
+                  'Build it with python setup.py build_ext in libs/simulationPy')
+    from numpy_simulator import Simulation
+    SIMULATION_TYPES = ['NUMPY']
+
+# Частицы легче TEST_PARTICLE_RATIO * масса самой тяжёлой - пробные: их притягивают остальные, сами они
+# никого не притягивают (Simulation.test_particle_mass). Астероиды рядом со звездой, но не планеты
+TEST_PARTICLE_RATIO = 1e-9
 
 class PointsGroupsIterator:
     def __init__(self, positions, points_groups_data):
         self.positions = positions
         self.points_group_data = points_groups_data
         self.ind = 0
+
+    def __iter__(self):
+        return self
     
     def __next__(self):
         if self.ind == len(self.points_group_data):
@@ -42,12 +61,11 @@ class PointsGroupsIterator:
 
         self.ind += 1
 
-        inds = group_data['inds'].values
         color = group_data['color']
         size = group_data['size']
 
-
-        positions = self.positions[inds] 
+        # частицы группы лежат подряд: срез, а не копия
+        positions = self.positions[group_data['start']:group_data['stop']]
         return {
             'xs': positions[:, 0],
             'ys': positions[:, 1],
@@ -63,42 +81,48 @@ class PointsManager:
                         velocities: NDArray[Float32], 
                         weights: NDArray[Float32], 
                         colors: NDArray[Float32],
-                        min_point_size: float, max_point_size: float):
+                        min_point_size: float, max_point_size: float,
+                        copy: bool = True, test_particle_ratio: float = 0.0):
         
         self._min_point_size = min_point_size
         self._max_point_size = max_point_size
+
+        # Частицы один раз упорядочиваются по цвету, а внутри цвета по массе. Размер точки не убывает с массой,
+        # поэтому при любых min/max размерах каждая группа (размер, цвет) - непрерывный отрезок частиц.
+        # order[i] - номер частицы i в исходных данных; уже упорядоченные данные не копируются
+        self.order = group_order(weights, colors)
+        if np.any(self.order != np.arange(len(self.order))):
+            positions, velocities = positions[self.order], velocities[self.order]
+            weights, colors = weights[self.order], colors[self.order]
         self._weights = weights
         self._colors = colors
 
-        self.points_groups = []
-        self.simulation = Simulation(positions, velocities, weights)
-        data = self.simulation.positions
-        
+        self.trajectory = None
+        self.level_of_detail = None
+        self.simulation = Simulation(positions, velocities, weights, copy=copy)
+        self.test_particle_ratio = test_particle_ratio
+
         self._sizes = self.__generate_sizes(weights, self._min_point_size, self._max_point_size)
 
-        self._points_groups = self.__generate_groups(self._sizes, self._weights, self._colors)
-        # for (size, r, g, b), group_df in data.groupby(['Size', 'R', 'G', 'B']):
-        #     self.points_groups.append({
-        #         'inds': group_df['Inds'],
-        #         'color': (r, g, b)
-        #     })
-    
-    def __generate_groups(self, sizes, weights, colors):
-        assert len(sizes) == len(weights) == len(colors)
-        data = pd.DataFrame()
-        data['Inds'] = np.arange(len(sizes))
-        data['Size'] = sizes
-        data['R'] = colors[:, 0]
-        data['G'] = colors[:, 1]
-        data['B'] = colors[:, 2]
-        
-        points_groups = []
-        for (size, r, g, b), group_df in data.groupby(['Size', 'R', 'G', 'B']):
-            points_groups.append({
-                'inds': group_df['Inds'],
-                'size': size,
-                'color': (r, g, b)
-            })
+        self._points_groups = self.__generate_groups(self._sizes, self._colors)
+
+    def __generate_groups(self, sizes, colors):
+        assert len(sizes) == len(colors)
+        if not len(sizes):
+            return []
+        # границы отрезков, где меняется размер или цвет
+        changes = np.any(colors[1:] != colors[:-1], axis=1) | (sizes[1:] != sizes[:-1])
+        starts = np.concatenate(([0], np.flatnonzero(changes) + 1))
+        stops = np.concatenate((starts[1:], [len(sizes)]))
+
+        points_groups = [{
+            'start': start,
+            'stop': stop,
+            'size': sizes[start],
+            'color': tuple(colors[start])
+        } for start, stop in zip(starts, stops)]
+        # порядок отрисовки как раньше: по размеру, затем по цвету
+        points_groups.sort(key=lambda group: (group['size'], *group['color']))
         return points_groups
 
     @property
@@ -111,7 +135,7 @@ class PointsManager:
         self._min_point_size = value
         self._min_point_size, self._max_point_size = min(self._min_point_size, self._max_point_size), max(self._min_point_size, self._max_point_size)
         self._sizes = self.__generate_sizes(self._weights, self._min_point_size, self._max_point_size)
-        self._points_groups = self.__generate_groups(self._sizes, self._weights, self._colors)
+        self._points_groups = self.__generate_groups(self._sizes, self._colors)
 
     @property
     def max_point_size(self):
@@ -123,28 +147,122 @@ class PointsManager:
         self._max_point_size = value
         self._min_point_size, self._max_point_size = min(self._min_point_size, self._max_point_size), max(self._min_point_size, self._max_point_size)
         self._sizes = self.__generate_sizes(self._weights, self._min_point_size, self._max_point_size)
-        self._points_groups = self.__generate_groups(self._sizes, self._weights, self._colors)
+        self._points_groups = self.__generate_groups(self._sizes, self._colors)
 
     def set_min_max_points_sizes(self, min_size, max_size):
         self._max_point_size = float(max_size)
         self._min_point_size = float(min_size)
         self._min_point_size, self._max_point_size = min(self._min_point_size, self._max_point_size), max(self._min_point_size, self._max_point_size)
         self._sizes = self.__generate_sizes(self._weights, self._min_point_size, self._max_point_size)
-        self._points_groups = self.__generate_groups(self._sizes, self._weights, self._colors)
+        self._points_groups = self.__generate_groups(self._sizes, self._colors)
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @property
+    def sizes(self):
+        '''Point size of every particle'''
+        return self._sizes
+
+    @property
+    def colors(self):
+        '''rgb color of every particle, (N, 3) in [0, 1]'''
+        return self._colors
+
+    @property
+    def point_budget(self):
+        '''Particles drawn per frame at most (about), 0 - all of them, see level_of_detail.LevelOfDetail'''
+        return self.level_of_detail.budget if self.level_of_detail else 0
+
+    @point_budget.setter
+    def point_budget(self, value):
+        value = int(value)
+        if not value:
+            self.level_of_detail = None
+        elif self.level_of_detail is None:
+            self.level_of_detail = LevelOfDetail(self._weights, value)
+        else:
+            self.level_of_detail.budget = value
+
+    @property
+    def test_particle_ratio(self):
+        '''Particles lighter than this times the heaviest loaded one are test particles, 0 - none (see TEST_PARTICLE_RATIO)'''
+        return self._test_particle_ratio
+
+    @test_particle_ratio.setter
+    def test_particle_ratio(self, value):
+        self._test_particle_ratio = value
+        mass = np.float32(value * self._weights.max()) if len(self._weights) else np.float32(0)
+        # переклассификация сбрасывает силы, поэтому только при изменении
+        if mass != self.simulation.test_particle_mass:
+            self.simulation.test_particle_mass = mass
+
+    def origin(self):
+        '''Index of every current particle of the simulation among the loaded ones (Simulation.origin),
+        None while no particle was merged. A merged body keeps the size and color of its heaviest particle
+        '''
+        return merged_origin(self.simulation.origin)
+
+    def select(self, positions=None, bounds=None, origin=None):
+        '''Sorted indices of the particles to draw (see point_budget), None - all of them'''
+        if self.level_of_detail is None:
+            return None
+        if positions is None:
+            positions, bounds, origin = self.simulation.positions, self.simulation.bounds(), self.origin()
+        return self.level_of_detail.select(positions, bounds, origin)
 
     def total_groups(self):
-        return len(self.points_groups)
+        return len(self._points_groups)
 
     def __iter__(self) -> PointsGroupsIterator:
-        iterator = PointsGroupsIterator(self.simulation.positions, self._points_groups)
-        return iterator
+        return self.groups()
+
+    def groups(self, positions=None, indices=None, origin=None) -> PointsGroupsIterator:
+        '''Groups of the given positions (e.g. a frame of frame_pipeline), the current ones of the simulation by default.
+
+        indices - sorted indices of the particles to draw (select()), the groups are then slices of positions[indices]
+        origin - index of every particle of positions among the loaded ones (origin()), None - no particle was merged
+        '''
+        if positions is None:
+            positions, origin = self.simulation.positions, self.origin()
+        if indices is None and origin is None:
+            return PointsGroupsIterator(positions, self._points_groups)
+        starts = [group['start'] for group in self._points_groups]
+        stops = [group['stop'] for group in self._points_groups]
+        # слияния и выборка сохраняют порядок частиц, поэтому каждая группа остаётся непрерывным отрезком
+        if origin is not None:
+            starts, stops = np.searchsorted(origin, starts), np.searchsorted(origin, stops)
+        if indices is not None:
+            starts, stops = np.searchsorted(indices, starts), np.searchsorted(indices, stops)
+            positions = positions[indices]
+        points_groups = [dict(group, start=start, stop=stop) for group, start, stop in zip(self._points_groups, starts, stops)]
+        return PointsGroupsIterator(positions, points_groups)
     
+    def record_trajectory(self, path, every=1, **options):
+        '''Starts recording every `every`-th step of the simulation to the directory path, see trajectory.TrajectoryWriter'''
+        self.stop_recording()
+        self.trajectory = TrajectoryWriter(path, every, **options)
+        self.simulation.record_trajectory(self.trajectory)
+        return self.trajectory
+
+    def stop_recording(self):
+        '''Detaches the trajectory writer and waits until everything recorded is on disk'''
+        if self.trajectory is not None:
+            self.simulation.record_trajectory(None)
+            self.trajectory.close()
+            self.trajectory = None
+
     @run_in_executor
     def update(self, timestep=0.01, type='C'):
         self.simulation.update(timestep, type)
 
+    @run_in_executor
+    def run(self, n_steps, timestep=0.01, type='C', record_every=0):
+        return self.simulation.run(n_steps, timestep, record_every=record_every, type=type)
+
     def __generate_sizes(self, weights, min_size, max_size):
-        if min_size == max_size:
+        if min_size == max_size or not len(weights):
             return  np.full(weights.shape, min_size)
         
         sizes = np.log(weights)
@@ -156,34 +274,28 @@ class PointsManager:
             sizes[...] = min_size
         return sizes
 
-def parse_points(file_path, min_size=0.5, max_size=30) -> PointsManager:
+def parse_points(file_path, min_size=0.5, max_size=30, test_particle_ratio=TEST_PARTICLE_RATIO) -> PointsManager:
+    '''Loads a scene: a tab-separated text file or a binary .nbody one (see scene_format).
+
+    A binary scene is memory-mapped copy-on-write straight into the Simulation buffers, nothing is
+    parsed or copied and the file on disk is never modified. Particles lighter than test_particle_ratio
+    times the heaviest one become test particles (PointsManager.test_particle_ratio), 0 - none.
+    '''
     assert min_size > 0
     assert max_size >= min_size
 
-    dtypes = {
-        'px': np.float32,
-        'py': np.float32,
-        'pz': np.float32,
-        'vx': np.float32,
-        'vy': np.float32,
-        'vz': np.float32,
-        'm': np.float32,
-        'r': np.uint8,
-        'g': np.uint8,
-        'b': np.uint8
-    }
-
-    df = pd.read_csv(file_path, delimiter='\t', dtype=dtypes)
-    print(df)
-    # df.columns = ['px', 'py', 'pz', 'vx', 'vy', 'vz', 'w', 'r', 'g', 'b']
-    print(df.columns)
-    assert np.all(df['m'] > 0), 'mass should allways be positive (>0)'
-    
-    pm = PointsManager(df[['px', 'py', 'pz']].values, 
-                        df[['vx', 'vy', 'vz']].values, 
-                        df['m'].values,
-                        df[['r', 'g', 'b']].astype(float).values / 255.0,
-                        min_size, max_size)
-    
+    if is_binary_scene(file_path):
+        positions, velocities, weights, colors = read_scene(file_path)
+        copy = False
+    else:
+        positions, velocities, weights, colors = read_tsv_scene(file_path)
+        copy = True
+    assert np.all(weights > 0), 'mass should allways be positive (>0)'
+
+    pm = PointsManager(positions,
+                        velocities,
+                        weights,
+                        colors.astype(float) / 255.0,
+                        min_size, max_size, copy=copy, test_particle_ratio=test_particle_ratio)
+
     return pm
-    
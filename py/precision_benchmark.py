@@ -0,0 +1,76 @@
+'''
+Throughput against energy drift of the precision modes of Simulation.
+
+For every scene and every precision ('FLOAT32', 'KAHAN', 'FLOAT64') runs the same number of steps and
+prints the steps per second and the relative drift of the total energy |E - E0| / |E0|, the energy being
+computed in float64 from copy() (the float64 state itself with 'FLOAT64').
+
+    python precision_benchmark.py
+    python precision_benchmark.py "TestData_v2/7 planet system.txt" --steps 100000 --dt 0.05 --integrator YOSHIDA4
+'''
+import os
+import numpy as np
+
+from numpy_simulator import SOFTENING_SQUARED, G
+from points_parser import parse_points
+from reports import report_parser, save_report, scene_files, timed
+PRECISIONS = ['FLOAT32', 'KAHAN', 'FLOAT64']
+
+
+def total_energy(positions, velocities, weights):
+    '''Kinetic + softened potential energy in float64, the potential of the force pass of the engine'''
+    positions = positions.astype(np.float64)
+    velocities = velocities.astype(np.float64)
+    weights = weights.astype(np.float64)
+    energy = 0.5 * np.sum(weights * np.sum(velocities ** 2, axis=1))
+    for i in range(len(weights) - 1):
+        dist = np.sqrt(np.sum((positions[i + 1:] - positions[i]) ** 2, axis=1) + SOFTENING_SQUARED)
+        energy -= G * weights[i] * np.sum(weights[i + 1:] / dist)
+    return energy
+
+
+def scene_report(path, precisions, steps, dt, integrator, type):
+    rows = []
+    for precision in precisions:
+        if type == 'NUMPY' and precision == 'KAHAN':
+            continue
+        simulation = parse_points(path).simulation
+        simulation.integrator = integrator
+        simulation.precision = precision
+        start_energy = total_energy(*simulation.copy())
+
+        elapsed = timed(simulation.run, steps, dt, type=type)[1]
+
+        energy = total_energy(*simulation.copy())
+        rows.append({
+            'scene': os.path.basename(path),
+            'nbodies': simulation.positions.shape[0],
+            'precision': precision,
+            'steps_per_second': steps / max(elapsed, 1e-9),
+            'energy_drift': float(abs(energy - start_energy) / abs(start_energy)) if start_energy else 0.0,
+        })
+    return rows
+
+
+def print_report(rows):
+    print(f'{"scene":<36}{"N":>7}{"precision":>11}{"steps/s":>12}{"dE/E":>11}')
+    for row in rows:
+        print(f'{row["scene"]:<36}{row["nbodies"]:>7}{row["precision"]:>11}'
+              f'{row["steps_per_second"]:>12.1f}{row["energy_drift"]:>11.2e}')
+
+
+if __name__ == '__main__':
+    parser = report_parser('Precision modes: throughput against energy drift')
+    parser.add_argument('--precisions', nargs='+', default=PRECISIONS, choices=PRECISIONS)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--dt', type=float, default=0.5)
+    parser.add_argument('--integrator', default='LEAPFROG')
+    parser.add_argument('--type', default='C', choices=['C', 'BARNES_HUT', 'FMM', 'NUMPY'])
+    args = parser.parse_args()
+
+    report = []
+    for scene in scene_files(args.scenes):
+        report.extend(scene_report(scene, args.precisions, args.steps, args.dt, args.integrator, args.type))
+
+    print_report(report)
+    save_report(report, args.json)
@@ -0,0 +1,67 @@
+'''
+Helpers shared by the report and benchmark scripts (barnes_hut_accuracy, block_timesteps_report, precision_benchmark,
+benchmark, batch_run, tiled_kernel_check, fmm_scaling, distributed): the default scenes, timing, errors against
+a reference, the common command line and the JSON report.
+
+    parser = report_parser('Barnes-Hut vs direct sum accuracy report')
+    parser.add_argument('--thetas', type=float, nargs='+', default=[0.5])
+    args = parser.parse_args()
+    report = [row for scene in scene_files(args.scenes) for row in scene_report(scene, ...)]
+    print_report(report)
+    save_report(report, args.json)
+'''
+import argparse, glob, json, os, time
+import numpy as np
+
+DEFAULT_SCENES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TestData_v2', '*.txt')
+
+
+def scene_files(scenes=None):
+    '''The given scene files, TestData_v2/*.txt if there are none'''
+    return list(scenes) if scenes else sorted(glob.glob(DEFAULT_SCENES))
+
+
+def load_scene(scene, n=0, seed=0):
+    '''(positions, velocities, weights) of a .nbody or .txt scene or of n particles of a synthetic_scenes generator'''
+    from synthetic_scenes import SCENE_GENERATORS
+    if scene in SCENE_GENERATORS:
+        return SCENE_GENERATORS[scene](n, seed)
+    from scene_format import is_binary_scene, read_scene, read_tsv_scene
+    return (read_scene(scene) if is_binary_scene(scene) else read_tsv_scene(scene))[:3]
+
+
+def timed(f, *args, **kwargs):
+    '''(f(*args, **kwargs), seconds it took)'''
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def relative_errors(approx, exact):
+    '''|approx - exact| / |exact| of every row, rows of an exact zero are compared to 1'''
+    norm = np.linalg.norm(exact, axis=1)
+    norm[norm == 0] = 1
+    return np.linalg.norm(approx - exact, axis=1) / norm
+
+
+def position_deviations(positions, reference):
+    '''Distance of every body from its reference position, relative to the radius of the reference scene
+    (largest distance from its mean position)'''
+    radius = np.max(np.linalg.norm(reference - reference.mean(axis=0), axis=1)) if len(reference) else 0.0
+    return np.linalg.norm(positions - reference, axis=1) / (radius or 1.0)
+
+
+def report_parser(description, scenes=True, scenes_help='scene files (.txt or .nbody), TestData_v2/*.txt by default'):
+    '''ArgumentParser with the arguments every report has: the scenes (unless scenes=False) and --json'''
+    parser = argparse.ArgumentParser(description=description)
+    if scenes:
+        parser.add_argument('scenes', nargs='*', help=scenes_help)
+    parser.add_argument('--json', help='save the report to this file')
+    return parser
+
+
+def save_report(report, path):
+    '''Writes the report to path as JSON, nothing if path is None'''
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,124 @@
+'''
+Binary scene format (.nbody) and the converter from the tab-separated text scenes.
+
+Layout, little-endian, every column is one contiguous array so the file can be memory-mapped
+straight into the Simulation buffers:
+
+    header (64 bytes): magic b'NBODYSCN', uint32 version, uint32 reserved, uint64 nbodies, zero padding
+    positions   float32 (nbodies, 3)    px py pz
+    velocities  float32 (nbodies, 3)    vx vy vz
+    weights     float32 (nbodies,)      m
+    colors      uint8   (nbodies, 3)    r g b
+
+    python scene_format.py "TestData_v2/planet and asteroidal system.txt" planets.nbody
+'''
+import argparse
+import numpy as np
+
+SCENE_MAGIC = b'NBODYSCN'
+SCENE_VERSION = 1
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('reserved', '<u4'),
+    ('nbodies', '<u8'),
+    ('padding', 'V40'),
+])
+assert HEADER_DTYPE.itemsize == 64
+
+# name, dtype, columns
+SCENE_COLUMNS = [
+    ('positions', np.dtype('<f4'), 3),
+    ('velocities', np.dtype('<f4'), 3),
+    ('weights', np.dtype('<f4'), 0),
+    ('colors', np.dtype('u1'), 3),
+]
+
+TSV_DTYPES = {
+    'px': np.float32,
+    'py': np.float32,
+    'pz': np.float32,
+    'vx': np.float32,
+    'vy': np.float32,
+    'vz': np.float32,
+    'm': np.float32,
+    'r': np.uint8,
+    'g': np.uint8,
+    'b': np.uint8
+}
+
+
+def is_binary_scene(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SCENE_MAGIC)) == SCENE_MAGIC
+
+
+def write_scene(path, positions, velocities, weights, colors):
+    '''Writes a .nbody scene, colors are uint8 r, g, b'''
+    nbodies = len(weights)
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = SCENE_MAGIC
+    header['version'] = SCENE_VERSION
+    header['nbodies'] = nbodies
+
+    columns = {'positions': positions, 'velocities': velocities, 'weights': weights, 'colors': colors}
+    with open(path, 'wb') as f:
+        header.tofile(f)
+        for name, dtype, width in SCENE_COLUMNS:
+            column = np.ascontiguousarray(columns[name], dtype=dtype)
+            if column.shape != ((nbodies, width) if width else (nbodies,)):
+                raise ValueError(f'{name} should have {nbodies} rows, got shape {column.shape}')
+            column.tofile(f)
+
+
+def read_scene(path, mode='c'):
+    '''Memory-maps a .nbody scene: (positions, velocities, weights, colors), nothing is read up front.
+
+    With the default copy-on-write mode the arrays are writable, pages are only copied when the
+    simulation writes them and the file itself never changes.
+    '''
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header['magic'][0] != SCENE_MAGIC:
+        raise Exception(f'"{path}" is not a binary scene')
+    if header['version'][0] != SCENE_VERSION:
+        raise Exception(f'Unsupported scene version {header["version"][0]} of "{path}"')
+
+    nbodies = int(header['nbodies'][0])
+    offset = HEADER_DTYPE.itemsize
+    arrays = []
+    for name, dtype, width in SCENE_COLUMNS:
+        shape = (nbodies, width) if width else (nbodies,)
+        if nbodies:
+            arrays.append(np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=shape))
+        else:
+            arrays.append(np.zeros(shape, dtype=dtype))
+        offset += nbodies * max(width, 1) * dtype.itemsize
+    return tuple(arrays)
+
+
+def read_tsv_scene(path):
+    '''Reads a tab-separated text scene: (positions, velocities, weights, colors)'''
+    import pandas as pd
+    df = pd.read_csv(path, delimiter='\t', dtype=TSV_DTYPES)
+    return (df[['px', 'py', 'pz']].to_numpy(), df[['vx', 'vy', 'vz']].to_numpy(),
+            df['m'].to_numpy(), df[['r', 'g', 'b']].to_numpy())
+
+
+def group_order(weights, colors):
+    '''Particle order by color, then by mass: the order PointsManager keeps particles in'''
+    return np.lexsort((weights, colors[:, 2], colors[:, 1], colors[:, 0]))
+
+
+def convert_tsv(tsv_path, scene_path):
+    '''Converts a text scene, particles are stored in group_order so that parse_points maps them without copies'''
+    positions, velocities, weights, colors = read_tsv_scene(tsv_path)
+    order = group_order(weights, colors)
+    write_scene(scene_path, positions[order], velocities[order], weights[order], colors[order])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a tab-separated text scene to the binary .nbody format')
+    parser.add_argument('tsv', help='text scene: px py pz vx vy vz m r g b')
+    parser.add_argument('scene', help='output .nbody file')
+    args = parser.parse_args()
+    convert_tsv(args.tsv, args.scene)
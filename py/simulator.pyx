@@ -1,103 +1,808 @@
-from libc.stdlib cimport malloc, free
-from numpy import empty_like
+from libc.stdlib cimport calloc, free
+from libc.string cimport memcpy
+from libc.math cimport NAN
 cimport numpy as np
 import numpy as np
+np.import_array()
+from numpy_simulator import (update_simulation_numpy, compute_accelerations, INTEGRATORS, pulling_particles,
+                             DIAGNOSTICS_DTYPE, DiagnosticsLog, state_diagnostics, diagnostics_dict, as_state_array)
+from checkpoint import write_checkpoint, read_checkpoint
 
-cdef extern from "vector_types.h":
+cdef extern from "libSimulation/simulator.h" nogil:
     cdef struct float3:
         float x, y, z
+    cdef struct double3:
+        double x, y, z
+    cdef struct float4:
+        float x, y, z, w
+
+    cdef int STATE_ON_HOST
+    cdef int STATE_ON_DEVICE
+    cdef int INTEGRATOR_EULER
+    cdef int INTEGRATOR_LEAPFROG
+    cdef int INTEGRATOR_YOSHIDA4
+    cdef int FORCES_NONE
+    cdef int FORCES_DIRECT
+    cdef int FORCES_BARNES_HUT
+    cdef int FORCES_NUMPY
+    cdef int FORCES_FMM
+    cdef int MIN_FMM_ORDER
+    cdef int MAX_FMM_ORDER
+    cdef int MAX_TIMESTEP_LEVEL
+    cdef int PRECISION_FLOAT32
+    cdef int PRECISION_KAHAN
+    cdef int PRECISION_FLOAT64
+
+    cdef struct SimulationDiagnostics:
+        pass
+
+    cdef struct SceneBounds:
+        double min[3]
+        double max[3]
+        double centerOfMass[3]
+        double radius
 
-cdef extern from "libSimulation/simulator.h":
-    cdef struct Particle:
-        float3 pos
-        float3 vel
-        float weight
-    
     cdef struct SimulationData:
-        Particle* particleData
+        float3* positions
+        float3* velocities
+        float* weights
+        float3* accelerations
+        double3* positions64
+        double3* velocities64
+        float3* positionErrors
+        float3* velocityErrors
+        float* potentials
+        int* origins
+        int* sources
         int nbodies
+        int nsources
+        int nthreads
+        float theta
+        int fmmOrder
+        int stateLocation
+        int integrator
+        int forcesSource
+        int precision
+        int timestepLevels
+        float timestepAccuracy
+        float mergeRadius
     
+    int syncSimulationToHost(SimulationData* data)
+    void releaseSimulationData(SimulationData* data)
     int updateSimulationCuda(SimulationData* data, float step)
     int updateSimulationC(SimulationData* data, float timeStep)
+    int updateSimulationBarnesHut(SimulationData* data, float timeStep)
+    int updateSimulationFmm(SimulationData* data, float timeStep)
+    int computeAccelerationsC(SimulationData* data, float3* acc)
+    int computeAccelerationsBarnesHut(SimulationData* data, float3* acc)
+    int computeAccelerationsFmm(SimulationData* data, float3* acc)
+    int computeAccelerationsTiled(SimulationData* data, int blockSize, float3* acc)
+    int computeActiveAccelerations(SimulationData* data, int forcesSource, const int* active, int nactive, float3* acc)
+    int essentialTree(SimulationData* data, float theta, int nboxes, const float* boxes, int* counts, float4* items, int capacity)
+    int computeDiagnostics(SimulationData* data, SimulationDiagnostics* diagnostics)
+    int computeBounds(SimulationData* data, SceneBounds* bounds)
+    int timestepLevelOccupancy(SimulationData* data, int* counts, long long* forceEvaluations)
+    int getTimestepLevels(SimulationData* data, int* levels, long long* forceEvaluations)
+    int setTimestepLevels(SimulationData* data, const int* levels, long long forceEvaluations)
+    int mergeCollisions(SimulationData* data, int* removed)
+
+INTEGRATOR_CODES = {
+    'EULER': INTEGRATOR_EULER,
+    'LEAPFROG': INTEGRATOR_LEAPFROG,
+    'YOSHIDA4': INTEGRATOR_YOSHIDA4,
+}
+assert set(INTEGRATOR_CODES) == set(INTEGRATORS)
+
+PRECISION_CODES = {
+    'FLOAT32': PRECISION_FLOAT32,
+    'KAHAN': PRECISION_KAHAN,
+    'FLOAT64': PRECISION_FLOAT64,
+}
+
+# Host force passes of Simulation.accelerations(targets=...)
+ACTIVE_FORCES_CODES = {
+    'C': FORCES_DIRECT,
+    'BARNES_HUT': FORCES_BARNES_HUT,
+    'FMM': FORCES_FMM,
+}
+
+# Force passes whose accelerations are on the host and can be saved by a checkpoint
+FORCES_CODES = {
+    'DIRECT': FORCES_DIRECT,
+    'BARNES_HUT': FORCES_BARNES_HUT,
+    'NUMPY': FORCES_NUMPY,
+    'FMM': FORCES_FMM,
+}
+
+# A DIAGNOSTICS_DTYPE record
+cdef struct DiagnosticsRecord:
+    long long step
+    double time
+    SimulationDiagnostics diagnostics
+
+assert DIAGNOSTICS_DTYPE.itemsize == sizeof(DiagnosticsRecord)
+
+ctypedef int (*UpdateFunction)(SimulationData* data, float timeStep) nogil
+
+
+cdef read_only_view(np.ndarray array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
 
 
 cdef class Simulation:
     cdef SimulationData* data
+    # float32 state buffers (structure of arrays) shared with NBodySimulation through SimulationData
+    cdef np.ndarray _positions, _velocities, _weights, _accelerations
+    # state of the 'FLOAT64' precision and compensation terms of 'KAHAN', allocated when the precision is chosen
+    cdef np.ndarray _positions64, _velocities64, _position_errors, _velocity_errors
+    # potentials of the last force pass, for the potential energy of diagnostics()
+    cdef np.ndarray _potentials
+    # original index of every particle, compacted by the collision stage together with the state
+    cdef np.ndarray _origins
+    # particles that pull (SimulationData::sources), None - all of them
+    cdef np.ndarray _sources
+    cdef float _test_particle_mass
+    cdef long long _step
+    cdef double _time
+    cdef object _log
+    cdef object _trajectory
+    cdef object _checkpoints
+    cdef object _positions_view, _velocities_view, _weights_view, _origins_view, _sources_view
 
-    def __cinit__(self, np.float32_t[:, :] particlesPositions not None, np.float32_t[:, :] particlesVelocities, np.float32_t[:] particlesWeights):
-        assert particlesPositions.shape[0] == particlesVelocities.shape[0] == particlesWeights.shape[0]
+    def __cinit__(self, particlesPositions not None, particlesVelocities not None, particlesWeights not None, int num_threads=0, float theta=0.5, integrator='EULER',
+                  int timestep_levels=0, float timestep_accuracy=0.02, precision='FLOAT32', copy=True, int fmm_order=4,
+                  float merge_radius=0.0, float test_particle_mass=0.0):
+        # The buffers live as long as the simulation and never move, steps update them in place.
+        # copy=False adopts the given arrays as the buffers (e.g. a memory-mapped scene, see scene_format)
+        self._positions = as_state_array(particlesPositions, 3, copy)
+        self._velocities = as_state_array(particlesVelocities, 3, copy)
+        self._weights = as_state_array(particlesWeights, copy=copy)
+        assert self._positions.shape[0] == self._velocities.shape[0] == self._weights.shape[0]
 
-        cdef int nbodies = particlesPositions.shape[0]
+        cdef int nbodies = self._positions.shape[0]
+        self._accelerations = np.zeros((nbodies, 3), dtype='float32')
+        self._potentials = np.zeros(nbodies, dtype='float32')
+        self._origins = np.arange(nbodies, dtype=np.intc)
+        self.make_views()
 
-        self.data = <SimulationData*>malloc(sizeof(SimulationData))
-        self.data.particleData = <Particle*> malloc(sizeof(Particle) * nbodies)
+        self.data = <SimulationData*>calloc(1, sizeof(SimulationData))
+        if self.data == NULL:
+            raise MemoryError()
+        self.data.positions = <float3*>np.PyArray_DATA(self._positions)
+        self.data.velocities = <float3*>np.PyArray_DATA(self._velocities)
+        self.data.weights = <float*>np.PyArray_DATA(self._weights)
+        self.data.accelerations = <float3*>np.PyArray_DATA(self._accelerations)
+        self.data.potentials = <float*>np.PyArray_DATA(self._potentials)
+        self.data.origins = <int*>np.PyArray_DATA(self._origins)
         self.data.nbodies = nbodies
+        self.data.stateLocation = STATE_ON_HOST
+        self.data.nthreads = num_threads
+        self.data.theta = theta
+        self.fmm_order = fmm_order
+        self.integrator = integrator
+        self.timestep_levels = timestep_levels
+        self.timestep_accuracy = timestep_accuracy
+        self.precision = precision
+        self.merge_radius = merge_radius
+        self.test_particle_mass = test_particle_mass
 
-        cdef:
-            int i
-            Particle p
-            np.float32_t[:] pos
-            np.float32_t[:] vel
-            np.float weight
-
-        for i in range(nbodies):
-            pos = particlesPositions[i]
-            vel = particlesVelocities[i]
-            weight = particlesWeights[i]
-
-            p = Particle()
-            p.pos.x = pos[0]
-            p.pos.y = pos[1]
-            p.pos.z = pos[2]
-            p.vel.x = vel[0]
-            p.vel.y = vel[1]
-            p.vel.z = vel[2]
-            p.weight = weight
-            
-            self.data.particleData[i] = p
+    def __dealloc__(self):
+        if self.data != NULL:
+            releaseSimulationData(self.data)
+            free(self.data)
 
+    property num_threads:
+        """CPU threads used by the 'C' backend, 0 - all available cores"""
+        def __get__(self):
+            return self.data.nthreads
 
-    def __dealloc__(self):
-        free(self.data.particleData)
-        free(self.data)
+        def __set__(self, int value):
+            if value < 0:
+                raise ValueError('num_threads should be >= 0')
+            self.data.nthreads = value
+
+    property theta:
+        """Opening angle of 'BARNES_HUT' (cells with size / distance < theta are treated as a point mass)
+        and 'FMM' (cells with radii sum / distance < theta interact through their expansions)
+        """
+        def __get__(self):
+            return self.data.theta
+
+        def __set__(self, float value):
+            if value < 0:
+                raise ValueError('theta should be >= 0')
+            self.data.theta = value
+            self.data.forcesSource = FORCES_NONE
+
+    property fmm_order:
+        """Degree of the 'FMM' multipole and local expansions, the force error falls as ~ theta^fmm_order"""
+        def __get__(self):
+            return self.data.fmmOrder
+
+        def __set__(self, int value):
+            if not MIN_FMM_ORDER <= value <= MAX_FMM_ORDER:
+                raise ValueError(f'fmm_order should be in [{MIN_FMM_ORDER}, {MAX_FMM_ORDER}]')
+            self.data.fmmOrder = value
+            self.data.forcesSource = FORCES_NONE
+
+    property integrator:
+        """Time integration scheme: 'EULER', 'LEAPFROG' (kick-drift-kick) or 'YOSHIDA4'"""
+        def __get__(self):
+            for name, code in INTEGRATOR_CODES.items():
+                if code == self.data.integrator:
+                    return name
+
+        def __set__(self, value):
+            if value not in INTEGRATOR_CODES:
+                raise ValueError(f'Undefined integrator "{value}". Use one of {", ".join(INTEGRATOR_CODES)}.')
+            self.data.integrator = INTEGRATOR_CODES[value]
+
+    property precision:
+        """Precision of the 'C', 'BARNES_HUT', 'FMM' and 'NUMPY' types:
+
+        'FLOAT32' - float32 state and force sums (the default, the only one of 'CUDA'),
+        'KAHAN' - float32 state, force sums in float64 and compensated (Kahan) summation of the steps,
+        'FLOAT64' - float64 state and force sums; positions / data stay float32 copies of it, copy() returns it.
+        """
+        def __get__(self):
+            for name, code in PRECISION_CODES.items():
+                if code == self.data.precision:
+                    return name
+
+        def __set__(self, value):
+            if value not in PRECISION_CODES:
+                raise ValueError(f'Undefined precision "{value}". Use one of {", ".join(PRECISION_CODES)}.')
+            self.sync_to_host()
+            code = PRECISION_CODES[value]
+            if code == PRECISION_FLOAT64 and self.data.precision != PRECISION_FLOAT64:
+                self._positions64 = self._positions.astype(np.float64)
+                self._velocities64 = self._velocities.astype(np.float64)
+            elif code != PRECISION_FLOAT64:
+                self._positions64 = self._velocities64 = None
+            if code == PRECISION_KAHAN:
+                self._position_errors = np.zeros_like(self._positions)
+                self._velocity_errors = np.zeros_like(self._velocities)
+            else:
+                self._position_errors = self._velocity_errors = None
+
+            self.data.positions64 = <double3*>np.PyArray_DATA(self._positions64) if self._positions64 is not None else NULL
+            self.data.velocities64 = <double3*>np.PyArray_DATA(self._velocities64) if self._velocities64 is not None else NULL
+            self.data.positionErrors = <float3*>np.PyArray_DATA(self._position_errors) if self._position_errors is not None else NULL
+            self.data.velocityErrors = <float3*>np.PyArray_DATA(self._velocity_errors) if self._velocity_errors is not None else NULL
+            self.data.precision = code
+            # the state only lives on the host from now on and the force sums change
+            self.data.stateLocation = STATE_ON_HOST
+            self.data.forcesSource = FORCES_NONE
+
+    property timestep_levels:
+        """Block time steps of the 'C', 'BARNES_HUT' and 'FMM' types: every particle steps by timestep / 2^level,
+        0 <= level <= timestep_levels, chosen per particle. 0 - one shared time step (the default)
+        """
+        def __get__(self):
+            return self.data.timestepLevels
+
+        def __set__(self, int value):
+            if not 0 <= value <= MAX_TIMESTEP_LEVEL:
+                raise ValueError(f'timestep_levels should be in [0, {MAX_TIMESTEP_LEVEL}]')
+            self.data.timestepLevels = value
+
+    property timestep_accuracy:
+        """eta of the block time step criterion dt = eta * |a| / |da/dt|, smaller is more accurate"""
+        def __get__(self):
+            return self.data.timestepAccuracy
+
+        def __set__(self, float value):
+            if not value > 0:
+                raise ValueError('timestep_accuracy should be > 0')
+            self.data.timestepAccuracy = value
+
+    property merge_radius:
+        """Collision stage after every step: particles closer than merge_radius are merged into one body of their
+        total mass, center of mass and momentum, 0 - off (the default). The number of particles then goes down:
+        positions, data, copy() and origin shrink with it, see origin. With "CUDA" the state is copied to the
+        host after every step for it.
+        """
+        def __get__(self):
+            return self.data.mergeRadius
+
+        def __set__(self, float value):
+            if not value >= 0:
+                raise ValueError('merge_radius should be >= 0')
+            self.data.mergeRadius = value
+
+    property origin:
+        """Read-only (nbodies,) index of every current particle among the particles the simulation was created
+        with: a merged body keeps the index of its heaviest member. Always ascending, arange(nbodies) until
+        the first merge.
+        """
+        def __get__(self):
+            return self._origins_view
+
+    property test_particle_mass:
+        """Particles lighter than test_particle_mass are test particles: the other particles pull them, they pull
+        nothing, so a force pass costs N * M instead of N^2 for M heavier particles. 0 - every particle pulls
+        (the default). Setting it classifies the particles by their current weights; a body merged later
+        (merge_radius) pulls if one of its members did. See sources.
+        """
+        def __get__(self):
+            return self._test_particle_mass
+
+        def __set__(self, float value):
+            if not value >= 0:
+                raise ValueError('test_particle_mass should be >= 0')
+            self._test_particle_mass = value
+            self.set_sources(pulling_particles(self._weights, value))
+
+    property sources:
+        """Read-only ascending indices of the particles that pull (see test_particle_mass), None if all of them do.
+        Can be set to any indices of particles as well (e.g. the share of another process, see distributed)
+        """
+        def __get__(self):
+            return self._sources_view
+
+        def __set__(self, value):
+            if value is not None:
+                value = np.unique(np.asarray(value, dtype=np.intp))
+                if len(value) and (value[0] < 0 or value[-1] >= self.data.nbodies):
+                    raise ValueError(f'sources should be indices of the {self.data.nbodies} particles')
+            self.set_sources(value)
+
+    cdef set_sources(self, sources):
+        self.sync_to_host()
+        if sources is None:
+            self._sources = None
+            self.data.sources = NULL
+            self.data.nsources = 0
+        else:
+            self._sources = np.array(sources, dtype=np.intc)
+            self.data.sources = <int*>np.PyArray_DATA(self._sources)
+            self.data.nsources = self._sources.shape[0]
+        self.make_views()
+        # other forces, and the device has to get the new sources
+        self.data.forcesSource = FORCES_NONE
+        self.data.stateLocation = STATE_ON_HOST
+
+    cdef make_views(self):
+        self._positions_view = read_only_view(self._positions)
+        self._velocities_view = read_only_view(self._velocities)
+        self._weights_view = read_only_view(self._weights)
+        self._origins_view = read_only_view(self._origins)
+        self._sources_view = read_only_view(self._sources) if self._sources is not None else None
+
+    cdef int merge_collisions(self) except -1 nogil:
+        cdef int removed = 0
+        if mergeCollisions(self.data, &removed):
+            with gil:
+                raise Exception('Failed to merge the collisions')
+        if removed:
+            # mergeCollisions compacted the buffers in place, the arrays are cut to the particles left
+            with gil:
+                self.truncate()
+        return removed
+
+    cdef truncate(self):
+        cdef int n = self.data.nbodies
+        self._positions = self._positions[:n]
+        self._velocities = self._velocities[:n]
+        self._weights = self._weights[:n]
+        self._accelerations = self._accelerations[:n]
+        self._potentials = self._potentials[:n]
+        self._origins = self._origins[:n]
+        if self._sources is not None:
+            self._sources = self._sources[:self.data.nsources]
+        if self._positions64 is not None:
+            self._positions64 = self._positions64[:n]
+            self._velocities64 = self._velocities64[:n]
+        if self._position_errors is not None:
+            self._position_errors = self._position_errors[:n]
+            self._velocity_errors = self._velocity_errors[:n]
+        self.make_views()
+
+    def timestep_occupancy(self):
+        """Block time steps report: (number of particles on every level, single-particle force evaluations made so far).
+
+        Level l steps by timestep / 2^l. None until the first block step with the current timestep_levels.
+        """
+        counts = np.zeros(self.data.timestepLevels + 1, dtype=np.intc)
+        cdef int[::1] countsView = counts
+        cdef long long evaluations = 0
+        if timestepLevelOccupancy(self.data, &countsView[0], &evaluations):
+            return None
+        return counts, evaluations
+
+    cdef sync_to_host(self):
+        if syncSimulationToHost(self.data):
+            raise Exception('Failed to copy the simulation state to the host')
 
     property positions:
+        """Read-only (nbodies, 3) view of the current positions, no copy is made.
+
+        The view follows the simulation as it advances, use .copy() to keep a snapshot.
+        """
         def __get__(self):
-            cdef:
-                float[:, :] dataPos = np.empty((self.data.nbodies, 3), dtype='float32')
-                int i
-            for i in range(self.data.nbodies):
-                dataPos[i, 0] = self.data.particleData[i].pos.x
-                dataPos[i, 1] = self.data.particleData[i].pos.y
-                dataPos[i, 2] = self.data.particleData[i].pos.z
-            return np.array(dataPos)
+            self.sync_to_host()
+            return self._positions_view
 
     property data:
+        """Read-only views of (positions, velocities, weights), see positions"""
         def __get__(self):
-            cdef:
-                float[:, :] dataPos = np.empty((self.data.nbodies, 3), dtype='float32')
-                float[:, :] dataVel = np.empty((self.data.nbodies, 3), dtype='float32')
-                float[:] dataWeight = np.empty((self.data.nbodies), dtype='float32')
-                int i
-            
-            for i in range(self.data.nbodies):
-                dataPos[i, 0] = self.data.particleData[i].pos.x
-                dataPos[i, 1] = self.data.particleData[i].pos.y
-                dataPos[i, 2] = self.data.particleData[i].pos.z
-                dataVel[i, 0] = self.data.particleData[i].vel.x
-                dataVel[i, 1] = self.data.particleData[i].vel.y
-                dataVel[i, 2] = self.data.particleData[i].vel.z
-                dataWeight[i] = self.data.particleData[i].weight
-
-            return np.array(dataPos), np.array(dataVel), np.array(dataWeight)
+            self.sync_to_host()
+            return self._positions_view, self._velocities_view, self._weights_view
 
-    def update(self, timestep=0.001, type='C'):
+    def copy(self):
+        """Snapshot of (positions, velocities, weights) that is not affected by further steps,
+        positions and velocities are float64 with the 'FLOAT64' precision
+        """
+        self.sync_to_host()
+        if self.data.precision == PRECISION_FLOAT64:
+            return self._positions64.copy(), self._velocities64.copy(), self._weights.copy()
+        return self._positions.copy(), self._velocities.copy(), self._weights.copy()
+
+    def accelerations(self, type='C', int block_size=256, targets=None, potentials=None):
+        """Accelerations of all particles for the current state, the state itself is not changed.
+
+        'TILED' is the CPU emulation of the tiled CUDA force kernel with blocks of block_size threads,
+        bit for bit what "CUDA" computes for float32 positions.
+        targets - indices of the particles to compute ("C", "BARNES_HUT" and "FMM"), the result has a row for each;
+        every particle still pulls. potentials, if given, receives the potentials of the targets
+        """
+        if targets is not None:
+            return self.target_accelerations(type, targets, potentials)
+        acc = np.empty((self.data.nbodies, 3), dtype='float32')
+        cdef float[:, ::1] accView = acc
+        cdef float3* accPtr = <float3*>&accView[0, 0] if self.data.nbodies else NULL
+        cdef int status
+        if type == 'C':
+            if computeAccelerationsC(self.data, accPtr):
+                raise Exception("Failed to compute accelerations with C")
+        elif type == 'BARNES_HUT':
+            if computeAccelerationsBarnesHut(self.data, accPtr):
+                raise Exception("Failed to compute accelerations with BARNES_HUT")
+        elif type == 'FMM':
+            if computeAccelerationsFmm(self.data, accPtr):
+                raise Exception("Failed to compute accelerations with FMM")
+        elif type == 'TILED':
+            with nogil:
+                status = computeAccelerationsTiled(self.data, block_size, accPtr)
+            if status:
+                raise Exception(f"Failed to compute accelerations with TILED, block_size {block_size}")
+        elif type == 'NUMPY':
+            self.sync_to_host()
+            positions = self._positions64 if self.data.precision == PRECISION_FLOAT64 else self._positions
+            compute_accelerations(positions, self._weights, out=acc, potentials=self._potentials, sources=self._sources)
+        else:
+            raise Exception(f'Undefined type "{type}". Use "C", "BARNES_HUT", "FMM", "TILED" or "NUMPY" instead.')
+        if potentials is not None:
+            potentials[...] = self._potentials
+        return acc
+
+    cdef target_accelerations(self, type, targets, potentials):
+        if type not in ACTIVE_FORCES_CODES:
+            raise Exception(f'Undefined type "{type}" for targets. Use "C", "BARNES_HUT" or "FMM" instead.')
+        cdef int[::1] active = np.ascontiguousarray(targets, dtype=np.intc)
+        cdef int nactive = active.shape[0]
+        if nactive and (np.min(active) < 0 or np.max(active) >= self.data.nbodies):
+            raise ValueError(f'targets should be indices of the {self.data.nbodies} particles')
+        acc = np.empty((nactive, 3), dtype='float32')
+        if not nactive:
+            return acc
+        cdef float[:, ::1] accView = acc
+        cdef int code = ACTIVE_FORCES_CODES[type]
+        cdef int status
+        with nogil:
+            status = computeActiveAccelerations(self.data, code, &active[0], nactive, <float3*>&accView[0, 0])
+        if status:
+            raise Exception(f'Failed to compute accelerations with {type}')
+        if potentials is not None:
+            potentials[...] = self._potentials[np.asarray(active)]
+        return acc
+
+    def essential_tree(self, boxes, theta=None):
+        """Locally essential trees of the particles for boxes of targets (k, 6: min xyz, max xyz), see essentialTree.
+
+        A list of (n, 4) float32 arrays, one per box: x, y, z and weight of the Barnes-Hut cells that are far enough
+        from every point of the box (with the opening angle theta, self.theta by default) and of the bodies of the
+        other leaves. Summed as bodies they give the targets in the box the field of these particles.
+        """
+        cdef float[:, ::1] boxesView = np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 6)
+        cdef int nboxes = boxesView.shape[0]
+        cdef float openingAngle = self.data.theta if theta is None else theta
+        counts = np.zeros(nboxes, dtype=np.intc)
+        if not nboxes:
+            return []
+        cdef int[::1] countsView = counts
+        cdef int capacity = max(1024, self.data.nbodies)
+        cdef int status
+        cdef float[:, ::1] itemsView
+        while True:
+            items = np.empty((capacity, 4), dtype=np.float32)
+            itemsView = items
+            with nogil:
+                status = essentialTree(self.data, openingAngle, nboxes, &boxesView[0, 0], &countsView[0],
+                                       <float4*>&itemsView[0, 0], capacity)
+            if status:
+                raise Exception('Failed to build the essential trees')
+            if counts.sum() <= capacity:
+                break
+            capacity = int(counts.sum())
+        return np.split(items[:counts.sum()], np.cumsum(counts)[:-1])
+
+    cdef UpdateFunction native_update_function(self, type):
         if type == 'C':
-            if updateSimulationC(self.data, timestep):
-                raise Exception("Failed to update with C")
+            return updateSimulationC
         elif type == 'CUDA':
-            if updateSimulationCuda(self.data, timestep):
-                raise Exception('Failed to update with CUDA')
+            return updateSimulationCuda
+        elif type == 'BARNES_HUT':
+            return updateSimulationBarnesHut
+        elif type == 'FMM':
+            return updateSimulationFmm
+        return NULL
+
+    def update(self, timestep=0.001, type='C'):
+        cdef UpdateFunction update_function = self.native_update_function(type)
+        cdef float step = timestep
+        cdef int status
+        if update_function != NULL:
+            with nogil:
+                status = update_function(self.data, step)
+            if status:
+                raise Exception(f'Failed to update with {type}')
+        elif type == 'NUMPY':
+            if self.data.timestepLevels:
+                raise Exception('Block time steps are only supported by "C", "BARNES_HUT" and "FMM"')
+            if self.data.precision == PRECISION_KAHAN:
+                raise Exception('"NUMPY" does not support the KAHAN precision')
+            self.sync_to_host()
+            if self.data.precision == PRECISION_FLOAT64:
+                update_simulation_numpy(self._positions64, self._velocities64, self._weights, timestep, self._accelerations,
+                                        self.integrator, self.data.forcesSource == FORCES_NUMPY, self._potentials, self._sources)
+                self._positions[...] = self._positions64
+                self._velocities[...] = self._velocities64
+            else:
+                update_simulation_numpy(self._positions, self._velocities, self._weights, timestep, self._accelerations,
+                                        self.integrator, self.data.forcesSource == FORCES_NUMPY, self._potentials, self._sources)
+            self.data.forcesSource = FORCES_NUMPY
+            self.data.stateLocation = STATE_ON_HOST
         else:
-            raise Exception(f'Undefined type "{type}". Use "C" or "CUDA" instead.')
-            
\ No newline at end of file
+            raise Exception(f'Undefined type "{type}". Use "C", "CUDA", "BARNES_HUT", "FMM" or "NUMPY" instead.')
+        if self.data.mergeRadius:
+            self.merge_collisions()
+        self._step += 1
+        self._time += timestep
+        if self._log and self._step % self._log.every == 0:
+            self.fill_diagnostics(self._log.records, self._log.next_index())
+        if self._trajectory and self._step % self._trajectory.every == 0:
+            self.record_frame()
+        if self._checkpoints and self._step % self._checkpoints.every == 0:
+            self._checkpoints.checkpoint(self)
+
+    cdef int write_diagnostics(self, DiagnosticsRecord* record) nogil:
+        record.step = self._step
+        record.time = self._time
+        return computeDiagnostics(self.data, &record.diagnostics)
+
+    cdef fill_diagnostics(self, np.ndarray records, int index):
+        if self.write_diagnostics(<DiagnosticsRecord*>np.PyArray_DATA(records) + index):
+            raise Exception('Failed to compute the diagnostics')
+
+    def diagnostics(self):
+        """Total, kinetic and potential energy, momentum, angular momentum and center of mass of the current state.
+
+        The potential energy is the one accumulated by the last force pass, a direct-sum pass is only made
+        when there is none for the current positions (before the first step or after 'CUDA' steps).
+        """
+        records = np.zeros(1, dtype=DIAGNOSTICS_DTYPE)
+        self.fill_diagnostics(records, 0)
+        return diagnostics_dict(records[0])
+
+    property step:
+        """Steps made since the simulation was created"""
+        def __get__(self):
+            return self._step
+
+    property time:
+        """Simulated time, the sum of the time steps made"""
+        def __get__(self):
+            return self._time
+
+    def record_trajectory(self, writer):
+        """Passes every writer.every-th step to writer.record (a trajectory.TrajectoryWriter), None - stop"""
+        self._trajectory = writer
+
+    cdef record_frame(self):
+        self.sync_to_host()
+        self._trajectory.record(self._step, self._time, self._positions, self._velocities, self._origins)
+
+    def save_checkpoint(self, path):
+        """Saves the full state to path atomically (see checkpoint), Simulation.load_checkpoint continues it
+        exactly: the same steps from the loaded simulation give bit-identical results
+        """
+        self.sync_to_host()
+        arrays = {'positions': self._positions, 'velocities': self._velocities, 'weights': self._weights,
+                  'origins': self._origins}
+        if self._sources is not None:
+            arrays['sources'] = self._sources
+        forces = None
+        for name, code in FORCES_CODES.items():
+            if code == self.data.forcesSource:
+                forces = name
+                arrays['accelerations'] = self._accelerations
+                arrays['potentials'] = self._potentials
+        if self.data.precision == PRECISION_FLOAT64:
+            arrays['positions64'] = self._positions64
+            arrays['velocities64'] = self._velocities64
+        if self.data.precision == PRECISION_KAHAN:
+            arrays['position_errors'] = self._position_errors
+            arrays['velocity_errors'] = self._velocity_errors
+
+        cdef long long evaluations = 0
+        levels = np.empty(self.data.nbodies, dtype=np.int32)
+        cdef int[::1] levelsView = levels
+        if self.data.timestepLevels and self.data.nbodies and not getTimestepLevels(self.data, &levelsView[0], &evaluations):
+            arrays['timestep_levels'] = levels
+
+        write_checkpoint(path, arrays, {
+            'step': self._step,
+            'time': self._time,
+            'integrator': self.integrator,
+            'precision': self.precision,
+            'theta': self.data.theta,
+            'fmm_order': self.data.fmmOrder,
+            'merge_radius': self.data.mergeRadius,
+            'test_particle_mass': self._test_particle_mass,
+            'num_threads': self.data.nthreads,
+            'timestep_levels': self.data.timestepLevels,
+            'timestep_accuracy': self.data.timestepAccuracy,
+            'forces': forces,
+            'force_evaluations': evaluations,
+        })
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """A new simulation in the state saved by save_checkpoint (also of numpy_simulator.Simulation)"""
+        arrays, meta = read_checkpoint(path)
+        cdef Simulation simulation = cls(arrays['positions'], arrays['velocities'], arrays['weights'],
+                                         meta.get('num_threads', 0), meta.get('theta', 0.5), meta['integrator'],
+                                         meta['timestep_levels'], meta.get('timestep_accuracy', 0.02), meta['precision'],
+                                         fmm_order=meta.get('fmm_order', 4), merge_radius=meta.get('merge_radius', 0.0),
+                                         test_particle_mass=meta.get('test_particle_mass', 0.0))
+        simulation.restore_state(arrays, meta)
+        return simulation
+
+    cdef restore_state(self, dict arrays, dict meta):
+        if self.data.precision == PRECISION_FLOAT64:
+            self._positions64[...] = arrays['positions64']
+            self._velocities64[...] = arrays['velocities64']
+        if self.data.precision == PRECISION_KAHAN:
+            self._position_errors[...] = arrays['position_errors']
+            self._velocity_errors[...] = arrays['velocity_errors']
+        if 'origins' in arrays:
+            self._origins[...] = arrays['origins']
+        # after merges the sources are not the particles test_particle_mass picks from the weights
+        self.set_sources(arrays.get('sources'))
+        if meta['forces'] is not None:
+            self._accelerations[...] = arrays['accelerations']
+            self._potentials[...] = arrays['potentials']
+            self.data.forcesSource = FORCES_CODES[meta['forces']]
+
+        cdef int[::1] levelsView
+        if 'timestep_levels' in arrays:
+            levelsView = np.ascontiguousarray(arrays['timestep_levels'], dtype=np.int32)
+            if setTimestepLevels(self.data, &levelsView[0], meta.get('force_evaluations', 0)):
+                raise Exception('Invalid block time step levels in the checkpoint')
+        self._step = meta['step']
+        self._time = meta['time']
+
+    def auto_checkpoint(self, policy):
+        """Passes every policy.every-th step to policy.checkpoint (a checkpoint.CheckpointPolicy), None - stop"""
+        self._checkpoints = policy
+
+    def bounds(self):
+        """Bounding box ('min', 'max'), 'center_of_mass' and 'radius' (rms distance from the center of mass)
+        of the current positions, one parallel pass without the GIL
+        """
+        cdef SceneBounds bounds
+        cdef int status
+        with nogil:
+            status = computeBounds(self.data, &bounds)
+        if status:
+            raise Exception('Failed to compute the bounds')
+        return {
+            'min': np.array(bounds.min),
+            'max': np.array(bounds.max),
+            'center_of_mass': np.array(bounds.centerOfMass),
+            'radius': bounds.radius,
+        }
+
+    def log_diagnostics(self, int every, int capacity=1024):
+        """Records diagnostics after every `every`-th step into a ring buffer of the last capacity records, 0 - stop"""
+        self._log = DiagnosticsLog(every, capacity) if every else None
+
+    def diagnostics_log(self):
+        """Logged records (numpy_simulator.DIAGNOSTICS_DTYPE), oldest first"""
+        return self._log.ordered() if self._log else np.zeros(0, dtype=DIAGNOSTICS_DTYPE)
+
+    def run(self, int n_steps, timestep=0.001, int record_every=0, type='C', out=None):
+        """Advances the simulation by n_steps steps in a single call.
+
+        Positions after every record_every-th step are written to out, a float32 array of shape
+        (n_steps // record_every, nbodies, 3) that is allocated when not given, and out is returned.
+        The native backends run the whole loop with the GIL released. Once particles were merged
+        (merge_radius) a snapshot only has origin.shape[0] of them, the rows after them are NaN.
+        """
+        cdef:
+            UpdateFunction update_function = self.native_update_function(type)
+            float[:, :, ::1] snapshots
+            float step_size = timestep
+            int step, status = 0, k
+            int width = self.data.nbodies
+            bint merge = self.data.mergeRadius != 0
+            DiagnosticsRecord* log_records = NULL
+            int log_every = 0, log_capacity = 0
+            long long log_count = 0
+            int trajectory_every = self._trajectory.every if self._trajectory else 0
+            int checkpoint_every = self._checkpoints.every if self._checkpoints else 0
+
+        if n_steps < 0 or record_every < 0:
+            raise ValueError('n_steps and record_every should be >= 0')
+        n_snapshots = n_steps // record_every if record_every else 0
+        if out is None:
+            out = np.empty((n_snapshots, self.data.nbodies, 3), dtype='float32')
+        elif out.shape != (n_snapshots, self.data.nbodies, 3):
+            raise ValueError(f'out should have shape {(n_snapshots, self.data.nbodies, 3)}, got {out.shape}')
+
+        if update_function == NULL:
+            if type != 'NUMPY':
+                raise Exception(f'Undefined type "{type}". Use "C", "CUDA", "BARNES_HUT", "FMM" or "NUMPY" instead.')
+            for step in range(1, n_steps + 1):
+                self.update(timestep, type)
+                if record_every and step % record_every == 0:
+                    out[step // record_every - 1, :len(self._positions)] = self._positions
+                    out[step // record_every - 1, len(self._positions):] = np.nan
+            return out
+
+        snapshots = out
+        if self._log:
+            log_records = <DiagnosticsRecord*>np.PyArray_DATA(self._log.records)
+            log_every, log_capacity, log_count = self._log.every, len(self._log.records), self._log.count
+        try:
+            with nogil:
+                for step in range(1, n_steps + 1):
+                    status = update_function(self.data, step_size)
+                    if status:
+                        break
+                    if merge:
+                        self.merge_collisions()
+                    self._step += 1
+                    self._time += step_size
+                    if log_every and self._step % log_every == 0:
+                        status = self.write_diagnostics(&log_records[log_count % log_capacity])
+                        log_count += 1
+                        if status:
+                            break
+                    if trajectory_every and self._step % trajectory_every == 0:
+                        # the writer only copies the frame, the disk is written by its own thread
+                        with gil:
+                            self.record_frame()
+                    if checkpoint_every and self._step % checkpoint_every == 0:
+                        with gil:
+                            self._checkpoints.checkpoint(self)
+                    if record_every and step % record_every == 0:
+                        status = syncSimulationToHost(self.data)
+                        if status:
+                            break
+                        if self.data.nbodies:
+                            memcpy(&snapshots[step // record_every - 1, 0, 0], self.data.positions, self.data.nbodies * sizeof(float3))
+                        for k in range(self.data.nbodies, width):
+                            snapshots[step // record_every - 1, k, 0] = NAN
+                            snapshots[step // record_every - 1, k, 1] = NAN
+                            snapshots[step // record_every - 1, k, 2] = NAN
+        finally:
+            # also when the trajectory writer raised in the middle of the loop
+            if self._log:
+                self._log.count = log_count
+        if status:
+            raise Exception(f'Failed to run with {type}')
+        return out
@@ -0,0 +1,106 @@
+'''
+Synthetic scenes of any size for benchmarks: a Plummer sphere in equilibrium, a cold uniform ball and an
+asteroid belt around a star with planets (test particles, see Simulation.test_particle_mass).
+
+Units of the engine (G = 1), total mass 1, scale radius 1. Every generator takes a seed, so the same
+(n, seed) always gives the same scene.
+
+    python synthetic_scenes.py plummer 100000 plummer_1e5.nbody
+'''
+import argparse
+import numpy as np
+
+# Plummer radii are cut here (in scale radii): the distribution has a tail to infinity
+PLUMMER_MAX_RADIUS = 20.0
+
+
+def _random_directions(rng, n):
+    z = rng.uniform(-1.0, 1.0, n)
+    phi = rng.uniform(0.0, 2 * np.pi, n)
+    s = np.sqrt(1.0 - z * z)
+    return np.stack((s * np.cos(phi), s * np.sin(phi), z), axis=1)
+
+
+def plummer_scene(n, seed=0):
+    '''(positions, velocities, weights) of a Plummer sphere, sampled as in Aarseth, Henon & Wielen (1974)'''
+    rng = np.random.default_rng(seed)
+    # cumulative mass M(r) = r^3 / (1 + r^2)^(3/2) inverted
+    max_mass = PLUMMER_MAX_RADIUS ** 3 / (1 + PLUMMER_MAX_RADIUS ** 2) ** 1.5
+    mass = rng.uniform(1e-10, max_mass, n)
+    radii = 1.0 / np.sqrt(mass ** (-2.0 / 3.0) - 1.0)
+
+    # speed in units of the escape speed sqrt(2) (1 + r^2)^(-1/4): q^2 (1 - q^2)^(7/2), rejection sampling
+    q = np.empty(n)
+    todo = np.arange(n)
+    while len(todo):
+        candidates = rng.uniform(0.0, 1.0, len(todo))
+        accepted = rng.uniform(0.0, 0.1, len(todo)) < candidates ** 2 * (1 - candidates ** 2) ** 3.5
+        q[todo[accepted]] = candidates[accepted]
+        todo = todo[~accepted]
+    speeds = q * np.sqrt(2.0) * (1.0 + radii ** 2) ** -0.25
+
+    positions = radii[:, None] * _random_directions(rng, n)
+    velocities = speeds[:, None] * _random_directions(rng, n)
+    # centre of mass at rest in the origin
+    positions -= positions.mean(axis=0)
+    velocities -= velocities.mean(axis=0)
+    weights = np.full(n, 1.0 / n)
+    return positions.astype(np.float32), velocities.astype(np.float32), weights.astype(np.float32)
+
+
+def uniform_scene(n, seed=0):
+    '''(positions, velocities, weights) of a uniform ball of radius 1 at rest (cold collapse)'''
+    rng = np.random.default_rng(seed)
+    radii = rng.uniform(0.0, 1.0, n) ** (1.0 / 3.0)
+    positions = radii[:, None] * _random_directions(rng, n)
+    weights = np.full(n, 1.0 / n)
+    return positions.astype(np.float32), np.zeros((n, 3), dtype=np.float32), weights.astype(np.float32)
+
+
+# Planets of belt_scene: (orbit radius, mass), the belt lies between BELT_RADII
+BELT_PLANETS = [(0.4, 1.7e-7), (0.7, 2.4e-6), (1.0, 3.0e-6), (1.5, 3.2e-7), (5.2, 9.5e-4), (9.5, 2.9e-4)]
+BELT_RADII = (2.1, 3.3)
+BELT_MASS = 1e-12
+
+
+def belt_scene(n, seed=0):
+    '''(positions, velocities, weights) of a star of mass 1 with planets on circular orbits (BELT_PLANETS) and an
+    asteroid belt of the remaining particles of mass BELT_MASS, nearly circular and nearly in the plane
+    '''
+    rng = np.random.default_rng(seed)
+    nplanets = min(len(BELT_PLANETS), max(n - 1, 0))
+    nbelt = max(n - 1 - nplanets, 0)
+    radii = np.concatenate(([0.0], [r for r, _ in BELT_PLANETS[:nplanets]], rng.uniform(*BELT_RADII, nbelt)))
+    weights = np.concatenate(([1.0], [m for _, m in BELT_PLANETS[:nplanets]], np.full(nbelt, BELT_MASS)))[:n]
+    radii = radii[:n]
+    angles = rng.uniform(0.0, 2 * np.pi, len(radii))
+    inclinations = np.concatenate((np.zeros(1 + nplanets), rng.normal(0.0, 0.05, nbelt)))[:n]
+
+    positions = radii[:, None] * np.stack((np.cos(angles), np.sin(angles) * np.cos(inclinations),
+                                           np.sin(angles) * np.sin(inclinations)), axis=1)
+    # circular speed around the star, the softening of the engine is negligible at these radii
+    speeds = np.sqrt(np.divide(1.0, radii, out=np.zeros_like(radii), where=radii > 0))
+    velocities = speeds[:, None] * np.stack((-np.sin(angles), np.cos(angles) * np.cos(inclinations),
+                                             np.cos(angles) * np.sin(inclinations)), axis=1)
+    return positions.astype(np.float32), velocities.astype(np.float32), weights.astype(np.float32)
+
+
+SCENE_GENERATORS = {
+    'plummer': plummer_scene,
+    'uniform': uniform_scene,
+    'belt': belt_scene,
+}
+
+
+if __name__ == '__main__':
+    from scene_format import write_scene
+
+    parser = argparse.ArgumentParser(description='Writes a synthetic scene in the binary .nbody format')
+    parser.add_argument('distribution', choices=list(SCENE_GENERATORS))
+    parser.add_argument('n', type=int, help='number of particles')
+    parser.add_argument('scene', help='output .nbody file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    positions, velocities, weights = SCENE_GENERATORS[args.distribution](args.n, args.seed)
+    write_scene(args.scene, positions, velocities, weights, np.full((args.n, 3), 255, dtype=np.uint8))
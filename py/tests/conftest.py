@@ -0,0 +1,49 @@
+'''
+Tests of the simulation engines, run from the py directory:
+
+    python -m pytest tests
+
+The tests of the native engine need the simulator module (python setup.py build_ext in libs/simulationPy
+builds it into py) and are skipped without it; the NumPy ones always run.
+'''
+import os, sys
+import numpy as np
+import pytest
+
+PY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PY_DIRECTORY)
+
+
+@pytest.fixture
+def native():
+    '''The native simulator module, the test is skipped if it is not built'''
+    return pytest.importorskip('simulator')
+
+
+@pytest.fixture
+def cluster():
+    '''(positions, velocities, weights) of 300 particles in a Gaussian cluster'''
+    rng = np.random.default_rng(1)
+    positions = rng.normal(0, 1, (300, 3))
+    velocities = rng.normal(0, 0.1, (300, 3))
+    weights = rng.uniform(0.5, 1.5, 300) / 300
+    return positions.astype(np.float32), velocities.astype(np.float32), weights.astype(np.float32)
+
+
+def direct_sum(positions, weights, sources=None):
+    '''Softened accelerations and potentials in float64, only the sources pull (all particles by default)'''
+    from numpy_simulator import G, SOFTENING_SQUARED
+    positions = np.asarray(positions, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    sources = np.arange(len(weights)) if sources is None else np.asarray(sources)
+    d = positions[sources][None, :, :] - positions[:, None, :]
+    dist = np.sqrt(np.einsum('ijk,ijk->ij', d, d) + SOFTENING_SQUARED)
+    pull = G * weights[sources][None, :] / dist
+    # a particle does not pull itself
+    pull[sources, np.arange(len(sources))] = 0
+    return np.einsum('ij,ijk->ik', pull / dist ** 2, d), -pull.sum(axis=1)
+
+
+def relative_error(approx, exact):
+    '''Largest |approx - exact| of a row relative to the largest |exact|'''
+    return np.max(np.linalg.norm(approx - exact, axis=1)) / np.max(np.linalg.norm(exact, axis=1))
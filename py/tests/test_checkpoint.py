@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pytest
+
+from checkpoint import CheckpointPolicy, latest_checkpoint
+from numpy_simulator import Simulation as NumpySimulation
+
+# (type, settings of the simulation)
+NATIVE_CASES = [
+    ('C', {'integrator': 'LEAPFROG'}),
+    ('C', {'integrator': 'YOSHIDA4', 'precision': 'KAHAN'}),
+    ('C', {'integrator': 'LEAPFROG', 'precision': 'FLOAT64'}),
+    ('C', {'integrator': 'LEAPFROG', 'timestep_levels': 4}),
+    ('BARNES_HUT', {'integrator': 'LEAPFROG'}),
+    ('FMM', {'integrator': 'LEAPFROG'}),
+    ('NUMPY', {'integrator': 'EULER'}),
+    ('C', {'integrator': 'LEAPFROG', 'merge_radius': 0.05}),
+]
+
+
+def assert_same_state(a, b):
+    for x, y in zip(a.copy(), b.copy()):
+        np.testing.assert_array_equal(x, y)
+    assert a.step == b.step
+    assert a.time == b.time
+
+
+@pytest.mark.parametrize('type, settings', NATIVE_CASES)
+def test_native_continuation_is_bit_identical(native, cluster, tmp_path, type, settings):
+    simulation = native.Simulation(*cluster, **settings)
+    simulation.run(10, 0.01, type=type)
+    path = str(tmp_path / 'state.npz')
+    simulation.save_checkpoint(path)
+    simulation.run(10, 0.01, type=type)
+
+    resumed = native.Simulation.load_checkpoint(path)
+    assert resumed.step == 10
+    resumed.run(10, 0.01, type=type)
+    assert_same_state(resumed, simulation)
+    np.testing.assert_array_equal(resumed.origin, simulation.origin)
+
+
+def test_numpy_continuation_is_bit_identical(cluster, tmp_path):
+    simulation = NumpySimulation(*cluster, integrator='YOSHIDA4')
+    simulation.run(10, 0.01)
+    path = str(tmp_path / 'state.npz')
+    simulation.save_checkpoint(path)
+    simulation.run(10, 0.01)
+
+    resumed = NumpySimulation.load_checkpoint(path)
+    resumed.run(10, 0.01)
+    assert_same_state(resumed, simulation)
+
+
+def test_checkpoints_move_between_the_engines(native, cluster, tmp_path):
+    path = str(tmp_path / 'state.npz')
+    fallback = NumpySimulation(*cluster, integrator='LEAPFROG')
+    fallback.run(5, 0.01)
+    fallback.save_checkpoint(path)
+    fallback.run(5, 0.01)
+
+    resumed = native.Simulation.load_checkpoint(path)
+    resumed.run(5, 0.01, type='NUMPY')
+    assert_same_state(resumed, fallback)
+
+
+def test_policy_keeps_the_last_checkpoints(native, cluster, tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    simulation = native.Simulation(*cluster)
+    simulation.auto_checkpoint(CheckpointPolicy(directory, every_steps=3, keep=2))
+    simulation.run(10, 0.01)
+    assert sorted(os.listdir(directory)) == ['checkpoint_000000000006.npz', 'checkpoint_000000000009.npz']
+    assert native.Simulation.load_checkpoint(latest_checkpoint(directory)).step == 9
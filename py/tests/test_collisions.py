@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from numpy_simulator import Simulation as NumpySimulation, merge_collisions
+
+MERGE_RADIUS = 0.1
+
+
+def colliding_scene(seed=0):
+    '''Scattered particles, a few close pairs and a chain whose ends are farther apart than the radius'''
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-10, 10, (200, 3))
+    positions[1] = positions[0] + [0.05, 0, 0]
+    positions[11] = positions[10] + [0, 0.03, 0.03]
+    positions[21] = positions[20] + [0.08, 0, 0]
+    positions[22] = positions[20] + [0.16, 0, 0]
+    positions[23] = positions[20] + [0.24, 0, 0]
+    velocities = rng.normal(0, 0.1, (200, 3))
+    weights = rng.uniform(0.1, 1.0, 200)
+    return positions.astype(np.float32), velocities.astype(np.float32), weights.astype(np.float32)
+
+
+def totals(positions, velocities, weights):
+    '''mass, momentum and mass-weighted position in float64'''
+    weights = np.asarray(weights, dtype=np.float64)
+    return (weights.sum(), weights @ np.asarray(velocities, dtype=np.float64),
+            weights @ np.asarray(positions, dtype=np.float64))
+
+
+def test_merge_collisions_conserves_mass_and_momentum():
+    positions, velocities, weights = colliding_scene()
+    before = totals(positions, velocities, weights)
+    keep = merge_collisions(positions, velocities, weights, MERGE_RADIUS)
+    after = totals(positions[keep], velocities[keep], weights[keep])
+    assert len(keep) == 200 - 1 - 1 - 3
+    for x, y in zip(after, before):
+        np.testing.assert_allclose(x, y, rtol=1e-6, atol=1e-6)
+
+
+def test_chain_becomes_one_body_in_place_of_its_heaviest_member():
+    positions, velocities, weights = colliding_scene()
+    weights[22] = 5.0
+    mass = weights[20:24].sum(dtype=np.float64)
+    center = weights[20:24].astype(np.float64) @ positions[20:24] / mass
+    keep = merge_collisions(positions, velocities, weights, MERGE_RADIUS)
+    assert 22 in keep and not np.isin([20, 21, 23], keep).any()
+    np.testing.assert_allclose(weights[22], mass, rtol=1e-6)
+    np.testing.assert_allclose(positions[22], center, rtol=1e-6)
+
+
+@pytest.mark.parametrize('type', ['C', 'BARNES_HUT', 'NUMPY'])
+def test_native_merges_conserve_mass_and_momentum(native, type):
+    scene = colliding_scene()
+    simulation = native.Simulation(*scene, merge_radius=MERGE_RADIUS)
+    before = totals(*simulation.copy())
+    # zero time step: only the collision stage changes the state
+    simulation.update(0.0, type)
+    after = totals(*simulation.copy())
+    assert len(simulation.positions) == 195
+    for x, y in zip(after, before):
+        np.testing.assert_allclose(x, y, rtol=1e-6, atol=1e-6)
+
+
+def test_native_and_numpy_merges_are_identical(native):
+    scene = colliding_scene(seed=3)
+    simulation = native.Simulation(*scene, merge_radius=MERGE_RADIUS)
+    fallback = NumpySimulation(*scene, merge_radius=MERGE_RADIUS)
+    simulation.update(0.0, 'C')
+    fallback.update(0.0)
+    for x, y in zip(simulation.copy(), fallback.copy()):
+        np.testing.assert_array_equal(x, y)
+    np.testing.assert_array_equal(simulation.origin, fallback.origin)
+
+
+def test_merging_runs_match_between_the_engines(native):
+    scene = colliding_scene(seed=4)
+    simulation = native.Simulation(*scene, merge_radius=MERGE_RADIUS)
+    fallback = NumpySimulation(*scene, merge_radius=MERGE_RADIUS)
+    simulation.run(20, 0.01, type='NUMPY')
+    fallback.run(20, 0.01)
+    for x, y in zip(simulation.copy(), fallback.copy()):
+        np.testing.assert_array_equal(x, y)
+    np.testing.assert_array_equal(simulation.origin, fallback.origin)
+
+
+def test_no_merges_without_radius(native):
+    scene = colliding_scene()
+    simulation = native.Simulation(*scene)
+    simulation.update(0.0, 'C')
+    assert len(simulation.positions) == 200
+    np.testing.assert_array_equal(simulation.origin, np.arange(200))
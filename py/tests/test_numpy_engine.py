@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from conftest import direct_sum, relative_error
+from numpy_simulator import INTEGRATORS, Simulation as NumpySimulation, compute_accelerations
+
+
+def test_accelerations_match_the_float64_sum(cluster):
+    positions, _, weights = cluster
+    potentials = np.empty(len(weights), dtype=np.float32)
+    acc = compute_accelerations(positions, weights, potentials=potentials)
+    exact, exact_potentials = direct_sum(positions, weights)
+    assert relative_error(acc, exact) < 1e-5
+    np.testing.assert_allclose(potentials, exact_potentials, rtol=1e-5)
+
+
+def test_blocks_do_not_change_the_result(cluster):
+    positions, _, weights = cluster
+    whole = compute_accelerations(positions, weights)
+    # blocks of 7 rows: many blocks, the last one partial
+    blocked = compute_accelerations(positions, weights, block_elements=7 * len(weights))
+    np.testing.assert_array_equal(blocked, whole)
+
+
+@pytest.mark.parametrize('integrator', list(INTEGRATORS))
+def test_numpy_steps_match_native_steps(native, cluster, integrator):
+    reference = native.Simulation(*cluster, integrator=integrator)
+    simulation = native.Simulation(*cluster, integrator=integrator)
+    fallback = NumpySimulation(*cluster, integrator=integrator)
+    reference.run(20, 0.01, type='C')
+    simulation.run(20, 0.01, type='NUMPY')
+    fallback.run(20, 0.01)
+    np.testing.assert_allclose(simulation.positions, reference.positions, atol=1e-5)
+    np.testing.assert_array_equal(fallback.positions, simulation.positions)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from conftest import direct_sum, relative_error
+from numpy_simulator import Simulation as NumpySimulation, compute_accelerations, pulling_particles
+from synthetic_scenes import belt_scene
+
+TEST_PARTICLE_MASS = 1e-9
+
+
+@pytest.fixture
+def belt():
+    return belt_scene(400, seed=2)
+
+
+def test_pulling_particles():
+    weights = np.array([1.0, 1e-12, 0.5, 0.0], dtype=np.float32)
+    np.testing.assert_array_equal(pulling_particles(weights, 1e-9), [0, 2])
+    assert pulling_particles(weights, 0.0) is None
+
+
+def test_numpy_sources_match_the_restricted_sum(cluster):
+    positions, _, weights = cluster
+    sources = np.arange(0, len(weights), 3)
+    potentials = np.empty(len(weights), dtype=np.float32)
+    acc = compute_accelerations(positions, weights, potentials=potentials, sources=sources)
+    exact, exact_potentials = direct_sum(positions, weights, sources)
+    assert relative_error(acc, exact) < 1e-5
+    np.testing.assert_allclose(potentials, exact_potentials, rtol=1e-5)
+
+
+@pytest.mark.parametrize('type', ['C', 'TILED', 'NUMPY'])
+def test_native_sources_match_the_restricted_sum(native, belt, type):
+    simulation = native.Simulation(*belt, test_particle_mass=TEST_PARTICLE_MASS)
+    sources = simulation.sources
+    assert len(sources) == 7
+    exact, _ = direct_sum(simulation.positions, belt[2], sources)
+    assert relative_error(simulation.accelerations(type), exact) < 1e-5
+
+
+def test_tiled_matches_direct_with_sources(native, belt):
+    simulation = native.Simulation(*belt, test_particle_mass=TEST_PARTICLE_MASS)
+    np.testing.assert_array_equal(simulation.accelerations('TILED', block_size=64), simulation.accelerations('C'))
+
+
+@pytest.mark.parametrize('type', ['BARNES_HUT', 'FMM'])
+def test_tree_sources_match_the_restricted_sum(native, belt, type):
+    simulation = native.Simulation(*belt, test_particle_mass=TEST_PARTICLE_MASS)
+    exact, _ = direct_sum(simulation.positions, belt[2], simulation.sources)
+    assert relative_error(simulation.accelerations(type), exact) < 1e-2
+
+
+@pytest.mark.parametrize('type, tolerance', [('C', 1e-5), ('BARNES_HUT', 1e-2), ('FMM', 1e-2)])
+def test_explicit_sources_match_the_restricted_sum(native, cluster, type, tolerance):
+    simulation = native.Simulation(*cluster)
+    sources = np.arange(0, 300, 3)
+    simulation.sources = sources
+    exact, _ = direct_sum(simulation.positions, cluster[2], sources)
+    assert relative_error(simulation.accelerations(type), exact) < tolerance
+
+
+def test_sources_setter(native, cluster):
+    simulation = native.Simulation(*cluster)
+    full = simulation.accelerations('C')
+    simulation.sources = [5, 1, 5, 3]
+    np.testing.assert_array_equal(simulation.sources, [1, 3, 5])
+    with pytest.raises(ValueError):
+        simulation.sources = [300]
+    simulation.sources = None
+    assert simulation.sources is None
+    np.testing.assert_array_equal(simulation.accelerations('C'), full)
+
+
+def test_diagnostics_count_test_particles_fully(native, belt):
+    simulation = native.Simulation(*belt, test_particle_mass=TEST_PARTICLE_MASS)
+    sources = simulation.sources
+    _, potentials = direct_sum(simulation.positions, belt[2], sources)
+    weights = belt[2].astype(np.float64)
+    test = np.ones(len(weights), dtype=bool)
+    test[sources] = False
+    expected = 0.5 * weights[sources] @ potentials[sources] + weights[test] @ potentials[test]
+    np.testing.assert_allclose(simulation.diagnostics()['potential_energy'], expected, rtol=1e-5)
+
+
+def test_native_and_numpy_steps_with_sources(native, belt):
+    simulation = native.Simulation(*belt, integrator='LEAPFROG', test_particle_mass=TEST_PARTICLE_MASS)
+    fallback = NumpySimulation(*belt, integrator='LEAPFROG', test_particle_mass=TEST_PARTICLE_MASS)
+    simulation.run(10, 0.01, type='NUMPY')
+    fallback.run(10, 0.01)
+    np.testing.assert_array_equal(simulation.positions, fallback.positions)
+
+
+def test_merged_body_pulls_if_a_member_did(native, belt):
+    positions, velocities, weights = (array.copy() for array in belt)
+    # a test particle on top of the first planet and two test particles on top of each other
+    positions[1] = positions[0] + [0.01, 0, 0]
+    positions[100] = positions[7]
+    positions[200] = positions[201]
+    simulation = native.Simulation(positions, velocities, weights, merge_radius=1e-3,
+                                   test_particle_mass=TEST_PARTICLE_MASS)
+    fallback = NumpySimulation(positions, velocities, weights, merge_radius=1e-3,
+                               test_particle_mass=TEST_PARTICLE_MASS)
+    pulling = set(simulation.origin[simulation.sources])
+    simulation.update(0.0, 'C')
+    fallback.update(0.0)
+    assert len(simulation.positions) == 398
+    # the star, the planets and the body the first planet's neighbour merged into; the asteroids stay test particles
+    assert set(simulation.origin[simulation.sources]) == pulling
+    np.testing.assert_array_equal(simulation.sources, fallback.sources)
+    np.testing.assert_array_equal(simulation.origin, fallback.origin)
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from numpy_simulator import Simulation as NumpySimulation
+from trajectory import TrajectoryReader, TrajectoryWriter
+
+
+def test_frames_round_trip(native, cluster, tmp_path):
+    path = str(tmp_path / 'trajectory')
+    simulation = native.Simulation(*cluster)
+    with TrajectoryWriter(path, every=2, chunk_frames=3) as writer:
+        simulation.record_trajectory(writer)
+        snapshots = simulation.run(10, 0.01, record_every=2)
+
+    trajectory = TrajectoryReader(path)
+    assert len(trajectory) == 5 and trajectory.every == 2
+    assert list(trajectory.chunk_nbodies) == [300, 300]
+    for k, frame in enumerate(trajectory):
+        assert frame['step'] == 2 * (k + 1)
+        np.testing.assert_array_equal(frame['positions'], snapshots[k])
+        np.testing.assert_array_equal(frame['origin'], np.arange(300))
+    np.testing.assert_array_equal(trajectory[-1]['velocities'], simulation.copy()[1])
+
+
+def test_fewer_particles_start_a_new_chunk(cluster, tmp_path):
+    path = str(tmp_path / 'trajectory')
+    positions, velocities, _ = cluster
+    origin = np.arange(0, 300, 2)
+    with TrajectoryWriter(path, chunk_frames=4) as writer:
+        writer.record(1, 0.01, positions, velocities)
+        writer.record(2, 0.02, positions[origin], velocities[origin], origin)
+        assert writer.frames == 2
+
+    trajectory = TrajectoryReader(path)
+    assert list(trajectory.chunk_nbodies) == [300, 150]
+    np.testing.assert_array_equal(trajectory[0]['positions'], positions)
+    np.testing.assert_array_equal(trajectory[1]['positions'], positions[origin])
+    np.testing.assert_array_equal(trajectory[1]['origin'], origin)
+
+
+def test_append_continues_the_trajectory(cluster, tmp_path):
+    path = str(tmp_path / 'trajectory')
+    simulation = NumpySimulation(*cluster)
+    with TrajectoryWriter(path) as writer:
+        simulation.record_trajectory(writer)
+        simulation.run(3, 0.01)
+
+    with TrajectoryWriter(path, append=True) as writer:
+        simulation.record_trajectory(writer)
+        simulation.run(2, 0.01)
+    trajectory = TrajectoryReader(path)
+    assert len(trajectory) == 5
+    assert trajectory[-1]['step'] == 5
+    np.testing.assert_array_equal(trajectory[-1]['positions'], simulation.positions)
+
+    with pytest.raises(ValueError):
+        with TrajectoryWriter(path, append=True) as writer:
+            writer.record(6, 0.0, np.zeros((301, 3), np.float32), np.zeros((301, 3), np.float32))
+
+
+@pytest.mark.parametrize('engine', ['native', 'numpy'])
+def test_merges_start_a_new_chunk(request, cluster, tmp_path, engine):
+    if engine == 'native':
+        simulation = request.getfixturevalue('native').Simulation(*cluster)
+    else:
+        simulation = NumpySimulation(*cluster)
+    path = str(tmp_path / 'trajectory')
+    frames = []
+    with TrajectoryWriter(path, every=1, chunk_frames=4) as writer:
+        simulation.record_trajectory(writer)
+        for step in range(10):
+            if step == 5:
+                simulation.merge_radius = 0.1
+            simulation.update(0.01)
+            frames.append((simulation.positions.copy(), simulation.origin.copy()))
+
+    trajectory = TrajectoryReader(path)
+    assert len(trajectory) == 10
+    assert trajectory.chunk_nbodies[0] == 300 and trajectory.chunk_nbodies[-1] < 300
+    for frame, (positions, origin) in zip(trajectory, frames):
+        np.testing.assert_array_equal(frame['positions'], positions)
+        np.testing.assert_array_equal(frame['origin'], origin)
+
+
+def test_append_continues_after_merges(native, cluster, tmp_path):
+    path = str(tmp_path / 'trajectory')
+    simulation = native.Simulation(*cluster, merge_radius=0.1)
+    with TrajectoryWriter(path) as writer:
+        simulation.record_trajectory(writer)
+        simulation.run(3, 0.01)
+    assert len(simulation.positions) < 300
+
+    with TrajectoryWriter(path, append=True) as writer:
+        simulation.record_trajectory(writer)
+        simulation.run(2, 0.01)
+    trajectory = TrajectoryReader(path)
+    assert len(trajectory) == 5
+    np.testing.assert_array_equal(trajectory[-1]['origin'], simulation.origin)
@@ -0,0 +1,74 @@
+'''
+Check of the tiled CUDA force kernel without a GPU: its CPU emulation ('TILED' accelerations, same grid,
+same tiles, same summation code) against the direct sum ('C'), bit for bit.
+
+For every scene and block size prints the bodies whose accelerations differ in any bit (must be 0), the
+time of one force evaluation and the interactions per second, so the scaling with N can be followed too.
+The synthetic sizes include ones that are not multiples of the block size and ones above 65536, the
+bodies the old fixed <<<256, 256>>> launch skipped. The exit code is 1 if any body differs.
+
+    python tiled_kernel_check.py
+    python tiled_kernel_check.py --sizes 1000 100000 --block-sizes 128 256 --no-test-data --json report.json
+'''
+import os, sys
+import numpy as np
+
+from reports import load_scene, report_parser, save_report, scene_files, timed
+from simulator import Simulation
+
+DEFAULT_SIZES = [1, 255, 1000, 4097, 70000]
+
+
+def scene_report(name, scene, block_sizes, threads):
+    simulation = Simulation(*scene, num_threads=threads)
+    exact, direct_time = timed(simulation.accelerations, 'C')
+    nbodies = len(exact)
+
+    rows = []
+    for block_size in block_sizes:
+        tiled, tiled_time = timed(simulation.accelerations, 'TILED', block_size=block_size)
+        # сравнение по битам: -0.0 != 0.0, NaN == NaN с тем же представлением
+        mismatches = np.any(tiled.view(np.uint32) != exact.view(np.uint32), axis=1)
+        rows.append({
+            'scene': name,
+            'nbodies': nbodies,
+            'block_size': block_size,
+            'blocks': -(-nbodies // block_size),
+            'mismatches': int(np.count_nonzero(mismatches)),
+            'max_difference': float(np.max(np.abs(tiled - exact))) if nbodies else 0.0,
+            'direct_time': direct_time,
+            'tiled_time': tiled_time,
+            'interactions_per_second': float(nbodies) * nbodies / max(tiled_time, 1e-9),
+        })
+    return rows
+
+
+def print_report(rows):
+    print(f'{"scene":<36}{"N":>8}{"block":>7}{"blocks":>8}{"mismatches":>12}{"tiled, s":>11}{"direct, s":>11}{"interactions/s":>16}')
+    for row in rows:
+        print(f'{row["scene"]:<36}{row["nbodies"]:>8}{row["block_size"]:>7}{row["blocks"]:>8}{row["mismatches"]:>12}'
+              f'{row["tiled_time"]:>11.4f}{row["direct_time"]:>11.4f}{row["interactions_per_second"]:>16.3e}')
+
+
+if __name__ == '__main__':
+    from synthetic_scenes import plummer_scene
+
+    parser = report_parser('Tiled CUDA force kernel (CPU emulation) vs direct sum')
+    parser.add_argument('--no-test-data', action='store_true', help='only the synthetic scenes')
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES, help='N of the synthetic Plummer scenes')
+    parser.add_argument('--block-sizes', type=int, nargs='+', default=[256])
+    parser.add_argument('--threads', type=int, default=0, help='OpenMP threads, 0 - all cores')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cases = [('plummer', plummer_scene(n, args.seed)) for n in sorted(args.sizes)]
+    if not args.no_test_data:
+        cases += [(os.path.basename(path), load_scene(path)) for path in scene_files(args.scenes)]
+
+    report = []
+    for name, scene in cases:
+        report.extend(scene_report(name, scene, args.block_sizes, args.threads))
+
+    print_report(report)
+    save_report(report, args.json)
+    sys.exit(1 if any(row['mismatches'] for row in report) else 0)
@@ -0,0 +1,217 @@
+'''
+Trajectory recording: positions, velocities and time of every k-th step into a chunked directory.
+
+    trajectory/
+        meta.json               nbodies, every, frames and particles of every chunk written so far
+        chunk_000000.npz        step (F,), time (F,), positions (F, N, 3), velocities (F, N, 3), origin (N,)
+        chunk_000001.npz
+        ...
+
+The directory is append-only: a chunk file is written once, then listed in meta.json (both replaced
+atomically), so a reader never sees a half-written chunk, even while the run is still going. Reading a
+frame loads only its chunk.
+
+The particles of a chunk are the same in all of its frames. When merges (Simulation.merge_radius) change
+their number the chunk is closed early and the next one has the new N; origin is the index of every
+particle of the chunk among the initial ones (Simulation.origin).
+
+    writer = TrajectoryWriter('run1', every=10)
+    simulation.record_trajectory(writer)
+    simulation.run(10000, 0.01)
+    writer.close()
+
+    trajectory = TrajectoryReader('run1')
+    frame = trajectory[500]     # {'step': ..., 'time': ..., 'positions': ..., 'velocities': ..., 'origin': ...}
+'''
+import json, os, queue, threading, warnings
+import numpy as np
+
+from checkpoint import replace_file
+
+TRAJECTORY_FORMAT = 'nbody-trajectory'
+TRAJECTORY_VERSION = 1
+META_FILE = 'meta.json'
+
+
+def _chunk_file(index):
+    return f'chunk_{index:06d}.npz'
+
+
+def _read_meta(path):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get('format') != TRAJECTORY_FORMAT or meta.get('version') != TRAJECTORY_VERSION:
+        raise Exception(f'"{path}" is not a trajectory directory')
+    return meta
+
+
+class TrajectoryWriter:
+    '''Records every `every`-th step of the simulations it is attached to (Simulation.record_trajectory).
+
+    Frames are copied into an in-memory chunk of chunk_frames frames, full chunks go through a queue of
+    at most queue_chunks chunks to a background thread that compresses and writes them, so a step never
+    waits for the disk. If the disk falls so far behind that the queue is full, the chunk is dropped and
+    counted in dropped_frames instead of blocking the simulation.
+
+    append=True continues an existing trajectory, with at most the particles of its last chunk (merges remove them).
+    '''
+    def __init__(self, path, every=1, chunk_frames=64, queue_chunks=4, compress=True, append=False):
+        if every < 1 or chunk_frames < 1 or queue_chunks < 1:
+            raise ValueError('every, chunk_frames and queue_chunks should be >= 1')
+        self.path = path
+        self.every = every
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        self.dropped_frames = 0
+
+        os.makedirs(path, exist_ok=True)
+        if append and os.path.exists(os.path.join(path, META_FILE)):
+            self._meta = _read_meta(path)
+        else:
+            if os.path.exists(os.path.join(path, META_FILE)):
+                raise Exception(f'"{path}" already contains a trajectory, use append=True to continue it')
+            self._meta = {'format': TRAJECTORY_FORMAT, 'version': TRAJECTORY_VERSION,
+                          'nbodies': None, 'every': every, 'chunks': [], 'chunk_nbodies': []}
+        self._next_chunk = len(self._meta['chunks'])
+        # frames of the chunks written or waiting in the queue
+        self._submitted_frames = sum(self._meta['chunks'])
+        self._chunk = None
+        # particles of the last chunk of this writer, None before its first frame
+        self._last_nbodies = None
+        self._frames = 0
+
+        self._queue = queue.Queue(maxsize=queue_chunks)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_chunks, name='TrajectoryWriter', daemon=True)
+        self._thread.start()
+
+    @property
+    def frames(self):
+        '''Frames recorded so far, including the ones still in memory'''
+        return self._submitted_frames + self._frames
+
+    def record(self, step, time, positions, velocities, origin=None):
+        '''Copies one frame, called by the simulation after every `every`-th step.
+
+        origin: index of every particle among the initial ones, by default they are the initial ones
+        '''
+        if self._error is not None:
+            raise Exception(f'Failed to write the trajectory to "{self.path}"') from self._error
+        nbodies = positions.shape[0]
+        if self._chunk is not None and self._chunk['positions'].shape[1] != nbodies:
+            # particles were merged: the frames so far keep their own chunk
+            self._submit(block=False)
+        if self._chunk is None:
+            if self._meta['nbodies'] is None:
+                self._meta['nbodies'] = nbodies
+            elif self._last_nbodies is None and self._meta['chunk_nbodies'] and self._meta['chunk_nbodies'][-1] < nbodies:
+                # merges only ever remove particles
+                raise ValueError(f'The trajectory has {self._meta["chunk_nbodies"][-1]} particles, got {nbodies}')
+            self._last_nbodies = nbodies
+            self._chunk = {
+                'step': np.empty(self.chunk_frames, dtype=np.int64),
+                'time': np.empty(self.chunk_frames, dtype=np.float64),
+                'positions': np.empty((self.chunk_frames, nbodies, 3), dtype=np.float32),
+                'velocities': np.empty((self.chunk_frames, nbodies, 3), dtype=np.float32),
+                'origin': np.array(np.arange(nbodies) if origin is None else origin, dtype=np.intc),
+            }
+        chunk, frame = self._chunk, self._frames
+        chunk['step'][frame] = step
+        chunk['time'][frame] = time
+        chunk['positions'][frame] = positions
+        chunk['velocities'][frame] = velocities
+        self._frames += 1
+        if self._frames == self.chunk_frames:
+            self._submit(block=False)
+
+    def _submit(self, block):
+        chunk = {name: values if name == 'origin' else values[:self._frames] for name, values in self._chunk.items()}
+        try:
+            self._queue.put((self._next_chunk, chunk), block=block)
+            self._next_chunk += 1
+            self._submitted_frames += self._frames
+        except queue.Full:
+            self.dropped_frames += self._frames
+            warnings.warn(f'Trajectory writer of "{self.path}" falls behind, {self._frames} frames dropped')
+        self._chunk = None
+        self._frames = 0
+
+    def _write_chunks(self):
+        save = np.savez_compressed if self.compress else np.savez
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            index, chunk = item
+            try:
+                replace_file(os.path.join(self.path, _chunk_file(index)), lambda f: save(f, **chunk))
+                self._meta['chunks'].append(len(chunk['step']))
+                self._meta['chunk_nbodies'].append(len(chunk['origin']))
+                meta = json.dumps(self._meta, indent=2).encode()
+                replace_file(os.path.join(self.path, META_FILE), lambda f: f.write(meta))
+            except Exception as error:
+                self._error = error
+
+    def close(self):
+        '''Writes the last, partial chunk and waits for the writer thread'''
+        if self._thread is None:
+            return
+        if self._frames:
+            self._submit(block=True)
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise Exception(f'Failed to write the trajectory to "{self.path}"') from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryReader:
+    '''Random access to the frames of a trajectory directory, loads one chunk at a time'''
+    def __init__(self, path):
+        self.path = path
+        self._cached_index = None
+        self._cached_chunk = None
+        self.refresh()
+
+    def refresh(self):
+        '''Picks up the chunks written since the reader was opened'''
+        meta = _read_meta(self.path)
+        self.nbodies = meta['nbodies']
+        self.every = meta['every']
+        self._chunk_frames = np.asarray(meta['chunks'], dtype=np.int64)
+        self.chunk_nbodies = np.asarray(meta['chunk_nbodies'], dtype=np.int64)
+        self._chunk_starts = np.concatenate(([0], np.cumsum(self._chunk_frames)))
+
+    def __len__(self):
+        return int(self._chunk_starts[-1])
+
+    def _load_chunk(self, index):
+        if index != self._cached_index:
+            with np.load(os.path.join(self.path, _chunk_file(index))) as chunk:
+                self._cached_chunk = {name: chunk[name] for name in chunk.files}
+            self._cached_index = index
+        return self._cached_chunk
+
+    def __getitem__(self, frame):
+        '''{'step', 'time', 'positions', 'velocities', 'origin'} of one frame, origin as in TrajectoryWriter.record'''
+        frame = int(frame)
+        if frame < 0:
+            frame += len(self)
+        if not 0 <= frame < len(self):
+            raise IndexError(f'frame {frame} out of range, the trajectory has {len(self)} frames')
+        index = int(np.searchsorted(self._chunk_starts, frame, side='right')) - 1
+        chunk = self._load_chunk(index)
+        offset = frame - self._chunk_starts[index]
+        return {name: values if name == 'origin' else values[offset] for name, values in chunk.items()}
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self[frame]
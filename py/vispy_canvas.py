@@ -0,0 +1,171 @@
+'''
+OpenGL point renderer (VisPy) with the interface of draw_simulation.MplCanvas.
+
+All particles are one vertex buffer drawn as GL points: positions are uploaded as they are, straight from
+the float32 (nbodies, 3) buffer of the simulation, sizes and colors are per-point attributes uploaded
+only when the points manager or the sizes change. No per-group draw calls and no rasterization on the
+CPU, so 10^5-10^6 particles render at interactive rates. Only OpenGL 2.1 is needed, software rendering
+(Mesa llvmpipe) works too.
+'''
+import numpy as np
+from PyQt5 import QtWidgets
+
+import vispy
+vispy.use(app='pyqt5')
+from vispy import gloo, scene, visuals
+
+from points_parser import PointsManager
+from numpy_simulator import scene_bounds
+from camera_follow import CameraFollow
+
+VERTEX_SHADER = '''
+uniform float u_size_scale;
+attribute vec3 a_position;
+attribute float a_size;
+attribute vec4 a_color;
+varying vec4 v_color;
+
+void main() {
+    gl_Position = $transform(vec4(a_position, 1.0));
+    gl_PointSize = max(a_size * u_size_scale, 1.0);
+    v_color = a_color;
+}
+'''
+
+FRAGMENT_SHADER = '''
+varying vec4 v_color;
+
+void main() {
+    // round points
+    vec2 offset = gl_PointCoord - vec2(0.5);
+    if (dot(offset, offset) > 0.25)
+        discard;
+    gl_FragColor = v_color;
+}
+'''
+
+
+class PointsVisual(visuals.Visual):
+    '''GL points with per-point size (pixels) and color'''
+    def __init__(self, size_scale=1.0):
+        super().__init__(vcode=VERTEX_SHADER, fcode=FRAGMENT_SHADER)
+        self._positions = gloo.VertexBuffer(np.zeros((1, 3), dtype=np.float32))
+        self._sizes = gloo.VertexBuffer(np.zeros(1, dtype=np.float32))
+        self._colors = gloo.VertexBuffer(np.zeros((1, 4), dtype=np.float32))
+        self._count = 0
+        self.size_scale = size_scale
+        self.shared_program['a_position'] = self._positions
+        self.shared_program['a_size'] = self._sizes
+        self.shared_program['a_color'] = self._colors
+        self._draw_mode = 'points'
+        self.set_gl_state('opaque', depth_test=True)
+
+    def set_attributes(self, sizes, colors):
+        '''Per-point sizes (N,) and rgb or rgba colors (N, 3 | 4) in [0, 1]'''
+        colors = np.asarray(colors, dtype=np.float32)
+        if colors.shape[1] == 3:
+            colors = np.hstack((colors, np.ones((len(colors), 1), dtype=np.float32)))
+        self._count = len(colors)
+        if self._count:
+            self._sizes.set_data(np.ascontiguousarray(sizes, dtype=np.float32))
+            self._colors.set_data(np.ascontiguousarray(colors))
+        self.update()
+
+    def set_positions(self, positions):
+        '''(N, 3) float32 positions, C-contiguous arrays are uploaded without a copy on the Python side'''
+        if len(positions):
+            self._positions.set_data(np.ascontiguousarray(positions, dtype=np.float32))
+        self.update()
+
+    def _prepare_transforms(self, view):
+        view.view_program.vert['transform'] = view.get_transform()
+
+    def _prepare_draw(self, view):
+        if not self._count:
+            return False
+        view.view_program['u_size_scale'] = self.size_scale * view.transforms.pixel_scale
+
+
+Points = scene.visuals.create_visual_node(PointsVisual)
+
+
+class VispyCanvas(QtWidgets.QWidget):
+    def __init__(self, parent=None, bgcolor='black', size_scale=1.0, camera_follow=None):
+        super().__init__(parent)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+        self.canvas = scene.SceneCanvas(keys=None, bgcolor=bgcolor, parent=self)
+        self.view = self.canvas.central_widget.add_view()
+        self.view.camera = scene.TurntableCamera(fov=45)
+        self.points = Points(size_scale=size_scale, parent=self.view.scene)
+        layout.addWidget(self.canvas.native)
+
+        self.camera_follow = camera_follow or CameraFollow('fixed')
+        self._half_size = None
+        self._points_manager = None
+        self._points_manager_changed = True
+        self._groups_updated = True
+        self._nbodies = None
+
+    @property
+    def points_manager(self):
+        return self._points_manager
+
+    @points_manager.setter
+    def points_manager(self, value):
+        assert isinstance(value, PointsManager), 'Invalid type'
+        self._points_manager = value
+        self._points_manager_changed = True
+        self._groups_updated = True
+
+    def change_points_size(self):
+        self._groups_updated = True
+
+    def update_points(self, positions=None, bounds=None, indices=None, origin=None):
+        '''bounds - Simulation.bounds() of the positions (the frame has them), computed here if not given;
+        indices - particles to draw (PointsManager.select), all of them if None;
+        origin - PointsManager.origin() of the positions, None if no particle was merged
+        '''
+        if not self._points_manager:
+            return
+        if positions is None:
+            positions = self._points_manager.simulation.positions
+            bounds = bounds or self._points_manager.simulation.bounds()
+            origin = self._points_manager.origin()
+            indices = self._points_manager.select(positions, bounds, origin)
+        if self._points_manager_changed:
+            self._points_manager_changed = False
+            self.camera_follow.reset()
+        # размеры и цвета заданы для загруженных частиц, после слияний они берутся по origin
+        particles = slice(None) if origin is None else origin
+        if len(positions):
+            self._follow(bounds or scene_bounds(positions, self._points_manager.weights[particles]))
+        if indices is not None:
+            # выборка меняется от кадра к кадру: атрибуты загружаются вместе с позициями, их не больше бюджета
+            particles = indices if origin is None else origin[indices]
+            self.points.set_attributes(self._points_manager.sizes[particles], self._points_manager.colors[particles])
+            self._groups_updated = True
+            self._nbodies = None
+            positions = positions[indices]
+        elif self._groups_updated or len(positions) != self._nbodies:
+            # частиц становится меньше только при слиянии: тогда атрибуты загружаются заново
+            self._groups_updated = False
+            self._nbodies = len(positions)
+            self.points.set_attributes(self._points_manager.sizes[particles], self._points_manager.colors[particles])
+        self.points.set_positions(positions)
+
+    def _follow(self, bounds):
+        # вид подгоняется под сцену целиком только после reset(), дальше двигаются центр и масштаб
+        # камеры, поворот и приближение пользователя сохраняются
+        fitted = self.camera_follow.center is None
+        center, half_size = self.camera_follow.update(bounds)
+        camera = self.view.camera
+        if fitted:
+            camera.set_range(*[(c - half_size, c + half_size) for c in center])
+        elif self.camera_follow.mode != 'fixed':
+            camera.center = tuple(center)
+            if self.camera_follow.mode == 'fit' and self._half_size:
+                camera.scale_factor *= half_size / self._half_size
+        self._half_size = half_size